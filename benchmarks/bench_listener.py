@@ -0,0 +1,47 @@
+"""
+Replay synthetic Pulse traffic through TaskEventApp's callbacks, no Pulse
+connection is made.
+"""
+
+import time
+import logging
+
+from common import PREFIX, clear, used_memory, summarize
+
+import listener
+from stats import Stats
+
+
+def run(rds, messages, batch_size=1):
+    """
+    Feed messages to a fresh TaskEventApp, returning throughput, per message
+    latency and the redis memory used by the resulting lists
+    """
+    clear(rds)
+    listener.setup_log().setLevel(logging.WARNING)
+    before = used_memory(rds)
+    stats = Stats(PREFIX, datastore=rds)
+    options = {'user': 'bench', 'passwd': 'bench',
+               'batch_size': batch_size, 'prefetch': 2 * batch_size,
+               'batch_timeout': 1}
+    app = listener.TaskEventApp(PREFIX, options, stats, datastore=rds)
+    if batch_size > 1:
+        handler = app._batch_callback_handler
+    else:
+        handler = app._route_callback_handler
+
+    latencies = []
+    start = time.time()
+    for body, message in messages:
+        message_start = time.time()
+        handler(body, message)
+        latencies.append(time.time() - message_start)
+    app._flush_batch()
+    stats.flush()
+    elapsed = time.time() - start
+
+    result = summarize(latencies, elapsed)
+    result['batch_size'] = batch_size
+    result['lists'] = rds.scard(PREFIX + 'list_keys')
+    result['redis_memory_bytes'] = used_memory(rds) - before
+    return result
@@ -0,0 +1,75 @@
+"""
+Time rebuilding the lists from a journal: compacting its segments into a
+snapshot, loading snapshot and tail, and restoring them into redis.
+"""
+
+import time
+import random
+import shutil
+import logging
+import tempfile
+
+from common import PREFIX, clear, used_memory
+
+import journal
+from stats import Stats
+from coalescer import CoalescingMachine
+
+
+def write_journal(directory, tasks, keys, completed, tail, seed=0):
+    """
+    Journal tasks inserts spread over keys coalesce keys over the last day,
+    the given fraction of them removed again.  The changes before the last
+    tail fraction are compacted into a snapshot, returning the seconds that
+    took
+    """
+    rnd = random.Random(seed)
+    log = journal.Journal(directory, lambda prefix, key: 5 * 24 * 3600,
+                          compact_segments=10 ** 9)
+    now = time.time()
+    compact_seconds = None
+    for i in range(tasks):
+        if i == int(tasks * (1 - tail)):
+            log.rotate()
+            start = time.time()
+            log.compact()
+            compact_seconds = time.time() - start
+        timestamp = now - 86400 * float(tasks - i) / tasks
+        key = 'key.%d' % rnd.randrange(keys)
+        taskId = 'task%08d' % i
+        log.append('+', PREFIX, key, [taskId], timestamp)
+        if rnd.random() < completed:
+            log.append('-', PREFIX, key, [taskId], timestamp)
+    log.close()
+    return compact_seconds
+
+
+def run(rds, tasks, keys=1000, completed=0.5, tail=0.1):
+    """
+    Journal tasks changes, then time loading and restoring the live lists
+    into a cleared redis
+    """
+    clear(rds)
+    directory = tempfile.mkdtemp()
+    try:
+        compact_seconds = write_journal(directory, tasks, keys, completed,
+                                        tail)
+        before = used_memory(rds)
+        coalescer = CoalescingMachine(PREFIX, rds, Stats(PREFIX, rds))
+        logging.getLogger().setLevel(logging.WARNING)
+        start = time.time()
+        lists = journal.load(directory, lambda prefix, key: coalescer.ttl)
+        load_seconds = time.time() - start
+        restored = coalescer.restore_lists(lists.get(PREFIX, {}))
+        total_seconds = time.time() - start
+    finally:
+        shutil.rmtree(directory)
+    result = {'tasks': tasks,
+              'restored': restored,
+              'compact_seconds': round(compact_seconds, 3),
+              'load_seconds': round(load_seconds, 3),
+              'restore_seconds': round(total_seconds - load_seconds, 3),
+              'per_sec': round(restored / total_seconds, 1),
+              'redis_memory_bytes': used_memory(rds) - before}
+    clear(rds)
+    return result
@@ -0,0 +1,136 @@
+"""
+Load test GET /v1/list/<age>/<size>/<key> with concurrent client processes
+against the web app served by werkzeug or gunicorn in separate processes.
+"""
+
+import os
+import sys
+import time
+import random
+import requests
+import subprocess
+import multiprocessing
+
+from common import ROOT, PREFIX, clear, free_port, used_memory, summarize
+
+from stats import Stats
+from coalescer import CoalescingMachine
+
+
+def populate(rds, keys, list_length):
+    """
+    Fill keys lists of list_length tasks inserted over the last hour, as the
+    listener writes them
+    """
+    now = time.time()
+    lists = {}
+    for k in range(keys):
+        lists['key.%d' % k] = dict(
+            ('task.%d.%d' % (k, i), now - 3600 * float(i) / list_length)
+            for i in range(list_length))
+    CoalescingMachine(PREFIX, rds, Stats(PREFIX, rds)).restore_lists(lists)
+
+
+def server_env(redis_url):
+    return dict(os.environ, REDIS_URL=redis_url, PREFIX=PREFIX,
+                ENVIRONMENT_TYPE='Production')
+
+
+def serve(redis_url, port):
+    os.environ.update(server_env(redis_url))
+    import logging
+    from werkzeug.serving import make_server
+    import web
+    web.app.logger.setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    make_server('127.0.0.1', port, web.app, threaded=True).serve_forever()
+
+
+def start_server(server, workers, redis_url, port):
+    """
+    Serve the web app with werkzeug's threaded server, or with gunicorn
+    running workers of the worker class given as gunicorn-<class>
+    """
+    if server == 'werkzeug':
+        process = multiprocessing.Process(target=serve,
+                                          args=(redis_url, port))
+        process.start()
+        return process
+    worker_class = server.split('-', 1)[1]
+    gunicorn = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+    return subprocess.Popen(
+        [gunicorn, '--config=config/gunicorn.py', '--workers', str(workers),
+         '--worker-class', worker_class, '--bind', '127.0.0.1:%d' % port,
+         '--log-level', 'warning', 'taskclustercoalesce.web:app'],
+        cwd=ROOT, env=server_env(redis_url), stdout=open(os.devnull, 'w'),
+        stderr=open(os.devnull, 'w'))
+
+
+def stop_server(process):
+    process.terminate()
+    if isinstance(process, subprocess.Popen):
+        process.wait()
+    else:
+        process.join()
+
+
+def client(base_url, keys, requests_count, seed, results):
+    rnd = random.Random(seed)
+    session = requests.Session()
+    latencies = []
+    for _ in range(requests_count):
+        # Half the queries exceed their thresholds and return the list
+        age = rnd.choice([60, 7200])
+        url = '%s/v1/list/%d/0/key.%d' % (base_url, age, rnd.randrange(keys))
+        start = time.time()
+        session.get(url).raise_for_status()
+        latencies.append(time.time() - start)
+    results.put(latencies)
+
+
+def run(rds, redis_url, keys, list_length, clients, requests_count,
+        server='werkzeug', workers=1):
+    """
+    Serve lists of list_length tasks for keys coalesce keys and query them
+    from clients processes, returning throughput and per request latency
+    """
+    clear(rds)
+    before = used_memory(rds)
+    populate(rds, keys, list_length)
+    memory = used_memory(rds) - before
+
+    port = free_port()
+    process = start_server(server, workers, redis_url, port)
+    base_url = 'http://127.0.0.1:%d' % port
+    try:
+        for _ in range(100):
+            try:
+                requests.get(base_url + '/v1/ping')
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        results = multiprocessing.Queue()
+        client_processes = [
+            multiprocessing.Process(target=client,
+                                    args=(base_url, keys, requests_count,
+                                          seed, results))
+            for seed in range(clients)]
+        start = time.time()
+        for client_process in client_processes:
+            client_process.start()
+        latencies = []
+        for _ in client_processes:
+            latencies.extend(results.get())
+        elapsed = time.time() - start
+        for client_process in client_processes:
+            client_process.join()
+    finally:
+        stop_server(process)
+        clear(rds)
+
+    result = summarize(latencies, elapsed)
+    result['clients'] = clients
+    result['server'] = server
+    result['workers'] = workers
+    result['redis_memory_bytes'] = memory
+    return result
@@ -0,0 +1,170 @@
+"""
+Helpers shared by the benchmarks: a scratch redis-server, synthetic Pulse
+traffic and latency summaries.
+"""
+
+import os
+import sys
+import time
+import redis
+import random
+import socket
+import subprocess
+import multiprocessing
+from urlparse import urlparse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'taskclustercoalesce'))
+
+# Prefix of every key the benchmarks write
+PREFIX = "bench.v1."
+
+
+class FakeMessage(object):
+
+    def __init__(self, coalesce_key):
+        self.headers = {'CC': ['route.' + PREFIX + coalesce_key]}
+
+    def ack(self):
+        pass
+
+    def requeue(self):
+        pass
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_redis():
+    """
+    Start a redis-server without persistence on a free port, returning the
+    process and its url
+    """
+    port = free_port()
+    process = subprocess.Popen(['redis-server', '--port', str(port),
+                                '--save', '', '--appendonly', 'no'],
+                               stdout=open(os.devnull, 'w'))
+    rds = redis.Redis(port=port)
+    for _ in range(50):
+        try:
+            rds.ping()
+            break
+        except redis.ConnectionError:
+            time.sleep(0.1)
+    return process, 'redis://localhost:%d' % port
+
+
+def start_latency_proxy(redis_url, latency):
+    """
+    Start a process relaying connections to redis_url with latency seconds
+    added to every round trip, as for a Redis across the network.  Returns
+    the process and the url to connect to instead
+    """
+    port = free_port()
+    url = urlparse(redis_url)
+    process = multiprocessing.Process(
+        target=relay, args=(port, url.hostname, url.port, latency / 2.0))
+    process.daemon = True
+    process.start()
+    time.sleep(0.5)
+    proxied = url._replace(netloc=url.netloc.replace(str(url.port),
+                                                     str(port)))
+    return process, proxied.geturl()
+
+
+def relay(port, host, upstream_port, delay):
+    from gevent import monkey
+    monkey.patch_all()
+    import gevent
+    from gevent.server import StreamServer
+    from gevent.socket import create_connection
+
+    def forward(source, destination):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                gevent.sleep(delay)
+                destination.sendall(data)
+        except socket.error:
+            pass
+        destination.close()
+
+    def handle(client, address):
+        upstream = create_connection((host, upstream_port))
+        gevent.spawn(forward, upstream, client)
+        forward(client, upstream)
+
+    StreamServer(('127.0.0.1', port), handle).serve_forever()
+
+
+def connect(redis_url):
+    url = urlparse(redis_url)
+    return redis.Redis(host=url.hostname, port=url.port,
+                       password=url.password)
+
+
+def clear(rds):
+    for key in rds.scan_iter(PREFIX + '*', count=1000):
+        rds.delete(key)
+
+
+def used_memory(rds):
+    return rds.info('memory')['used_memory']
+
+
+def build_traffic(count, keys, list_length, completed, out_of_order,
+                  seed=0):
+    """
+    Return (body, message) pairs for count tasks spread over keys coalesce
+    keys.  Pending events are followed list_length * keys events later by
+    a completion for the given fraction of tasks, so lists hover around
+    list_length; out_of_order is the fraction of completions delivered
+    ahead of their pending event.
+    """
+    rnd = random.Random(seed)
+    delay = list_length * keys
+    # position: [(body, key), ...] so completions can be scheduled ahead
+    slots = {}
+    for i in range(count):
+        key = 'key.%d' % rnd.randrange(keys)
+        pending = (status_body(i, 'pending'), key)
+        if rnd.random() < completed:
+            done = (status_body(i, 'completed'), key)
+            if rnd.random() < out_of_order:
+                slots.setdefault(i, []).extend([done, pending])
+                continue
+            slots.setdefault(i + delay, []).append(done)
+        slots.setdefault(i, []).append(pending)
+    return [(body, FakeMessage(coalesce_key))
+            for position in sorted(slots)
+            for body, coalesce_key in slots[position]]
+
+
+def status_body(i, state):
+    return {'runId': 0,
+            'status': {'state': state, 'taskId': 'task%08d' % i}}
+
+
+def summarize(latencies, elapsed):
+    """ Throughput and latency percentiles in milliseconds """
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(p / 100.0 * len(latencies)))
+        return round(latencies[index] * 1000, 3)
+
+    return {'count': len(latencies),
+            'per_sec': round(len(latencies) / elapsed, 1),
+            'p50_ms': percentile(50),
+            'p99_ms': percentile(99),
+            'max_ms': percentile(100)}
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Compare two benchmark results saved by benchmarks/run.py.
+
+    python benchmarks/compare.py benchmarks/results/abc1234.json \\
+        benchmarks/results/def5678.json
+"""
+
+import sys
+import json
+
+METRICS = ('per_sec', 'p50_ms', 'p99_ms', 'redis_memory_bytes')
+
+
+def change(old, new):
+    if old is None or new is None:
+        return ''
+    if not old:
+        return 'n/a'
+    return '%+.1f%%' % (100.0 * (new - old) / old)
+
+
+def compare(name, old, new):
+    for metric in METRICS:
+        print("%-24s %-20s %12s %12s %8s" % (
+            name, metric, old.get(metric), new.get(metric),
+            change(old.get(metric), new.get(metric))))
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(__doc__)
+        return 1
+    old, new = [json.load(open(path)) for path in sys.argv[1:]]
+    print("%-24s %-20s %12s %12s" % ('', '', old['commit'], new['commit']))
+    new_batches = dict((r['batch_size'], r) for r in new['listener'])
+    for result in old['listener']:
+        if result['batch_size'] in new_batches:
+            compare('listener batch %d' % result['batch_size'], result,
+                    new_batches[result['batch_size']])
+    new_servers = dict((r['server'], r) for r in new['web'])
+    for result in old['web']:
+        if result['server'] in new_servers:
+            compare('web ' + result['server'], result,
+                    new_servers[result['server']])
+    if old.get('recovery') and new.get('recovery'):
+        compare('recovery', old['recovery'], new['recovery'])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
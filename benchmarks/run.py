@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Run the listener and web benchmarks and save the results as JSON, named by
+the current commit unless --output is given, for comparison with
+benchmarks/compare.py.
+
+    python benchmarks/run.py --start-redis
+    REDIS_URL=redis://localhost:6379 python benchmarks/run.py --tasks 50000
+    python benchmarks/run.py --start-redis --skip-web --batch-sizes 1 50 500
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import common
+import bench_listener
+import bench_web
+import bench_recovery
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--start-redis', action='store_true',
+                        help='run against a scratch redis-server instead '
+                             'of REDIS_URL')
+    parser.add_argument('--tasks', type=int, default=20000)
+    parser.add_argument('--keys', type=int, default=50,
+                        help='coalesce key cardinality')
+    parser.add_argument('--list-length', type=int, default=20,
+                        help='pending tasks per list')
+    parser.add_argument('--completed', type=float, default=0.9,
+                        help='fraction of tasks which complete')
+    parser.add_argument('--out-of-order', type=float, default=0.01,
+                        help='fraction of completions arriving first')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1])
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--servers', nargs='+', default=['werkzeug'],
+                        help="'werkzeug' or gunicorn-<worker class>, eg. "
+                             "gunicorn-sync gunicorn-gevent")
+    parser.add_argument('--redis-latency', type=float, default=0,
+                        help='milliseconds added to each web round trip '
+                             'to Redis')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='gunicorn worker processes')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='web requests per client')
+    parser.add_argument('--skip-web', action='store_true')
+    parser.add_argument('--recovery-tasks', type=int, default=0,
+                        help='journal this many tasks and time restoring '
+                             'them, eg. 1000000; 0 skips')
+    parser.add_argument('--output')
+    return parser.parse_args()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short',
+                                        'HEAD'], cwd=common.ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    args = parse_args()
+    redis_process = proxy = None
+    if args.start_redis:
+        redis_process, redis_url = common.start_redis()
+    else:
+        redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379')
+    rds = common.connect(redis_url)
+
+    commit = git_commit()
+    results = {'commit': commit,
+               'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+               'params': vars(args),
+               'listener': [],
+               'web': [],
+               'recovery': None}
+    try:
+        messages = common.build_traffic(args.tasks, args.keys,
+                                        args.list_length, args.completed,
+                                        args.out_of_order)
+        for batch_size in args.batch_sizes:
+            result = bench_listener.run(rds, messages, batch_size)
+            print("listener batch %4d: %8.0f msgs/sec  p50 %.3f ms  "
+                  "p99 %.3f ms  %d bytes" %
+                  (batch_size, result['per_sec'], result['p50_ms'],
+                   result['p99_ms'], result['redis_memory_bytes']))
+            results['listener'].append(result)
+        web_redis_url = redis_url
+        if args.redis_latency and not args.skip_web:
+            proxy, web_redis_url = common.start_latency_proxy(
+                redis_url, args.redis_latency / 1000.0)
+        for server in [] if args.skip_web else args.servers:
+            result = bench_web.run(rds, web_redis_url, args.keys,
+                                   args.list_length, args.clients,
+                                   args.requests, server, args.workers)
+            print("web %s %d clients: %8.0f req/sec  p50 %.3f ms  "
+                  "p99 %.3f ms" %
+                  (server, args.clients, result['per_sec'],
+                   result['p50_ms'], result['p99_ms']))
+            results['web'].append(result)
+        if args.recovery_tasks:
+            result = bench_recovery.run(rds, args.recovery_tasks)
+            print("recovery %d tasks: %d restored in %.1fs (compact %.1fs, "
+                  "load %.1fs, restore %.1fs)" %
+                  (result['tasks'], result['restored'],
+                   result['load_seconds'] + result['restore_seconds'],
+                   result['compact_seconds'], result['load_seconds'],
+                   result['restore_seconds']))
+            results['recovery'] = result
+    finally:
+        common.clear(rds)
+        if proxy:
+            proxy.terminate()
+        if redis_process:
+            redis_process.terminate()
+
+    output = args.output or os.path.join(common.ROOT, 'benchmarks',
+                                         'results', commit + '.json')
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results saved to %s" % output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Report Redis memory per pending task for the original layout (a list plus
+one <taskId>.timestamp key per task) and the sorted set layout written by
+CoalescingMachine, using synthetic data under scratch prefixes.
+
+    REDIS_URL=redis://localhost:6379 python bin/memory_report.py 100000 50
+"""
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'taskclustercoalesce'))
+
+import redisconn  # noqa
+
+OLD_PREFIX = "memreport.old."
+NEW_PREFIX = "memreport.new."
+
+
+def used_memory(rds):
+    return rds.info('memory')['used_memory']
+
+
+def clear(rds, prefix):
+    for key in rds.scan_iter(prefix + '*', count=1000):
+        rds.delete(key)
+
+
+def fill_old(rds, task_count, key_count):
+    pipe = rds.pipeline(transaction=False)
+    for i in range(task_count):
+        taskId = 'task%016d' % i
+        pipe.sadd(OLD_PREFIX + "list_keys", 'key.%d' % (i % key_count))
+        pipe.lpush(OLD_PREFIX + 'lists.key.%d' % (i % key_count), taskId)
+        pipe.set(OLD_PREFIX + taskId + '.timestamp', time.time())
+        if i % 1000 == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def fill_new(rds, task_count, key_count):
+    pipe = rds.pipeline(transaction=False)
+    for i in range(task_count):
+        taskId = 'task%016d' % i
+        pipe.sadd(NEW_PREFIX + "list_keys", 'key.%d' % (i % key_count))
+        pipe.zadd(NEW_PREFIX + 'tasks.key.%d' % (i % key_count),
+                  taskId, time.time())
+        if i % 1000 == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def measure(rds, prefix, fill, task_count, key_count):
+    clear(rds, prefix)
+    before = used_memory(rds)
+    fill(rds, task_count, key_count)
+    used = used_memory(rds) - before
+    clear(rds, prefix)
+    return used
+
+
+def main():
+    task_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    key_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    rds = redisconn.connect(os.getenv('REDIS_URL', 'redis://localhost:6379'))
+
+    print("%d tasks over %d coalesce keys" % (task_count, key_count))
+    for name, prefix, fill in (('list + timestamp keys', OLD_PREFIX, fill_old),
+                               ('sorted set', NEW_PREFIX, fill_new)):
+        used = measure(rds, prefix, fill, task_count, key_count)
+        print("%-22s %12d bytes %8.1f bytes/task" %
+              (name, used, float(used) / task_count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Replay a message log recorded with the listener's CAPTURE_FILE into
+TaskEventApp against the Redis at REDIS_URL; no Pulse connection is made.
+Routes are rewritten to --prefix so a replay never touches live lists.
+
+    REDIS_URL=redis://localhost:6379 python bin/replay_pulse.py \\
+        --speed max --batch-size 50 capture.log.gz
+"""
+
+import os
+import sys
+import time
+import heapq
+import logging
+import argparse
+import cProfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'taskclustercoalesce'))
+
+import listener  # noqa
+import redisconn  # noqa
+from stats import Stats  # noqa
+from capture import read_log  # noqa
+
+LIVE_PREFIX = "coalesce.v1."
+
+
+class ReplayMessage(object):
+
+    def __init__(self, headers):
+        self.headers = headers
+
+    def ack(self):
+        pass
+
+    def requeue(self):
+        pass
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('logs', nargs='+', help='message logs to replay')
+    parser.add_argument('--speed', default='max',
+                        help="'max', or a multiple of the original speed")
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--prefix', default='replay.v1.')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write cProfile stats of the replay to FILE')
+    return parser.parse_args()
+
+
+def rewrite_routes(headers, prefix):
+    route = 'route.' + LIVE_PREFIX
+    headers = dict(headers)
+    headers['CC'] = ['route.' + prefix + cc[len(route):]
+                     if cc.startswith(route) else cc
+                     for cc in headers.get('CC', [])]
+    return headers
+
+
+def replay(app, handler, records, speed, prefix):
+    """ Feed records to handler, paced by speed unless it is None """
+    count = 0
+    start = first = None
+    for timestamp, body, headers in records:
+        if speed:
+            if first is None:
+                start, first = time.time(), timestamp
+            delay = (timestamp - first) / speed - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        handler(body, ReplayMessage(rewrite_routes(headers, prefix)))
+        count += 1
+    app._flush_batch()
+    return count
+
+
+def records(paths):
+    """
+    The records of the logs at paths, eg. the CAPTURE_FILE.<id> log of each
+    listener worker, merged in the order they were received
+    """
+    def keyed(index, path):
+        # Ties are broken by log, then position, never by comparing bodies
+        for position, record in enumerate(read_log(path)):
+            yield (record[0], index, position), record
+
+    merged = heapq.merge(*[keyed(index, path)
+                           for index, path in enumerate(paths)])
+    for _, record in merged:
+        yield record
+
+
+def main():
+    args = parse_args()
+    speed = None if args.speed == 'max' else float(args.speed)
+    if args.prefix == LIVE_PREFIX:
+        sys.exit("Refusing to replay into the live prefix")
+    rds = redisconn.connect(os.getenv('REDIS_URL', 'redis://localhost:6379'))
+    listener.setup_log().setLevel(logging.WARNING)
+    stats = Stats(args.prefix, datastore=rds)
+    options = {'user': 'replay', 'passwd': 'replay',
+               'batch_size': args.batch_size,
+               'prefetch': 2 * args.batch_size, 'batch_timeout': 1}
+    app = listener.TaskEventApp(args.prefix, options, stats, datastore=rds)
+    if args.batch_size > 1:
+        handler = app._batch_callback_handler
+    else:
+        handler = app._route_callback_handler
+
+    profile = cProfile.Profile() if args.profile else None
+    start = time.time()
+    if profile:
+        profile.enable()
+    count = replay(app, handler, records(args.logs), speed, args.prefix)
+    if profile:
+        profile.disable()
+        profile.dump_stats(args.profile)
+    elapsed = time.time() - start
+    stats.flush()
+    app.metrics.flush()
+    print("Replayed %d messages in %.1fs (%.0f msgs/sec)" %
+          (count, elapsed, count / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    main()
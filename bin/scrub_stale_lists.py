@@ -3,51 +3,271 @@
 import sys
 import os
 import time
-import redis
-import taskcluster
 import logging
-from urlparse import urlparse
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
 from datetime import timedelta
 
-queue = taskcluster.Queue()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'taskclustercoalesce'))
 
+import redisconn  # noqa
+import sharding  # noqa
+import journal  # noqa
+from coalescer import CoalescingMachine, parse_deadlines, pipe_drop_list  # noqa
 
-def main(rds):
-    pf = "coalesce.v1."
+PREFIX = "coalesce.v1."
+
+QUEUE_BASE_URL = "https://queue.taskcluster.net/v1"
+
+# Parallel status requests and the maximum requests/sec across all of them
+CONCURRENCY = 20
+RATE_LIMIT = 100
+
+# Tasks checked between each pipelined removal from redis
+CHUNK_SIZE = 500
+
+# Lists fetched from the age index per batch and tasks fetched per list page
+SCAN_COUNT = 100
+PAGE_SIZE = 100
+
+# A saved cursor older than this is stale, the next run starts over
+CURSOR_TTL = 24 * 60 * 60
+
+# Seconds between progress log lines
+PROGRESS_INTERVAL = 10
+
+
+class RateLimiter(object):
+    """ Spaces calls to wait() at least 1/rate seconds apart across threads """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_slot = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class QueueStatus(object):
+    """
+    Client for the Taskcluster queue's task status endpoint sharing one
+    pooled HTTP session between the scrubber's threads
+    """
+
+    def __init__(self, base_url=QUEUE_BASE_URL, concurrency=CONCURRENCY,
+                 rate_limit=RATE_LIMIT, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.limiter = RateLimiter(rate_limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency,
+                              max_retries=3)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def is_pending(self, taskId):
+        """
+        False only if the queue reports the task as unknown or no longer
+        pending; any error keeps the task
+        """
+        self.limiter.wait()
+        url = "%s/task/%s/status" % (self.base_url, taskId)
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+        except requests.exceptions.RequestException, err:
+            logging.debug("Taskcluster rest api error (%s): %s" %
+                          (taskId, err))
+            return True
+        if response.status_code == 404:
+            return False
+        if not response.ok:
+            logging.debug("Taskcluster rest api error (%s): %s %s" %
+                          (taskId, response.status_code, response.reason))
+            return True
+        return response.json()['status']['state'] == 'pending'
+
+
+class Progress(object):
+    """ Logs throughput at most every PROGRESS_INTERVAL seconds """
+
+    def __init__(self):
+        self.start = self.last_log = time.time()
+        self.checked = 0
+        self.removed = 0
+
+    def update(self, checked, removed):
+        self.checked += checked
+        self.removed += removed
+        now = time.time()
+        if now - self.last_log >= PROGRESS_INTERVAL:
+            self.last_log = now
+            logging.info("Checked %d tasks (%.1f/sec), removed %d" %
+                         (self.checked, self.checked / (now - self.start),
+                          self.removed))
+
+
+def main(rds, queue, concurrency=CONCURRENCY, chunk_size=CHUNK_SIZE,
+         scan_count=SCAN_COUNT, page_size=PAGE_SIZE, time_budget=None,
+         removal_log=None):
+    """
+    Scrub the lists in batches of scan_count keys taken from the age index
+    in ascending order, so the lists holding the oldest tasks are checked
+    first, saving the score reached after each batch so a run stopped by
+    time_budget (seconds) or a crash resumes where it left off.  Lists
+    missing from the index, written before it existed, are indexed by the
+    reaper at startup.  Removals are appended to the Journal removal_log,
+    if given, so restoring the listener's journal does not bring them back.
+    Returns (tasks_removed, lists_removed, finished)
+    """
+    pf = PREFIX
+    cursor_key = pf + "scrub.cursor"
+    deadline = time.time() + time_budget if time_budget else None
+
+    def expired():
+        return deadline is not None and time.time() >= deadline
 
-    tasks_removed = 0
     lists_removed = 0
+    progress = Progress()
+    pool = ThreadPool(concurrency)
 
-    list_keys = rds.smembers(pf + "list_keys")
-    for key in list_keys:
-        logging.debug("Inspecting list: " + pf + key)
-        coalesce_list = rds.lrange(pf + "lists." + key, start=0, end=-1)
-        for taskId in coalesce_list:
-            logging.debug(" - inspecting task: " + taskId)
-            if not is_pending(taskId):
-                logging.debug("Removing stale task: " + taskId)
-                rds.lrem(pf + 'lists.' + key, taskId, num=0)
-                tasks_removed += 1
-        if not rds.llen(pf + "lists." + key):
-            logging.debug("Removing stale list key: " + key)
-            rds.srem(pf + "list_keys", key)
-            lists_removed += 1
+    def check(task):
+        score, key, taskId = task
+        return key, taskId, queue.is_pending(taskId)
 
-    return tasks_removed, lists_removed
+    def scrub(tasks, removed):
+        """ Check tasks in parallel, then remove the stale ones """
+        stale = [(key, taskId) for key, taskId, pending
+                 in pool.imap_unordered(check, tasks) if not pending]
+        if stale:
+            for key, taskId in stale:
+                logging.debug("Removing stale task: " + taskId)
+                removed[key] = removed.get(key, 0) + 1
+            remove_tasks(rds, pf, stale, removal_log)
+        progress.update(len(tasks), len(stale))
 
+    def scrub_keys(keys):
+        """
+        Page through the lists of a batch of keys together, checking each
+        round of pages oldest task first.  Returns False if out of time.
+        """
+        offsets = dict((key, 0) for key in keys)
+        while offsets:
+            pipe = rds.pipeline(transaction=False)
+            page_keys = offsets.keys()
+            for key in page_keys:
+                pipe.zrange(pf + "tasks." + key, offsets[key],
+                            offsets[key] + page_size - 1, withscores=True)
+            pages = pipe.execute()
+            tasks = sorted((score, key, taskId)
+                           for key, page in zip(page_keys, pages)
+                           for taskId, score in page)
+            removed = {}
+            for i in range(0, len(tasks), chunk_size):
+                if expired():
+                    return False
+                scrub(tasks[i:i + chunk_size], removed)
+            for key, page in zip(page_keys, pages):
+                if len(page) < page_size:
+                    del offsets[key]
+                else:
+                    # Stale tasks were removed from ahead of the next page
+                    offsets[key] += len(page) - removed.get(key, 0)
+        return True
 
-def is_pending(taskId):
+    index_key = pf + "age_index"
+    cursor = rds.get(cursor_key) or '-inf'
+    if cursor != '-inf':
+        logging.info("Resuming scrub at age index score %s" % cursor)
     try:
-        status = queue.status(taskId)
-        if not status['status']['state'] == 'pending':
-            return False
-    except taskcluster.exceptions.TaskclusterRestFailure, err:
-        logging.debug("Taskcluster rest api error (%s): %s %s" % (taskId,
-                                                                  err.status,
-                                                                  err.message))
-        if err.status_code == 404:
-            return False
-    return True
+        while True:
+            batch = rds.zrangebyscore(index_key, cursor, '+inf', start=0,
+                                      num=scan_count, withscores=True)
+            keys = [key for key, _ in batch]
+            next_cursor = None
+            if len(batch) == scan_count:
+                # Take the keys tied with the last one too, so the next
+                # batch starts past its score
+                last = batch[-1][1]
+                seen = set(keys)
+                keys.extend(key for key
+                            in rds.zrangebyscore(index_key, last, last)
+                            if key not in seen)
+                next_cursor = '(%r' % last
+            logging.debug("Inspecting %d lists" % len(keys))
+            finished = scrub_keys(keys)
+            pipe = rds.pipeline(transaction=False)
+            for key in keys:
+                pipe.zcard(pf + "tasks." + key)
+            for key, length in zip(keys, pipe.execute()):
+                if length == 0 and remove_if_empty(rds, pf, key):
+                    logging.debug("Removing stale list key: " + key)
+                    lists_removed += 1
+            if not finished:
+                # Start the interrupted batch again next time
+                rds.set(cursor_key, cursor, ex=CURSOR_TTL)
+                logging.info("Time budget spent, stopping at score %s" %
+                             cursor)
+                break
+            if next_cursor is None:
+                rds.delete(cursor_key)
+                break
+            cursor = next_cursor
+            rds.set(cursor_key, cursor, ex=CURSOR_TTL)
+    finally:
+        pool.close()
+        pool.join()
+
+    return progress.removed, lists_removed, finished
+
+
+def remove_tasks(rds, pf, stale, removal_log=None):
+    """
+    Remove the (key, taskId) of stale tasks, notifying the web API's cache
+    and /v1/list ETag as the listener does.  The removals are then journaled
+    to removal_log, if given
+    """
+    keys = sorted(set(key for key, _ in stale))
+    pipe = rds.pipeline()
+    for key, taskId in stale:
+        pipe.zrem(pf + 'tasks.' + key, taskId)
+    for key in keys:
+        pipe.publish(pf + "invalidate", key)
+    pipe.incr(pf + "version")
+    pipe.execute()
+    if removal_log is not None:
+        now = time.time()
+        for key in keys:
+            removal_log.append('-', pf, key,
+                               [taskId for stale_key, taskId in stale
+                                if stale_key == key], now)
+
+
+def remove_if_empty(rds, pf, key):
+    """
+    Drop an empty list from list_keys and the age index as the listener
+    does.  The list is WATCHed so an insert by the listener racing
+    in between leaves the key registered.
+    """
+    tasks_key = pf + "tasks." + key
+
+    def drop_if_empty(pipe):
+        if pipe.zcard(tasks_key) == 0:
+            listed = pipe.sismember(pf + "list_keys", key)
+            pipe.multi()
+            pipe_drop_list(pipe, pf, key, listed)
+
+    return bool(rds.transaction(drop_if_empty, tasks_key))
 
 
 if __name__ == '__main__':
@@ -55,24 +275,58 @@ if __name__ == '__main__':
                         level=logging.DEBUG)
 
     try:
-        redis_url = urlparse(os.environ['REDIS_URL'])
+        redis_url = os.environ['REDIS_URL']
     except KeyError:
         logging.exception("Missing REDIS_URL env variable")
         sys.exit(1)
 
-    rds = redis.Redis(host=redis_url.hostname,
-                      port=redis_url.port,
-                      password=redis_url.password)
+    # Each shard holds its own lists, age index and scrub cursor
+    nodes = [redisconn.connect(url) for url in
+             sharding.shard_urls(os.getenv('REDIS_SHARD_URLS')) or
+             [redis_url]]
+
+    # Journal removals alongside the listener's, see restore_from_journal
+    removal_log = None
+    if os.getenv('JOURNAL_DIR'):
+        coalescer = CoalescingMachine(
+            PREFIX, None, None,
+            ttl=int(os.environ['TASK_TTL']) if os.getenv('TASK_TTL') else None,
+            deadlines=parse_deadlines(os.getenv('TASK_DEADLINES', '')))
+        removal_log = journal.Journal(
+            os.environ['JOURNAL_DIR'],
+            lambda prefix, key: coalescer.deadline(key), name='scrub')
+
+    concurrency = int(os.getenv('SCRUB_CONCURRENCY', CONCURRENCY))
+    queue = QueueStatus(base_url=os.getenv('QUEUE_BASE_URL', QUEUE_BASE_URL),
+                        concurrency=concurrency,
+                        rate_limit=float(os.getenv('SCRUB_RATE_LIMIT',
+                                                   RATE_LIMIT)))
 
     try:
         start = time.time()
         logging.info("Starting scrub task")
 
-        tasks_removed, lists_removed = main(rds)
+        time_budget = float(os.getenv('SCRUB_TIME_BUDGET', 0)) or None
+        tasks_removed = lists_removed = 0
+        for rds in nodes:
+            remaining = None
+            if time_budget:
+                remaining = max(time_budget - (time.time() - start), 1)
+            removed = main(rds, queue, concurrency=concurrency,
+                           time_budget=remaining, removal_log=removal_log)
+            tasks_removed += removed[0]
+            lists_removed += removed[1]
+            finished = removed[2]
+            if not finished:
+                break
         elapsed = time.time() - start
-        logging.info("Completed scrub task in %s" %
-                     (str(timedelta(seconds=elapsed))))
+        logging.info("%s scrub task in %s" %
+                     ("Completed" if finished else "Paused",
+                      str(timedelta(seconds=elapsed))))
         logging.info("Removed %s lists and %s tasks" %
-                     (tasks_removed, lists_removed))
+                     (lists_removed, tasks_removed))
     except Exception:
         logging.exception("Fatal error in main loop")
+    finally:
+        if removal_log is not None:
+            removal_log.close()
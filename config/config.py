@@ -3,7 +3,27 @@ class Config(object):
     DEBUG = False
     TESTING = False
     REDIS_URL = "redis://localhost:6379"
+    # Optional replica serving the read only endpoints
+    REDIS_REPLICA_URL = None
+    # Optional comma separated nodes the lists are sharded over, REDIS_URL
+    # then only holds the stats and metrics and the replica goes unused
+    REDIS_SHARD_URLS = None
     PREFIX = "coalesce.v1."
+    # Redis connections per web worker process, requests beyond this wait
+    # up to REDIS_POOL_TIMEOUT seconds for a free one
+    REDIS_MAX_CONNECTIONS = 50
+    REDIS_POOL_TIMEOUT = 5
+    # Seconds a list lookup may be served from the in-process cache,
+    # 0 disables the cache
+    CACHE_TTL = 1
+    CACHE_SIZE = 1024
+    # Default and largest page of keys returned by /v1/list
+    LIST_PAGE_SIZE = 100
+    LIST_PAGE_MAX = 1000
+    # Most queries accepted by one POST /v1/supersedes request
+    BULK_MAX_QUERIES = 1000
+    # Most taskIds returned for one list, whatever ?limit= asks for
+    SUPERSEDES_MAX = 1000
 
 
 class Production(Config):
@@ -16,3 +36,4 @@ class Development(Config):
 
 class Testing(Config):
     TESTING = True
+    CACHE_TTL = 0
@@ -11,3 +11,6 @@ if os.getenv('DEBUG'):
     loglevel = 'debug'
 else:
     loglevel = 'info'
+
+# Concurrent requests per gevent worker, see WEB_WORKER_CLASS in Procfile
+worker_connections = int(os.getenv('WEB_WORKER_CONNECTIONS', 1000))
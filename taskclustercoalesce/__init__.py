@@ -1 +1,2 @@
-__all__ = ['web', 'stats', 'listener', 'coalescer']
+__all__ = ['web', 'stats', 'listener', 'coalescer', 'cache', 'reaper',
+           'metrics', 'redisconn', 'datastore']
@@ -0,0 +1,69 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class ListCache(object):
+    """
+    Bounded LRU cache of per coalesce key list state, each entry living at
+    most ttl seconds.  The cache only serves entries while enabled, ie. while
+    an invalidation subscriber is connected to receive the listener's change
+    notifications.
+
+    A reader calls begin(key) before reading Redis and hands the returned
+    token to put(); if the key was invalidated in the meantime the token is
+    stale and the value is not cached, so a slow read can never re-insert
+    data that predates a change.
+    """
+
+    def __init__(self, size, ttl, clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self.enabled = False
+        self.entries = OrderedDict()
+        self.tokens = {}
+        self.lock = threading.Lock()
+
+    def enable(self):
+        with self.lock:
+            self.enabled = True
+
+    def disable(self):
+        """ Stop serving and drop everything, changes may have been missed """
+        with self.lock:
+            self.enabled = False
+            self.entries.clear()
+            self.tokens.clear()
+
+    def get(self, key):
+        with self.lock:
+            if not self.enabled or key not in self.entries:
+                return None
+            expires, value = self.entries.pop(key)
+            if expires <= self.clock():
+                return None
+            # Re-insert as most recently used
+            self.entries[key] = (expires, value)
+            return value
+
+    def begin(self, key):
+        with self.lock:
+            if len(self.tokens) >= self.size:
+                self.tokens.clear()
+            token = self.tokens[key] = object()
+            return token
+
+    def put(self, key, value, token):
+        with self.lock:
+            if not self.enabled or self.tokens.get(key) is not token:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (self.clock() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.tokens.pop(key, None)
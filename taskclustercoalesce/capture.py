@@ -0,0 +1,53 @@
+import gzip
+import json
+import time
+
+
+class MessageLog(object):
+    """
+    Append-only log of Pulse messages, one compact JSON line of
+    {"t": <receive time>, "body": ..., "headers": ...} per message, gzip
+    compressed.  Each open appends a new gzip member, which readers see as
+    one continuous stream, and the compressor is flushed at most every
+    flush_interval seconds so little is lost if the process dies
+    """
+
+    flush_interval = 1
+
+    def __init__(self, path, flush_interval=None):
+        self.path = path
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        self.file = gzip.open(path, 'ab')
+        self.last_flush = time.time()
+
+    def write(self, body, headers):
+        now = time.time()
+        self.file.write(json.dumps({'t': now, 'body': body,
+                                    'headers': headers},
+                                   separators=(',', ':'), default=str))
+        self.file.write('\n')
+        if now - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_log(path):
+    """ Yield (receive time, body, headers) for each message in a log """
+    with gzip.open(path, 'rb') as f:
+        while True:
+            try:
+                line = f.readline()
+                record = json.loads(line) if line else None
+            except (IOError, EOFError, ValueError):
+                # Truncated by a process that died while writing
+                return
+            if record is None:
+                return
+            yield record['t'], record['body'], record['headers']
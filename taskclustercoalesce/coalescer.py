@@ -1,4 +1,5 @@
 import time
+from collections import OrderedDict
 
 
 class CoalescingMachine(object):
@@ -8,26 +9,451 @@ class CoalescingMachine(object):
     These 'defined commonalities' will be the index key used to quickly
     retrieve lists via the wsgi REST api multiple objects may be defined
     accommodate multiple 'defined commonalities'
+
+    Each list is stored as the sorted set <prefix>tasks.<coalesce_key> whose
+    members are taskIds scored by their insertion timestamp, so the oldest
+    task is the first member and insert/remove are O(log N)
+
+    Tasks older than ttl seconds can no longer be pending, so each insert
+    trims them from the set and pushes the set's expiry out to ttl; entries
+    whose completion message was missed are dropped rather than leaked
+
+    Every change to a list publishes its coalesce key on the
+    <prefix>invalidate channel for the web API's read cache and increments
+    <prefix>version, which the web API serves as the ETag of /v1/list with
+    details.  <prefix>list_keys_version is only incremented once a coalesce
+    key is actually added to or dropped from list_keys, and is the ETag of
+    /v1/list without details
+
+    Removed taskIds are recorded in the <prefix>tombstones sorted set for
+    tombstone_ttl seconds (and at most tombstone_max of them) and every
+    insert checks it within its transaction, so a pending event handled
+    after the task's completion (eg. by another listener process) does not
+    leave a ghost entry behind.  Such inserts are counted as 'premature',
+    removals of tasks missing from their list as 'unknown_tasks'
+
+    Tasks whose coalesce key starts with one of the deadlines prefixes are
+    considered stale after that many seconds instead of ttl.  The
+    <prefix>age_index sorted set scores each coalesce key by the time its
+    oldest task goes stale, so reap_expired() only visits lists that hold
+    stale tasks
+
+    With a journal, each insert and removal is also appended to it once
+    written, and restore_lists() loads the lists rebuilt from it
     """
 
     prefix = "default."
 
-    def __init__(self, prefix, datastore, stats):
+    # Taskcluster task deadlines are at most 5 days out
+    ttl = 5 * 24 * 60 * 60
+
+    tombstone_ttl = 60 * 60
+    tombstone_max = 100000
+
+    # Lists due in the age index visited per reap_expired() call
+    reap_batch = 100
+
+    # Lists written per pipeline by restore_lists()
+    restore_batch = 1000
+
+    def __init__(self, prefix, datastore, stats, ttl=None,
+                 tombstone_ttl=None, tombstone_max=None, deadlines=None,
+                 metrics=None, journal=None):
         self.prefix = prefix
         self.redis = datastore
         self.stats = stats
+        # Optional Metrics timing each redis round trip
+        self.metrics = metrics
+        # Optional Journal logging every change applied
+        self.journal = journal
+        if ttl is not None:
+            self.ttl = ttl
+        # Longest prefixes first so the most specific deadline wins
+        self.deadlines = sorted((deadlines or {}).items(),
+                                key=lambda item: -len(item[0]))
+        if tombstone_ttl is not None:
+            self.tombstone_ttl = tombstone_ttl
+        if tombstone_max is not None:
+            self.tombstone_max = tombstone_max
 
     def insert_task(self, taskId, coalesce_key):
-        self.redis.sadd(self.prefix + "list_keys", coalesce_key)
-        self.redis.lpush(self.prefix + "lists." + coalesce_key, taskId)
-        self.redis.set(self.prefix + taskId + '.timestamp', time.time())
-        self.stats.set('coalesced_lists',
-                       self.redis.scard(self.prefix + "list_keys"))
+        # Single MULTI/EXEC round trip
+        pipe = self.redis.pipeline()
+        pipe.sadd(self.prefix + "list_keys", coalesce_key)
+        now = time.time()
+        pipe.zadd(self.prefix + "tasks." + coalesce_key, taskId, now)
+        self._pipe_trim(pipe, coalesce_key, now)
+        self._pipe_changed(pipe, [coalesce_key])
+        pipe.zscore(self.prefix + "tombstones", taskId)
+        pipe.scard(self.prefix + "list_keys")
+        result = self._execute('insert', pipe.execute)
+        self._log('+', coalesce_key, [taskId], now)
+        self._notch_trimmed(result[2])
+        if result[0]:
+            self._index_new_lists([coalesce_key], now)
+        self._update_list_count(result[-1])
+        if result[-2] is not None:
+            # The task was already removed, take it back out
+            self.stats.notch('premature')
+            self._remove_task(taskId, coalesce_key)
 
     def remove_task(self, taskId, coalesce_key):
-        self.redis.lrem(self.prefix + 'lists.' + coalesce_key, taskId, 0)
-        self.redis.delete(self.prefix + taskId + '.timestamp')
-        if self.redis.llen(self.prefix + 'lists.' + coalesce_key) == 0:
-            self.redis.srem(self.prefix + "list_keys", coalesce_key)
-            self.stats.set('coalesced_lists',
-                           self.redis.scard(self.prefix + "list_keys"))
+        if not self._remove_task(taskId, coalesce_key):
+            self.stats.notch('unknown_tasks')
+
+    def apply_events(self, events):
+        """
+        Apply a batch of (action, taskId, coalesce_key) events, where action
+        is 'insert' or 'remove', in a single MULTI/EXEC round trip.  Events
+        are grouped by coalesce key; a remove following an insert of the
+        same task within the batch cancels the insert, though the task is
+        still removed in case a redelivered insert had stored it already,
+        and an insert preceded by a remove of the same task is dropped as
+        premature.
+        """
+        if not events:
+            return
+        by_key = OrderedDict()
+        for action, taskId, coalesce_key in events:
+            by_key.setdefault(coalesce_key, []).append((action, taskId))
+
+        # Resolve the order of events within each key, leaving disjoint sets
+        # of tasks to insert and to remove
+        inserts = OrderedDict()
+        removes = OrderedDict()
+        tombstones = []
+        premature = 0
+        # Removals cancelling an insert in the batch, not counted unknown
+        cancelled = 0
+        for coalesce_key, key_events in by_key.items():
+            inserted = OrderedDict()
+            removed = []
+            seen_removed = set()
+            for action, taskId in key_events:
+                if action == 'insert':
+                    if taskId in seen_removed:
+                        premature += 1
+                    else:
+                        inserted[taskId] = True
+                elif action == 'remove':
+                    seen_removed.add(taskId)
+                    tombstones.append(taskId)
+                    if taskId in inserted:
+                        del inserted[taskId]
+                        cancelled += 1
+                    removed.append(taskId)
+                else:
+                    raise ValueError("Unknown action: %s" % action)
+            if inserted:
+                inserts[coalesce_key] = list(inserted)
+            if removed:
+                removes[coalesce_key] = removed
+
+        pipe = self.redis.pipeline()
+        now = time.time()
+        for coalesce_key, taskIds in removes.items():
+            pipe.zrem(self.prefix + 'tasks.' + coalesce_key, *taskIds)
+        if tombstones:
+            self._pipe_tombstone(pipe, tombstones, now)
+        for coalesce_key, taskIds in inserts.items():
+            pairs = []
+            for taskId in taskIds:
+                pairs.extend([taskId, now])
+            pipe.zadd(self.prefix + 'tasks.' + coalesce_key, *pairs)
+            self._pipe_trim(pipe, coalesce_key, now)
+        self._pipe_changed(pipe, by_key)
+        for coalesce_key in removes:
+            pipe.zcard(self.prefix + 'tasks.' + coalesce_key)
+        inserted_tasks = [(taskId, coalesce_key)
+                          for coalesce_key, taskIds in inserts.items()
+                          for taskId in taskIds]
+        for taskId, coalesce_key in inserted_tasks:
+            pipe.zscore(self.prefix + "tombstones", taskId)
+        for coalesce_key in inserts:
+            pipe.sadd(self.prefix + "list_keys", coalesce_key)
+        pipe.scard(self.prefix + "list_keys")
+        result = self._execute('apply_events', pipe.execute)
+        for coalesce_key, taskIds in removes.items():
+            self._log('-', coalesce_key, taskIds, now)
+        for coalesce_key, taskIds in inserts.items():
+            self._log('+', coalesce_key, taskIds, now)
+        # Each insert's ZADD is followed by its trim, after the removals
+        trims = len(removes) + (4 if tombstones else 0) + 1
+        self._notch_trimmed(*result[trims:trims + 3 * len(inserts):3])
+
+        self._update_list_count(result[-1])
+        added = result[len(result) - 1 - len(inserts):-1]
+        new_keys = [coalesce_key for coalesce_key, count
+                    in zip(inserts, added) if count]
+        if new_keys:
+            self._index_new_lists(new_keys, now)
+        removed_counts = result[:len(removes)]
+        unknown = sum(len(taskIds) - count for taskIds, count
+                      in zip(removes.values(), removed_counts)) - cancelled
+        result = result[:-1 - len(inserts)]
+        tombstoned = result[len(result) - len(inserted_tasks):]
+        lengths = result[len(result) - len(inserted_tasks) - len(removes):
+                         len(result) - len(inserted_tasks)]
+        for (taskId, coalesce_key), score in zip(inserted_tasks, tombstoned):
+            if score is not None:
+                # The task was already removed, take it back out
+                premature += 1
+                self._remove_task(taskId, coalesce_key)
+        for coalesce_key, length in zip(removes, lengths):
+            if length == 0:
+                self._remove_list_key(coalesce_key)
+        if premature:
+            self.stats.notch('premature', premature)
+        if unknown > 0:
+            self.stats.notch('unknown_tasks', unknown)
+
+    def migrate_lists(self):
+        """
+        Convert coalesce lists from the original layout, a lists.<key> list
+        plus one <taskId>.timestamp key per task, into tasks.<key> sorted
+        sets.  Safe to run repeatedly; returns the number of tasks migrated
+        """
+        migrated = 0
+        for coalesce_key in self.redis.sscan_iter(self.prefix + "list_keys"):
+            list_key = self.prefix + 'lists.' + coalesce_key
+            taskIds = self.redis.lrange(list_key, 0, -1)
+            if not taskIds:
+                continue
+            timestamp_keys = [self.prefix + taskId + '.timestamp'
+                              for taskId in taskIds]
+            timestamps = self.redis.mget(timestamp_keys)
+            now = time.time()
+            pairs = []
+            for taskId, timestamp in zip(taskIds, timestamps):
+                pairs.extend([taskId,
+                              float(timestamp) if timestamp else now])
+            pipe = self.redis.pipeline()
+            pipe.zadd(self.prefix + 'tasks.' + coalesce_key, *pairs)
+            self._pipe_trim(pipe, coalesce_key, now)
+            pipe.delete(list_key, *timestamp_keys)
+            self._pipe_changed(pipe, [coalesce_key])
+            result = self._execute('migrate', pipe.execute)
+            self._notch_trimmed(result[1])
+            migrated += len(taskIds)
+        return migrated
+
+    def reap_expired(self):
+        """
+        Evict stale tasks from up to reap_batch lists due in the age index
+        and reschedule those lists by their new oldest task.  Returns the
+        number of tasks evicted and of lists visited, which may be due
+        without any stale task once their oldest has completed
+        """
+        index_key = self.prefix + "age_index"
+        now = time.time()
+        due = self.redis.zrangebyscore(index_key, '-inf', now,
+                                       start=0, num=self.reap_batch)
+        if not due:
+            return 0, 0
+        pipe = self.redis.pipeline()
+        for coalesce_key in due:
+            tasks_key = self.prefix + 'tasks.' + coalesce_key
+            pipe.zremrangebyscore(tasks_key, '-inf',
+                                  now - self.deadline(coalesce_key))
+            pipe.zrange(tasks_key, 0, 0, withscores=True)
+        self._pipe_changed(pipe, due)
+        result = self._execute('reap', pipe.execute)
+
+        evicted = 0
+        emptied = []
+        pipe = self.redis.pipeline()
+        for i, coalesce_key in enumerate(due):
+            evicted += result[2 * i]
+            oldest = result[2 * i + 1]
+            if oldest:
+                pipe.zadd(index_key, coalesce_key,
+                          oldest[0][1] + self.deadline(coalesce_key))
+            else:
+                emptied.append(coalesce_key)
+        self._execute('reap', pipe.execute)
+        for coalesce_key in emptied:
+            self._remove_list_key(coalesce_key)
+        if evicted:
+            self.stats.notch('reaped', evicted)
+        return evicted, len(due)
+
+    def build_age_index(self):
+        """
+        Add any coalesce key missing from the age index, eg. lists written
+        before the index existed.  Returns the number of keys added
+        """
+        index_key = self.prefix + "age_index"
+        added = 0
+        for coalesce_key in self.redis.sscan_iter(self.prefix + "list_keys"):
+            if self.redis.zscore(index_key, coalesce_key) is not None:
+                continue
+            oldest = self.redis.zrange(self.prefix + 'tasks.' + coalesce_key,
+                                       0, 0, withscores=True)
+            # Empty lists are due immediately so the reaper drops them
+            score = oldest[0][1] if oldest else 0
+            self.redis.zadd(index_key, coalesce_key,
+                            score + self.deadline(coalesce_key))
+            added += 1
+        return added
+
+    def restore_lists(self, lists):
+        """
+        Bulk load {coalesce_key: {taskId: timestamp}}, eg. rebuilt from the
+        journal after redis lost its data, streaming restore_batch lists
+        per pipeline.  Returns the number of tasks restored
+        """
+        restored = 0
+        items = [(coalesce_key, tasks) for coalesce_key, tasks
+                 in lists.items() if tasks]
+        for start in range(0, len(items), self.restore_batch):
+            chunk = items[start:start + self.restore_batch]
+            pipe = self.redis.pipeline(transaction=False)
+            index = []
+            for coalesce_key, tasks in chunk:
+                tasks_key = self.prefix + 'tasks.' + coalesce_key
+                deadline = self.deadline(coalesce_key)
+                pairs = []
+                for taskId, timestamp in tasks.items():
+                    pairs.extend([taskId, timestamp])
+                pipe.zadd(tasks_key, *pairs)
+                pipe.expire(tasks_key, 2 * deadline)
+                pipe.sadd(self.prefix + "list_keys", coalesce_key)
+                index.extend([coalesce_key, min(tasks.values()) + deadline])
+                restored += len(tasks)
+            pipe.zadd(self.prefix + "age_index", *index)
+            self._pipe_changed(pipe, [coalesce_key for coalesce_key, _
+                                      in chunk])
+            result = self._execute('restore', pipe.execute)
+            if any(result[2:3 * len(chunk):3]):
+                self.redis.incr(self.prefix + "list_keys_version")
+        self._update_list_count(self.redis.scard(self.prefix + "list_keys"))
+        return restored
+
+    def deadline(self, coalesce_key):
+        """ Seconds after which a task in the coalesce_key list is stale """
+        for key_prefix, seconds in self.deadlines:
+            if coalesce_key.startswith(key_prefix):
+                return seconds
+        return self.ttl
+
+    def _index_new_lists(self, coalesce_keys, now):
+        """ Schedule lists just added to list_keys in the age index """
+        pairs = []
+        for coalesce_key in coalesce_keys:
+            pairs.extend([coalesce_key, now + self.deadline(coalesce_key)])
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.prefix + "age_index", *pairs)
+        pipe.incr(self.prefix + "list_keys_version")
+        self._execute('index', pipe.execute)
+
+    def _execute(self, op, call, *args):
+        """ Make a redis call, timed as op when metrics are recorded """
+        if self.metrics is None:
+            return call(*args)
+        with self.metrics.time('coalescer_redis_seconds', op=op):
+            return call(*args)
+
+    def _log(self, op, coalesce_key, taskIds, now):
+        if self.journal is not None:
+            self.journal.append(op, self.prefix, coalesce_key, taskIds, now)
+
+    def _pipe_trim(self, pipe, coalesce_key, now):
+        """
+        Queue expiry of stale tasks and of the set itself.  The set outlives
+        the deadline so the reaper, not redis, evicts its tasks; callers
+        pass the number of tasks trimmed to _notch_trimmed()
+        """
+        tasks_key = self.prefix + 'tasks.' + coalesce_key
+        deadline = self.deadline(coalesce_key)
+        pipe.zremrangebyscore(tasks_key, '-inf', now - deadline)
+        pipe.expire(tasks_key, 2 * deadline)
+
+    def _notch_trimmed(self, *counts):
+        """ Count the stale tasks trimmed by inserts as reaped """
+        if sum(counts):
+            self.stats.notch('reaped', sum(counts))
+
+    def _remove_task(self, taskId, coalesce_key):
+        """ Remove taskId, returning False if it was not in the list """
+        tasks_key = self.prefix + 'tasks.' + coalesce_key
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zrem(tasks_key, taskId)
+        self._pipe_tombstone(pipe, [taskId], now)
+        self._pipe_changed(pipe, [coalesce_key])
+        pipe.zcard(tasks_key)
+        result = self._execute('remove', pipe.execute)
+        self._log('-', coalesce_key, [taskId], now)
+        if result[-1] == 0:
+            self._remove_list_key(coalesce_key)
+        return bool(result[0])
+
+    def _pipe_changed(self, pipe, coalesce_keys):
+        """ Queue the change notifications for coalesce_keys """
+        for coalesce_key in coalesce_keys:
+            pipe.publish(self.prefix + "invalidate", coalesce_key)
+        pipe.incr(self.prefix + "version")
+
+    def _pipe_tombstone(self, pipe, taskIds, now):
+        """
+        Queue recording taskIds as removed, dropping tombstones older than
+        tombstone_ttl and the oldest beyond tombstone_max
+        """
+        tombstones_key = self.prefix + "tombstones"
+        pairs = []
+        for taskId in taskIds:
+            pairs.extend([taskId, now])
+        pipe.zadd(tombstones_key, *pairs)
+        pipe.zremrangebyscore(tombstones_key, '-inf', now - self.tombstone_ttl)
+        pipe.zremrangebyrank(tombstones_key, 0, -self.tombstone_max - 1)
+        pipe.expire(tombstones_key, self.tombstone_ttl)
+
+    def _remove_list_key(self, coalesce_key):
+        """
+        Drop an emptied list from list_keys.  The sorted set is WATCHed so
+        an insert racing in between leaves the key registered.
+        """
+        tasks_key = self.prefix + 'tasks.' + coalesce_key
+
+        def drop_if_empty(pipe):
+            if pipe.zcard(tasks_key) == 0:
+                listed = pipe.sismember(self.prefix + "list_keys",
+                                        coalesce_key)
+                pipe.multi()
+                pipe_drop_list(pipe, self.prefix, coalesce_key, listed)
+                pipe.scard(self.prefix + "list_keys")
+
+        result = self._execute('remove_list_key', self.redis.transaction,
+                               drop_if_empty, tasks_key)
+        if result:
+            self._update_list_count(result[-1])
+
+    def _update_list_count(self, count):
+        # Only write through to the stats hash when the count changes
+        if self.stats.get('coalesced_lists') != count:
+            self.stats.set('coalesced_lists', count)
+
+
+def pipe_drop_list(pipe, prefix, coalesce_key, listed=True):
+    """
+    Queue dropping an emptied list from list_keys and the age index.  The
+    list_keys version only changes if the key was listed, as read while
+    WATCHing the list's sorted set, which any insert also writes
+    """
+    pipe.srem(prefix + "list_keys", coalesce_key)
+    pipe.zrem(prefix + "age_index", coalesce_key)
+    pipe.incr(prefix + "version")
+    if listed:
+        pipe.incr(prefix + "list_keys_version")
+
+
+def parse_deadlines(value):
+    """
+    Parse 'key_prefix=seconds,...' as given in TASK_DEADLINES into a dict
+    """
+    deadlines = {}
+    for item in value.split(','):
+        if item.strip():
+            key_prefix, seconds = item.rsplit('=', 1)
+            deadlines[key_prefix.strip()] = int(seconds)
+    return deadlines
@@ -0,0 +1,514 @@
+"""
+Datastores the coalescer, stats, metrics and web API run against.
+
+The interface is the subset of the redis.Redis client listed in COMMANDS,
+plus pipeline() and transaction() with MULTI/EXEC semantics.  Redis is the
+default backend; MemoryDatastore implements the same commands in-process
+for a single node running the listener and web API together, where each
+operation would otherwise pay a network hop.
+"""
+
+import re
+import time
+import zlib
+import threading
+from bisect import bisect_left, bisect_right, insort
+
+import redisconn
+
+# Commands every datastore provides, with redis-py's signatures and replies
+COMMANDS = (
+    # keys and strings
+    'get', 'set', 'incr', 'mget', 'delete', 'exists', 'expire', 'ttl',
+    'keys',
+    # sets
+    'sadd', 'srem', 'scard', 'sismember', 'smembers', 'sscan', 'sscan_iter',
+    # sorted sets
+    'zadd', 'zrem', 'zscore', 'zcard', 'zrange', 'zrevrange',
+    'zrangebyscore', 'zremrangebyscore', 'zremrangebyrank',
+    # hashes
+    'hget', 'hgetall', 'hset', 'hsetnx', 'hmset', 'hincrby', 'hincrbyfloat',
+    # lists, only read by CoalescingMachine.migrate_lists()
+    'lrange',
+    'publish',
+)
+
+BACKENDS = ('redis', 'memory')
+
+
+def connect(backend, redis_url=None, **kwargs):
+    """ Return a datastore for backend, one of BACKENDS """
+    if backend == 'memory':
+        return MemoryDatastore()
+    if backend == 'redis':
+        return redisconn.connect(redis_url, **kwargs)
+    raise ValueError("Unknown datastore: %s" % backend)
+
+
+class SortedSet(object):
+    """ Members scored by float, kept in (score, member) order """
+
+    __slots__ = ('scores', 'order')
+
+    def __init__(self):
+        self.scores = {}
+        self.order = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, member, score):
+        """ Set member's score, returning True if it is a new member """
+        old = self.scores.get(member)
+        if old == score:
+            return False
+        if old is not None:
+            self.discard(member)
+        self.scores[member] = score
+        # Scores mostly grow with time, appending is the common case
+        if not self.order or self.order[-1] < (score, member):
+            self.order.append((score, member))
+        else:
+            insort(self.order, (score, member))
+        return old is None
+
+    def discard(self, member):
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        del self.order[bisect_left(self.order, (score, member))]
+        return True
+
+    def rank_range(self, start, end):
+        """ Entries from rank start to end inclusive, negative from the end """
+        length = len(self.order)
+        if start < 0:
+            start = max(length + start, 0)
+        if end < 0:
+            end += length
+        return self.order[start:end + 1]
+
+    def score_range(self, low, high):
+        """ Entries scored between low and high inclusive """
+        return self.order[bisect_left(self.order, (low,)):
+                          bisect_right(self.order, (high, MAX_MEMBER))]
+
+
+class _MaxMember(object):
+    """ Sorts after every member, bounding score_range() """
+
+    def __gt__(self, other):
+        return True
+
+    def __lt__(self, other):
+        return False
+
+    def __cmp__(self, other):
+        return 1
+
+
+MAX_MEMBER = _MaxMember()
+
+
+class MemoryDatastore(object):
+    """
+    In-process datastore holding each key as a SortedSet, set, dict (hash)
+    or string.  Commands are serialised by one lock so the web API's
+    threads and the listener can share an instance, and a pipeline is
+    applied under that lock, as atomic as MULTI/EXEC.  Expiry is checked
+    lazily when a key is read.  Nothing is published, there are no other
+    processes to notify
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.data = {}
+        self.expires = {}
+        self.lock = threading.RLock()
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def transaction(self, func, *watches, **kwargs):
+        """
+        Call func(pipe) and execute the pipe.  Holding the lock throughout
+        means no watched key can change, so there is never a retry
+        """
+        with self.lock:
+            pipe = self.pipeline()
+            pipe.immediate = True
+            func(pipe)
+            return pipe.execute()
+
+    # keys and strings
+
+    def get(self, name):
+        with self.lock:
+            return self._get(name, basestring)
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        with self.lock:
+            exists = self._get(name) is not None
+            if (nx and exists) or (xx and not exists):
+                return None
+            self.data[name] = _string(value)
+            self.expires.pop(name, None)
+            if ex is not None:
+                self.expire(name, ex)
+            elif px is not None:
+                self.expire(name, px / 1000.0)
+            return True
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            value = int(self._get(name, basestring) or 0) + amount
+            self.data[name] = str(value)
+            return value
+
+    def mget(self, keys, *args):
+        keys = list(keys) if isinstance(keys, (list, tuple)) else [keys]
+        with self.lock:
+            return [self._get(key, basestring) for key in keys + list(args)]
+
+    def delete(self, *names):
+        with self.lock:
+            deleted = 0
+            for name in names:
+                if self._get(name) is not None:
+                    deleted += 1
+                self._drop(name)
+            return deleted
+
+    def exists(self, name):
+        with self.lock:
+            return self._get(name) is not None
+
+    def expire(self, name, time):
+        with self.lock:
+            if self._get(name) is None:
+                return False
+            self.expires[name] = self.clock() + time
+            return True
+
+    def ttl(self, name):
+        """ Seconds until name expires, None without an expiry """
+        with self.lock:
+            if self._get(name) is None or name not in self.expires:
+                return None
+            return int(round(self.expires[name] - self.clock()))
+
+    def keys(self, pattern='*'):
+        regex = glob_regex(pattern)
+        with self.lock:
+            return [name for name in list(self.data)
+                    if self._get(name) is not None and regex.match(name)]
+
+    # sets
+
+    def sadd(self, name, *values):
+        with self.lock:
+            members = self._get(name, set, create=True)
+            before = len(members)
+            members.update(values)
+            return len(members) - before
+
+    def srem(self, name, *values):
+        with self.lock:
+            members = self._get(name, set)
+            if members is None:
+                return 0
+            removed = len(members.intersection(values))
+            members.difference_update(values)
+            self._drop_if_empty(name, members)
+            return removed
+
+    def scard(self, name):
+        with self.lock:
+            return len(self._get(name, set) or ())
+
+    def sismember(self, name, value):
+        with self.lock:
+            return value in (self._get(name, set) or ())
+
+    def smembers(self, name):
+        with self.lock:
+            return set(self._get(name, set) or ())
+
+    def sscan(self, name, cursor=0, match=None, count=None):
+        """
+        Members are visited in crc32 order and the cursor is the hash to
+        resume from plus one, so every member present for the whole scan is
+        returned, as with SSCAN
+        """
+        count = count or 10
+        pattern = glob_regex(match) if match else None
+        with self.lock:
+            members = sorted((_hash(member), member)
+                             for member in self._get(name, set) or ())
+        position = bisect_left(members, (int(cursor) - 1,)) if cursor else 0
+        page = []
+        while position < len(members) and len(page) < count:
+            # Finish a run of equal hashes so the cursor can resume after it
+            run_hash = members[position][0]
+            while position < len(members) and \
+                    members[position][0] == run_hash:
+                page.append(members[position][1])
+                position += 1
+        next_cursor = members[position][0] + 1 \
+            if position < len(members) else 0
+        if pattern:
+            page = [member for member in page if pattern.match(member)]
+        return next_cursor, page
+
+    def sscan_iter(self, name, match=None, count=None):
+        cursor = None
+        while cursor != 0:
+            cursor, members = self.sscan(name, cursor or 0, match, count)
+            for member in members:
+                yield member
+
+    # sorted sets
+
+    def zadd(self, name, *args, **kwargs):
+        """ zadd(name, member1, score1, member2, score2, ...) """
+        pairs = zip(args[::2], args[1::2]) + kwargs.items()
+        with self.lock:
+            zset = self._get(name, SortedSet, create=True)
+            return sum(zset.add(member, float(score))
+                       for member, score in pairs)
+
+    def zrem(self, name, *values):
+        with self.lock:
+            zset = self._get(name, SortedSet)
+            if zset is None:
+                return 0
+            removed = sum(zset.discard(value) for value in values)
+            self._drop_if_empty(name, zset)
+            return removed
+
+    def zscore(self, name, value):
+        with self.lock:
+            return (self._get(name, SortedSet) or SortedSet()).scores.get(
+                value)
+
+    def zcard(self, name):
+        with self.lock:
+            return len(self._get(name, SortedSet) or ())
+
+    def zrange(self, name, start, end, desc=False, withscores=False,
+               score_cast_func=float):
+        with self.lock:
+            zset = self._get(name, SortedSet) or SortedSet()
+            if desc:
+                entries = list(reversed(zset.order))
+                length = len(entries)
+                start = max(length + start, 0) if start < 0 else start
+                end = end + length if end < 0 else end
+                entries = entries[start:end + 1]
+            else:
+                entries = zset.rank_range(start, end)
+        return _reply(entries, withscores, score_cast_func)
+
+    def zrevrange(self, name, start, end, withscores=False,
+                  score_cast_func=float):
+        return self.zrange(name, start, end, desc=True,
+                           withscores=withscores,
+                           score_cast_func=score_cast_func)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False, score_cast_func=float):
+        with self.lock:
+            zset = self._get(name, SortedSet) or SortedSet()
+            entries = zset.score_range(float(min), float(max))
+        if start is not None and num is not None:
+            entries = entries[start:start + num]
+        return _reply(entries, withscores, score_cast_func)
+
+    def zremrangebyscore(self, name, min, max):
+        with self.lock:
+            zset = self._get(name, SortedSet)
+            if zset is None:
+                return 0
+            entries = zset.score_range(float(min), float(max))
+            return self._zremove(name, zset, entries)
+
+    def zremrangebyrank(self, name, min, max):
+        with self.lock:
+            zset = self._get(name, SortedSet)
+            if zset is None:
+                return 0
+            return self._zremove(name, zset, zset.rank_range(min, max))
+
+    # hashes
+
+    def hget(self, name, key):
+        with self.lock:
+            return (self._get(name, dict) or {}).get(key)
+
+    def hgetall(self, name):
+        with self.lock:
+            return dict(self._get(name, dict) or {})
+
+    def hset(self, name, key, value):
+        with self.lock:
+            fields = self._get(name, dict, create=True)
+            new = key not in fields
+            fields[key] = _string(value)
+            return int(new)
+
+    def hsetnx(self, name, key, value):
+        with self.lock:
+            fields = self._get(name, dict, create=True)
+            if key in fields:
+                return False
+            fields[key] = _string(value)
+            return True
+
+    def hmset(self, name, mapping):
+        with self.lock:
+            fields = self._get(name, dict, create=True)
+            for key, value in mapping.items():
+                fields[key] = _string(value)
+            return True
+
+    def hincrby(self, name, key, amount=1):
+        with self.lock:
+            fields = self._get(name, dict, create=True)
+            value = int(fields.get(key, 0)) + amount
+            fields[key] = str(value)
+            return value
+
+    def hincrbyfloat(self, name, key, amount=1.0):
+        with self.lock:
+            fields = self._get(name, dict, create=True)
+            value = float(fields.get(key, 0)) + amount
+            fields[key] = _string(value)
+            return value
+
+    def lrange(self, name, start, end):
+        with self.lock:
+            return list(self._get(name, list) or [])[start:end + 1 or None]
+
+    def publish(self, channel, message):
+        return 0
+
+    # internal
+
+    def _get(self, name, kind=None, create=False):
+        """ The live value of name, checked to be a kind, or None """
+        if name in self.expires and self.expires[name] <= self.clock():
+            self._drop(name)
+        value = self.data.get(name)
+        if value is None:
+            if create:
+                value = self.data[name] = kind()
+            return value
+        if kind is not None and not isinstance(value, kind):
+            raise TypeError("WRONGTYPE Operation against a key holding the "
+                            "wrong kind of value: %s" % name)
+        return value
+
+    def _drop(self, name):
+        self.data.pop(name, None)
+        self.expires.pop(name, None)
+
+    def _drop_if_empty(self, name, value):
+        # Like redis, a collection's key goes away with its last member
+        if not value:
+            self._drop(name)
+
+    def _zremove(self, name, zset, entries):
+        for _, member in list(entries):
+            zset.discard(member)
+        self._drop_if_empty(name, zset)
+        return len(entries)
+
+
+class MemoryPipeline(object):
+    """
+    Queues commands for MemoryDatastore and applies them in one go under
+    its lock.  In immediate mode, as within transaction() before multi(),
+    commands run as they are called
+    """
+
+    def __init__(self, datastore):
+        self.datastore = datastore
+        self.commands = []
+        self.immediate = False
+
+    def __getattr__(self, name):
+        if name not in COMMANDS:
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            if self.immediate:
+                return getattr(self.datastore, name)(*args, **kwargs)
+            self.commands.append((name, args, kwargs))
+            return self
+        return command
+
+    def watch(self, *names):
+        self.immediate = True
+
+    def multi(self):
+        self.immediate = False
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        with self.datastore.lock:
+            return [getattr(self.datastore, name)(*args, **kwargs)
+                    for name, args, kwargs in commands]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.commands = []
+
+
+def glob_regex(pattern):
+    """ Compile a redis MATCH glob, where backslash escapes a character """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        elif char == '*':
+            regex.append('.*')
+        elif char == '?':
+            regex.append('.')
+        elif char == '[' and ']' in pattern[i + 1:]:
+            end = pattern.index(']', i + 1)
+            members = pattern[i + 1:end]
+            negate = members.startswith('^')
+            regex.append('[' + ('^' if negate else '') +
+                         re.escape(members[negate:]).replace('\\-', '-') +
+                         ']')
+            i = end
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return re.compile(''.join(regex) + r'\Z', re.DOTALL)
+
+
+def _hash(member):
+    if isinstance(member, unicode):
+        member = member.encode('utf-8')
+    return zlib.crc32(member) & 0xffffffff
+
+
+def _string(value):
+    # Values are stored as redis replies them, integral floats without '.0'
+    if isinstance(value, float):
+        return '%d' % value if value.is_integer() else repr(value)
+    if isinstance(value, basestring):
+        return value
+    return str(value)
+
+
+def _reply(entries, withscores, score_cast_func):
+    if withscores:
+        return [(member, score_cast_func(score)) for score, member in entries]
+    return [member for _, member in entries]
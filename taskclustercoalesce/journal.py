@@ -0,0 +1,241 @@
+import os
+import re
+import gzip
+import json
+import time
+import threading
+
+# <name>.<seq>.log segments and the <name>.snapshot.gz they compact into
+SEGMENT_RE = re.compile(r'^(?P<name>.+)\.(?P<seq>\d{8})\.log$')
+SNAPSHOT_SUFFIX = '.snapshot.gz'
+
+
+class Journal(object):
+    """
+    Write-ahead log of the changes CoalescingMachine applies, so the lists
+    can be rebuilt if redis loses them.  Changes are appended to
+    <name>.<seq>.log segments in directory as tab separated lines of time,
+    op, prefix, coalesce_key and taskId, op being '+' for an insert and '-'
+    for a removal; routing keys and slugids never hold tabs or newlines.
+
+    A segment is closed after segment_records changes, and once
+    compact_segments are closed a background thread folds them into
+    <name>.snapshot.gz, dropping tasks past deadline(prefix, coalesce_key)
+    seconds, before deleting them.  Several processes may share directory
+    under different names, see load()
+    """
+
+    segment_records = 100000
+    compact_segments = 8
+
+    # Seconds between flushes of the open segment to the OS
+    flush_interval = 1
+
+    def __init__(self, directory, deadline, name='journal',
+                 segment_records=None, compact_segments=None,
+                 flush_interval=None):
+        self.directory = directory
+        self.deadline = deadline
+        self.name = name
+        if segment_records is not None:
+            self.segment_records = segment_records
+        if compact_segments is not None:
+            self.compact_segments = compact_segments
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.compactor = None
+        self.file = None
+        # Never append to a segment left by a previous process, its last
+        # line may be truncated
+        existing = segments(directory, name)
+        self.seq = existing[-1][0] if existing else 0
+        self.rotate()
+
+    def append(self, op, prefix, coalesce_key, taskIds, timestamp):
+        """ Log op ('+' or '-') of taskIds applied at timestamp """
+        fields = u'%r\t%s\t%s\t%s\t' % (timestamp, op, prefix, coalesce_key)
+        for taskId in taskIds:
+            self.file.write((fields + taskId + u'\n').encode('utf-8'))
+        self.records += len(taskIds)
+        if self.records >= self.segment_records:
+            self.rotate()
+        elif timestamp - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        self.file.flush()
+
+    def rotate(self):
+        """ Close the open segment and start the next """
+        if self.file:
+            self.close()
+        self.seq += 1
+        self.file = open(self.segment_path(self.seq), 'a')
+        self.records = 0
+        self.last_flush = time.time()
+        closed = [seq for seq, _ in segments(self.directory, self.name)
+                  if seq < self.seq]
+        if len(closed) >= self.compact_segments and not self.compacting():
+            self.compactor = threading.Thread(target=self.compact,
+                                              name='journal-compactor')
+            self.compactor.daemon = True
+            self.compactor.start()
+
+    def compacting(self):
+        return self.compactor is not None and self.compactor.is_alive()
+
+    def compact(self, now=None):
+        """
+        Fold the snapshot and every closed segment into a new snapshot and
+        delete those segments.  Returns the number of segments compacted
+        """
+        closed = [(seq, path) for seq, path
+                  in segments(self.directory, self.name) if seq < self.seq]
+        if not closed:
+            return 0
+        through, lists, tombstones = read_snapshot(self.snapshot_path())
+        for seq, path in closed:
+            if seq > through:
+                fold(lists, tombstones, read_segment(path))
+        trim(lists, tombstones, self.deadline, now or time.time())
+        write_snapshot(self.snapshot_path(), closed[-1][0], lists,
+                       tombstones)
+        for _, path in closed:
+            os.remove(path)
+        return len(closed)
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+    def segment_path(self, seq):
+        return os.path.join(self.directory, '%s.%08d.log' % (self.name, seq))
+
+    def snapshot_path(self):
+        return os.path.join(self.directory, self.name + SNAPSHOT_SUFFIX)
+
+
+def segments(directory, name=None):
+    """ [(seq, path)] of the segments of journal name, oldest first """
+    found = []
+    for filename in os.listdir(directory):
+        match = SEGMENT_RE.match(filename)
+        if match and (name is None or match.group('name') == name):
+            found.append((int(match.group('seq')),
+                          os.path.join(directory, filename)))
+    return sorted(found)
+
+
+def read_segment(path):
+    """ Yield the records of a segment, stopping at a truncated line """
+    with open(path) as f:
+        for line in f:
+            fields = line[:-1].split('\t')
+            if not line.endswith('\n') or len(fields) != 5:
+                return
+            fields[0] = float(fields[0])
+            yield fields
+
+
+def fold(lists, tombstones, records):
+    """
+    Apply records to lists and tombstones, both {(prefix, coalesce_key):
+    {taskId: time}}.  A removal of a task inserted earlier in the journal
+    cancels it, one inserted elsewhere is kept as a tombstone
+    """
+    for timestamp, op, prefix, coalesce_key, taskId in records:
+        list_key = (prefix, coalesce_key)
+        if op == '+':
+            lists.setdefault(list_key, {})[taskId] = timestamp
+            if taskId in tombstones.get(list_key, ()):
+                del tombstones[list_key][taskId]
+        elif taskId in lists.get(list_key, ()):
+            del lists[list_key][taskId]
+            if not lists[list_key]:
+                del lists[list_key]
+        else:
+            tombstones.setdefault(list_key, {})[taskId] = timestamp
+
+
+def trim(lists, tombstones, deadline, now):
+    """ Drop tasks, and tombstones, older than their list's deadline """
+    for state in (lists, tombstones):
+        for list_key, tasks in state.items():
+            oldest = now - deadline(*list_key)
+            for taskId, timestamp in tasks.items():
+                if timestamp < oldest:
+                    del tasks[taskId]
+            if not tasks:
+                del state[list_key]
+
+
+def read_snapshot(path):
+    """ (last segment folded, lists, tombstones) saved by write_snapshot """
+    lists, tombstones = {}, {}
+    if not os.path.exists(path):
+        return 0, lists, tombstones
+    with gzip.open(path, 'rb') as f:
+        through = json.loads(f.readline())['through']
+        for line in f:
+            prefix, coalesce_key, tasks, removed = json.loads(line)
+            if tasks:
+                lists[(prefix, coalesce_key)] = tasks
+            if removed:
+                tombstones[(prefix, coalesce_key)] = removed
+    return through, lists, tombstones
+
+
+def write_snapshot(path, through, lists, tombstones):
+    """ Replace the snapshot at path, atomically """
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb') as f:
+        f.write(json.dumps({'through': through}) + '\n')
+        for list_key in set(lists) | set(tombstones):
+            f.write(json.dumps([list_key[0], list_key[1],
+                                lists.get(list_key, {}),
+                                tombstones.get(list_key, {})],
+                               separators=(',', ':')))
+            f.write('\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+def load(directory, deadline, now=None):
+    """
+    Rebuild {prefix: {coalesce_key: {taskId: time}}} from the snapshots and
+    segments of every journal in directory.  A task is live unless some
+    journal holds a later tombstone for it
+    """
+    names = set(filename[:-len(SNAPSHOT_SUFFIX)]
+                for filename in os.listdir(directory)
+                if filename.endswith(SNAPSHOT_SUFFIX))
+    names.update(SEGMENT_RE.match(os.path.basename(path)).group('name')
+                 for _, path in segments(directory))
+    merged, removed = {}, {}
+    for name in sorted(names):
+        through, lists, tombstones = read_snapshot(
+            os.path.join(directory, name + SNAPSHOT_SUFFIX))
+        for seq, path in segments(directory, name):
+            if seq > through:
+                fold(lists, tombstones, read_segment(path))
+        for state, into in ((lists, merged), (tombstones, removed)):
+            for list_key, tasks in state.items():
+                combined = into.setdefault(list_key, {})
+                for taskId, timestamp in tasks.items():
+                    combined[taskId] = max(timestamp,
+                                           combined.get(taskId, timestamp))
+    for list_key, tasks in removed.items():
+        live = merged.get(list_key, {})
+        for taskId, timestamp in tasks.items():
+            if live.get(taskId, timestamp) < timestamp:
+                del live[taskId]
+    trim(merged, {}, deadline, now or time.time())
+    restored = {}
+    for (prefix, coalesce_key), tasks in merged.items():
+        restored.setdefault(prefix, {})[coalesce_key] = tasks
+    return restored
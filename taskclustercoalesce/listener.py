@@ -2,12 +2,23 @@ import traceback
 import sys
 import os
 import logging
-import redis
 import signal
-from urlparse import urlparse
-
+import socket
+import time
+import calendar
+import threading
+import multiprocessing
+from collections import OrderedDict
+from datetime import datetime
+
+import reaper
+import journal
+import sharding
+import datastore
 from stats import Stats
-from coalescer import CoalescingMachine
+from metrics import Metrics
+from capture import MessageLog
+from coalescer import parse_deadlines
 
 from mozillapulse.config import PulseConfiguration
 from mozillapulse.consumers import GenericConsumer
@@ -19,6 +30,9 @@ class StateError(Exception):
 
 log = None
 
+# Seconds the supervisor waits for workers to shut down gracefully
+SHUTDOWN_TIMEOUT = 30
+
 
 class Options(object):
 
@@ -31,17 +45,116 @@ class Options(object):
         try:
             self.options['user'] = os.environ['PULSE_USER']
             self.options['passwd'] = os.environ['PULSE_PASSWD']
-            self.options['redis'] = urlparse(os.environ['REDIS_URL'])
+            # 'memory' keeps the lists in this process, which then also
+            # serves the web API, see serve_in_process()
+            self.options['datastore'] = os.getenv('DATASTORE', 'redis')
+            if self.options['datastore'] == 'redis':
+                self.options['redis_url'] = os.environ['REDIS_URL']
+                # Nodes the lists are sharded over, REDIS_URL keeps the
+                # stats and metrics; see sharding
+                self.options['shard_urls'] = sharding.shard_urls(
+                    os.getenv('REDIS_SHARD_URLS'))
         except KeyError:
             traceback.print_exc()
             sys.exit(1)
+        # Number of consumer processes sharing the Pulse queue
+        self.options['workers'] = int(os.getenv('WORKERS', 1))
+        # Batching is enabled when BATCH_SIZE > 1
+        self.options['batch_size'] = int(os.getenv('BATCH_SIZE', 1))
+        # Unacked messages per consumer, 0 is unlimited
+        if self.options['batch_size'] > 1 or self.options['workers'] > 1:
+            prefetch = 2 * self.options['batch_size']
+        else:
+            prefetch = 0
+        self.options['prefetch'] = int(os.getenv('PREFETCH', prefetch))
+        self.options['batch_timeout'] = float(os.getenv('BATCH_TIMEOUT', 1))
+        if os.getenv('STATS_FLUSH_INTERVAL'):
+            self.options['stats_flush_interval'] = float(
+                os.environ['STATS_FLUSH_INTERVAL'])
+        # Seconds after which a pending task is considered stale
+        if os.getenv('TASK_TTL'):
+            self.options['task_ttl'] = int(os.environ['TASK_TTL'])
+        # Per coalesce key prefix overrides of TASK_TTL, eg. 'try.=86400'
+        self.options['deadlines'] = parse_deadlines(
+            os.getenv('TASK_DEADLINES', ''))
+        # Seconds a removed taskId blocks a late pending event
+        if os.getenv('TOMBSTONE_TTL'):
+            self.options['tombstone_ttl'] = int(os.environ['TOMBSTONE_TTL'])
+        if os.getenv('TOMBSTONE_MAX'):
+            self.options['tombstone_max'] = int(os.environ['TOMBSTONE_MAX'])
+        # Coalescers for further route prefixes run side by side with the
+        # main one, eg. 'coalesce.v2.'
+        self.options['extra_prefixes'] = [
+            p.strip() for p in os.getenv('EXTRA_PREFIXES', '').split(',')
+            if p.strip()]
+        # Append every message received to this file for bin/replay_pulse.py
+        self.options['capture_file'] = os.getenv('CAPTURE_FILE')
+        # Journal every applied change here, restored whenever redis has
+        # lost the lists, see restore_from_journal()
+        self.options['journal_dir'] = os.getenv('JOURNAL_DIR')
+
+
+class RouteMatcher(object):
+    """
+    Finds the first CC route of a message starting with route.<prefix> for
+    any of the given prefixes
+    """
+
+    def __init__(self, prefixes):
+        # Longest first, so a prefix never shadows a longer one it starts
+        self.routes = sorted((('route.' + prefix, prefix)
+                              for prefix in prefixes),
+                             key=lambda route: -len(route[0]))
+        self.route_prefixes = tuple(route for route, _ in self.routes)
+
+    def match(self, routes):
+        """ Return (prefix, coalesce_key) for the first match or None """
+        for route in routes:
+            if route.startswith(self.route_prefixes):
+                for route_prefix, prefix in self.routes:
+                    if route.startswith(route_prefix):
+                        return prefix, route[len(route_prefix):]
+        return None
 
 
 class TcPulseConsumer(GenericConsumer):
-    def __init__(self, exchanges, **kwargs):
+    """
+    Consumer which limits unacked deliveries to prefetch_count, so messages
+    are shared fairly when several consumers bind the same queue
+    """
+
+    def __init__(self, exchanges, prefetch_count=0, **kwargs):
+        self.prefetch_count = prefetch_count
         super(TcPulseConsumer, self).__init__(
             PulseConfiguration(**kwargs), exchanges, **kwargs)
 
+    def _build_consumer(self, callback=None, on_connect_callback=None):
+        consumer = super(TcPulseConsumer, self)._build_consumer(
+            callback=callback, on_connect_callback=on_connect_callback)
+        if self.prefetch_count:
+            consumer.qos(prefetch_count=self.prefetch_count)
+        return consumer
+
+
+class BatchingPulseConsumer(TcPulseConsumer):
+    """
+    Consumer which calls on_idle whenever no message arrives within
+    idle_timeout seconds, so a partially filled batch is never held
+    indefinitely
+    """
+
+    def __init__(self, exchanges, idle_timeout, on_idle, **kwargs):
+        self.idle_timeout = idle_timeout
+        self.on_idle = on_idle
+        super(BatchingPulseConsumer, self).__init__(exchanges, **kwargs)
+
+    def _drain_events_loop(self):
+        while True:
+            try:
+                self.connection.drain_events(timeout=self.idle_timeout)
+            except socket.timeout:
+                self.on_idle()
+
 
 class TaskEventApp(object):
 
@@ -71,22 +184,94 @@ class TaskEventApp(object):
     # Coalesing machine
     coalescer = None
 
-    def __init__(self, prefix, options, stats, datastore):
+    # Coalescing machines by route prefix, including the main coalescer
+    coalescers = None
+
+    # ((prefix, event), message) pairs waiting to be flushed in batch mode
+    batch = None
+
+    # MessageLog recording received messages, if capturing
+    capture = None
+
+    # Journal of the changes applied, if journaling
+    journal = None
+
+    # Seconds between checks that redis has not lost the lists, see
+    # restore_from_journal()
+    restore_check_interval = 1
+
+    def __init__(self, prefix, options, stats, datastore, delete_queue=True,
+                 shards=None):
         self.prefix = prefix
         self.options = options
         self.stats = stats
         self.redis = datastore
-        self.coalescer = CoalescingMachine(prefix,
-                                           datastore,
-                                           stats=stats)
-        route_key = "route." + prefix + "#"
-        self.consumer_args['topic'] = [route_key] * len(self.exchanges)
+        self.shards = shards
+        self.last_restore_check = time.time()
+        # Only one of several workers sharing the queue should delete it
+        self.delete_queue = delete_queue
+        # Histograms are flushed to redis at the same interval as stats
+        self.metrics = Metrics(
+            prefix, datastore,
+            flush_interval=options.get('stats_flush_interval'))
+        prefixes = [prefix] + options.get('extra_prefixes', [])
+        if options.get('journal_dir'):
+            self.journal = journal.Journal(
+                options['journal_dir'], self._deadline,
+                name=options.get('journal_name', 'journal'))
+            log.info("Journaling changes to %s" % self.journal.segment_path(
+                self.journal.seq))
+        self.stats_by_prefix = {prefix: stats}
+        self.coalescers = {}
+        for coalescer_prefix in prefixes:
+            if coalescer_prefix not in self.stats_by_prefix:
+                self.stats_by_prefix[coalescer_prefix] = Stats(
+                    coalescer_prefix, datastore,
+                    flush_interval=options.get('stats_flush_interval'))
+            self.coalescers[coalescer_prefix] = sharding.coalescing_machine(
+                coalescer_prefix,
+                datastore,
+                stats=self.stats_by_prefix[coalescer_prefix],
+                shards=shards,
+                ttl=options.get('task_ttl'),
+                tombstone_ttl=options.get('tombstone_ttl'),
+                tombstone_max=options.get('tombstone_max'),
+                deadlines=options.get('deadlines'),
+                metrics=self.metrics,
+                journal=self.journal)
+        self.coalescer = self.coalescers[prefix]
+        self.routes = RouteMatcher(prefixes)
+        if options.get('capture_file'):
+            log.info("Capturing messages to %s" % options['capture_file'])
+            self.capture = MessageLog(options['capture_file'])
+        # Bind every exchange once per prefix
+        exchanges = [exchange for _ in prefixes
+                     for exchange in self.exchanges]
+        route_keys = ["route." + p + "#" for p in prefixes]
+        self.consumer_args['topic'] = [route_key for route_key in route_keys
+                                       for _ in self.exchanges]
         self.consumer_args['user'] = self.options['user']
         self.consumer_args['password'] = self.options['passwd']
-        log.info("Binding to queue with route key: %s" % (route_key))
-        self.listener = TcPulseConsumer(self.exchanges,
-                                        callback=self._route_callback_handler,
-                                        **self.consumer_args)
+        log.info("Binding to queue with route keys: %s" %
+                 ', '.join(route_keys))
+        self.batch_size = self.options.get('batch_size', 1)
+        self.batch = []
+        if self.batch_size > 1:
+            log.info("Batching %d messages (prefetch %d)" %
+                     (self.batch_size, self.options['prefetch']))
+            self.listener = BatchingPulseConsumer(
+                exchanges,
+                prefetch_count=self.options['prefetch'],
+                idle_timeout=self.options['batch_timeout'],
+                on_idle=self._on_idle,
+                callback=self._batch_callback_handler,
+                **self.consumer_args)
+        else:
+            self.listener = TcPulseConsumer(
+                exchanges,
+                prefetch_count=self.options.get('prefetch', 0),
+                callback=self._route_callback_handler,
+                **self.consumer_args)
 
     def run(self):
         while True:
@@ -97,41 +282,168 @@ class TaskEventApp(object):
                 self._graceful_shutdown()
             except:
                 traceback.print_exc()
+                # The write may have failed as redis lost its data
+                self._check_restored(force=True)
 
     def _graceful_shutdown(self):
         log.info("Gracefully shutting down")
-        log.info("Deleting Pulse queue")
-        self.listener.delete_queue()
+        try:
+            self._flush_batch()
+            for stats in self.stats_by_prefix.values():
+                stats.flush()
+            self.metrics.flush()
+            if self.capture:
+                self.capture.close()
+            if self.journal:
+                self.journal.close()
+        except:
+            traceback.print_exc()
+        if self.delete_queue:
+            log.info("Deleting Pulse queue")
+            self.listener.delete_queue()
         sys.exit(1)
 
-    def _route_callback_handler(self, body, message):
+    def _check_restored(self, force=False):
         """
-        Route call body and msg to proper callback handler
+        Restore the lists from the journal if redis lost them since, at
+        most every restore_check_interval seconds unless forced.  Changes
+        applied to an emptied redis in between are kept, the journal holds
+        them too
+        """
+        if self.journal is None:
+            return
+        now = time.time()
+        if not force and now - self.last_restore_check < \
+                self.restore_check_interval:
+            return
+        self.last_restore_check = now
+        try:
+            self.journal.flush()
+            restore_from_journal(self.coalescers.keys(), self.options,
+                                 self.redis, shards=self.shards)
+        except:
+            traceback.print_exc()
+
+    def _deadline(self, prefix, coalesce_key):
+        return self.coalescers[prefix].deadline(coalesce_key)
+
+    def _parse_event(self, body, message):
+        """
+        Return (prefix, (action, taskId, coalesce_key)) for body and msg,
+        the event for the coalescer of the first matching route prefix, or
+        None if the message should be ignored
         """
         # Ignore tasks with non-zero runId (for now)
         if not body['runId'] == 0:
-            message.ack()
-            return
+            return None
 
+        route = self.routes.match(message.headers.get('CC', ()))
+        if route is None:
+            self.stats.notch('unmatched')
+            return None
+        prefix, coalesce_key = route
         taskState = body['status']['state']
         taskId = body['status']['taskId']
-        # Extract first coalesce key that matches
-        for route in message.headers['CC']:
-            route = route[6:]
-            if self.prefix == route[:len(self.prefix)]:
-                coalesce_key = route[len(self.prefix):]
-                break
+        self._observe_lag(body)
         if taskState == 'pending':
-            self.coalescer.insert_task(taskId, coalesce_key)
+            return prefix, ('insert', taskId, coalesce_key)
         elif taskState == 'completed' or \
                 taskState == 'exception' or \
                 taskState == 'failed':
-            self.coalescer.remove_task(taskId, coalesce_key)
+            return prefix, ('remove', taskId, coalesce_key)
         else:
             raise StateError
-        message.ack()
+
+    def _observe_lag(self, body):
+        """
+        Record the time since the task event, ie. since the run was
+        scheduled or resolved
+        """
+        try:
+            run = body['status']['runs'][body['runId']]
+            timestamp = run.get('resolved') or run['scheduled']
+            event_time = calendar.timegm(datetime.strptime(
+                timestamp, '%Y-%m-%dT%H:%M:%S.%fZ').utctimetuple())
+        except (KeyError, IndexError, TypeError, ValueError):
+            return
+        self.metrics.observe('listener_queue_lag_seconds',
+                             max(0, time.time() - event_time))
+
+    def _route_callback_handler(self, body, message):
+        """
+        Route call body and msg to proper callback handler
+        """
+        if self.capture:
+            self.capture.write(body, message.headers)
+        self._check_restored()
+        with self.metrics.time('listener_message_seconds'):
+            event = self._parse_event(body, message)
+            if event is None:
+                message.ack()
+                return
+            prefix, (action, taskId, coalesce_key) = event
+            if action == 'insert':
+                self.coalescers[prefix].insert_task(taskId, coalesce_key)
+            else:
+                self.coalescers[prefix].remove_task(taskId, coalesce_key)
+            message.ack()
         self.stats.notch('total_msgs_handled')
-        log.debug("taskId: %s (%s)" % (taskId, taskState))
+        self.metrics.maybe_flush()
+        log.debug("taskId: %s (%s)" % (taskId, body['status']['state']))
+
+    def _batch_callback_handler(self, body, message):
+        """
+        Queue the event for body and msg, flushing once the batch is full
+        """
+        if self.capture:
+            self.capture.write(body, message.headers)
+        event = self._parse_event(body, message)
+        if event is None:
+            message.ack()
+            return
+        self.batch.append((event, message))
+        if len(self.batch) >= self.batch_size:
+            self._flush_batch()
+
+    def _on_idle(self):
+        self._flush_batch()
+        for stats in self.stats_by_prefix.values():
+            stats.maybe_flush()
+        self.metrics.maybe_flush()
+        if self.capture:
+            self.capture.flush()
+        if self.journal:
+            self.journal.flush()
+
+    def _flush_batch(self):
+        """
+        Apply the queued events of each prefix in one pipeline and only
+        then ack their messages.  If a write fails the messages not yet
+        applied are requeued
+        """
+        if not self.batch:
+            return
+        self._check_restored()
+        batch, self.batch = self.batch, []
+        by_prefix = OrderedDict()
+        for (prefix, event), message in batch:
+            by_prefix.setdefault(prefix, []).append((event, message))
+        with self.metrics.time('listener_batch_seconds'):
+            groups = by_prefix.items()
+            for i, (prefix, group) in enumerate(groups):
+                try:
+                    self.coalescers[prefix].apply_events(
+                        [event for event, _ in group])
+                except:
+                    for _, unapplied in groups[i:]:
+                        for _, message in unapplied:
+                            message.requeue()
+                    raise
+                for _, message in group:
+                    message.ack()
+        self.stats.notch('total_msgs_handled', len(batch))
+        self.metrics.maybe_flush()
+        log.debug("Flushed batch of %d messages" % len(batch))
 
 
 def setup_log():
@@ -157,16 +469,192 @@ def main():
     prefix = "coalesce.v1."
 
     # setup redis object
-    rds = redis.Redis(host=options['redis'].hostname,
-                      port=options['redis'].port,
-                      password=options['redis'].password)
-    stats = Stats(prefix, datastore=rds)
-    app = TaskEventApp(prefix, options, stats, datastore=rds)
+    rds = connect_datastore(options)
+    shards = connect_shards(options)
+    stats = Stats(prefix, datastore=rds,
+                  flush_interval=options.get('stats_flush_interval'))
+    # Convert any lists left in the original list + timestamp key layout
+    # before consuming, so no message can race the migration
+    for coalescer_prefix in [prefix] + options['extra_prefixes']:
+        migrated = sharding.coalescing_machine(
+            coalescer_prefix, rds, stats, shards=shards).migrate_lists()
+        if migrated:
+            log.info("Migrated %d %s tasks to sorted set layout" %
+                     (migrated, coalescer_prefix))
+    if options.get('journal_dir'):
+        restore_from_journal([prefix] + options['extra_prefixes'], options,
+                             rds, shards=shards)
     signal.signal(signal.SIGTERM, signal_term_handler)
-    app.run()
+    if options['datastore'] == 'memory':
+        if options['workers'] > 1:
+            log.warning("Ignoring WORKERS, the memory datastore is only "
+                        "reachable from one process")
+        serve_in_process(prefix, options, rds)
+        app = TaskEventApp(prefix, options, stats, datastore=rds)
+        app.run()
+    elif options['workers'] > 1:
+        supervise(prefix, options)
+    else:
+        app = TaskEventApp(prefix, options, stats, datastore=rds,
+                           shards=shards)
+        app.run()
     # graceful shutdown via SIGTERM
 
 
+def restore_from_journal(prefixes, options, rds, shards=None):
+    """
+    Rebuild the lists of every prefix whose <prefix>restored marker is
+    missing from redis, ie. redis was flushed, failed over to an empty
+    replica or is the memory datastore of a fresh process.  Only a restore
+    sets the marker, unlike the version counter any change recreates, so a
+    loss is noticed however many changes followed it.  The journal is
+    merged into whatever lists redis still holds.  With shards, each node
+    is checked and restored on its own.  Returns the tasks restored
+    """
+    coalescers = {}
+    for prefix in prefixes:
+        coalescer = sharding.coalescing_machine(
+            prefix, rds, Stats(prefix, datastore=rds), shards=shards,
+            ttl=options.get('task_ttl'), deadlines=options.get('deadlines'))
+        machines = coalescer.machines if shards else [coalescer]
+        lost = [index for index, machine in enumerate(machines)
+                if not machine.redis.exists(prefix + 'restored')]
+        if lost:
+            coalescers[prefix] = (coalescer, machines, lost)
+    if not coalescers:
+        return 0
+    start = time.time()
+    lists = journal.load(
+        options['journal_dir'],
+        lambda prefix, coalesce_key: coalescers[prefix][0].deadline(
+            coalesce_key) if prefix in coalescers else 0)
+    loaded = time.time() - start
+    restored = 0
+    for prefix, (coalescer, machines, lost) in coalescers.items():
+        prefix_lists = lists.get(prefix, {})
+        for index in lost:
+            if shards:
+                coalesce_keys = shards.partition(prefix_lists).get(index, [])
+            else:
+                coalesce_keys = prefix_lists.keys()
+            restored += machines[index].restore_lists(dict(
+                (coalesce_key, prefix_lists[coalesce_key])
+                for coalesce_key in coalesce_keys))
+            # Mark the node as restored, even when there was nothing to
+            # restore
+            machines[index].redis.set(prefix + 'restored', time.time())
+        coalescer.stats.flush()
+    log.info("Restored %d tasks from %s in %.1fs (%.1fs loading)" %
+             (restored, options['journal_dir'], time.time() - start, loaded))
+    return restored
+
+
+def connect_datastore(options):
+    return datastore.connect(options['datastore'], options.get('redis_url'))
+
+
+def connect_shards(options):
+    """ The HashRing of REDIS_SHARD_URLS, None when not sharding """
+    if options.get('shard_urls'):
+        return sharding.connect(options['shard_urls'])
+    return None
+
+
+def serve_in_process(prefix, options, rds):
+    """
+    Start the web API and the reaper on daemon threads, sharing the memory
+    datastore no other process can reach
+    """
+    # web loads its config package from the repository root
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 '..'))
+    import web
+    from werkzeug.serving import make_server
+    web.app.redis = rds
+    web.app.redis_replica = None
+    web.app.shards = None
+    web.app.prefix = prefix
+    web.setup_metrics(web.app)
+    # Lists are read in-process, there is no round trip for a cache to save
+    web.app.config['CACHE_TTL'] = 0
+    port = int(os.getenv('PORT', 5000))
+    server = make_server('0.0.0.0', port, web.app, threaded=True)
+    log.info("Serving the web API on port %d" % port)
+    start_daemon(server.serve_forever, 'web')
+
+    reaper.setup_log()
+    stats = Stats(prefix, datastore=rds,
+                  flush_interval=options.get('stats_flush_interval'))
+    coalescer = sharding.coalescing_machine(
+        prefix, rds, stats, ttl=options.get('task_ttl'),
+        deadlines=options.get('deadlines'), metrics=Metrics(prefix, rds))
+    start_daemon(reaper.run, 'reaper', coalescer, stats,
+                 float(os.getenv('REAP_INTERVAL', reaper.REAP_INTERVAL)))
+
+
+def start_daemon(target, name, *args):
+    thread = threading.Thread(target=target, name=name, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def run_worker(prefix, options, worker_id):
+    """ Consume the shared queue in a worker process """
+    if options.get('capture_file'):
+        # One log per worker, appends from several processes would interleave
+        options = dict(options,
+                       capture_file='%s.%d' % (options['capture_file'],
+                                               worker_id))
+    options = dict(options, journal_name='journal.%d' % worker_id)
+    rds = connect_datastore(options)
+    stats = Stats(prefix, datastore=rds,
+                  flush_interval=options.get('stats_flush_interval'))
+    app = TaskEventApp(prefix, options, stats, datastore=rds,
+                       delete_queue=(worker_id == 0),
+                       shards=connect_shards(options))
+    app.run()
+
+
+def supervise(prefix, options):
+    """
+    Run options['workers'] worker processes, restarting any that exit, until
+    SIGTERM/SIGINT which is passed on to the workers for a graceful shutdown
+    """
+    workers = {}
+
+    def start(worker_id):
+        worker = multiprocessing.Process(target=run_worker,
+                                         args=(prefix, options, worker_id),
+                                         name='worker-%d' % worker_id)
+        worker.start()
+        log.info("Started worker %d (pid %d)" % (worker_id, worker.pid))
+        workers[worker_id] = worker
+
+    try:
+        for worker_id in range(options['workers']):
+            start(worker_id)
+        while True:
+            time.sleep(1)
+            for worker_id, worker in workers.items():
+                if not worker.is_alive():
+                    log.warning("Worker %d exited with code %s, restarting" %
+                                (worker_id, worker.exitcode))
+                    start(worker_id)
+    except KeyboardInterrupt:
+        log.info("Stopping %d workers" % len(workers))
+        for worker in workers.values():
+            if worker.is_alive():
+                worker.terminate()
+        deadline = time.time() + SHUTDOWN_TIMEOUT
+        for worker in workers.values():
+            worker.join(max(0, deadline - time.time()))
+            if worker.is_alive():
+                log.warning("Killing unresponsive worker (pid %d)" %
+                            worker.pid)
+                os.kill(worker.pid, signal.SIGKILL)
+
+
 def signal_term_handler(signal, frame):
     log.info("Handling signal: term")
     raise KeyboardInterrupt
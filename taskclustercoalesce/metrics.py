@@ -0,0 +1,144 @@
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the histogram buckets, +Inf is implied
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# name: (help, buckets) of every histogram recorded by any process, so the
+# web process can render those recorded by the listener
+HISTOGRAMS = {
+    'listener_message_seconds':
+        ('Time to handle one Pulse message', LATENCY_BUCKETS),
+    'listener_batch_seconds':
+        ('Time to apply one batch of Pulse messages', LATENCY_BUCKETS),
+    'listener_queue_lag_seconds':
+        ('Time from a task event to its handling by the listener',
+         LAG_BUCKETS),
+    'coalescer_redis_seconds':
+        ('Redis round trip time by coalescer operation', LATENCY_BUCKETS),
+    'web_request_seconds':
+        ('Web request handling time by endpoint', LATENCY_BUCKETS),
+}
+
+# Stats which can decrease, every other stat is a counter
+GAUGES = ('pending_count', 'coalesced_lists')
+
+
+class Metrics(object):
+    """
+    Histograms recorded in process and merged into the <prefix>metrics hash
+    by flush(), so observing adds no Redis round trips and every process's
+    observations are served together by the web API's /metrics.
+
+    The hash holds per bucket counts in '<series>|<le>' fields alongside
+    '<series>|sum' and '<series>|count', where series is the histogram name
+    and its label, eg. 'coalescer_redis_seconds{op="insert"}'
+    """
+
+    prefix = "default.metrics"
+
+    # Seconds between writes of the observations to redis
+    flush_interval = 5
+
+    def __init__(self, prefix, datastore, flush_interval=None):
+        self.prefix = prefix + "metrics"
+        self.redis = datastore
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        # series: [bucket counts..., sum] observed since the last flush
+        self.series = {}
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        series = series_name(name, labels)
+        buckets = HISTOGRAMS[name][1]
+        with self.lock:
+            if series not in self.series:
+                self.series[series] = [0] * (len(buckets) + 2)
+            counts = self.series[series]
+            counts[bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def maybe_flush(self):
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Merge the buffered observations into redis in one round trip """
+        self.last_flush = time.time()
+        with self.lock:
+            series, self.series = self.series, {}
+        if not series:
+            return
+        pipe = self.redis.pipeline()
+        for name, counts in series.items():
+            buckets = HISTOGRAMS[name.split('{')[0]][1]
+            for le, count in zip(bucket_labels(buckets), counts):
+                if count:
+                    pipe.hincrby(self.prefix, name + '|' + le, count)
+            pipe.hincrby(self.prefix, name + '|count', sum(counts[:-1]))
+            pipe.hincrbyfloat(self.prefix, name + '|sum', counts[-1])
+        pipe.execute()
+
+    def render(self, stats_prefix):
+        """
+        Return the stored histograms and the stats hash in the Prometheus
+        text exposition format
+        """
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self.prefix)
+        pipe.hgetall(stats_prefix + "stats")
+        fields, stats = pipe.execute()
+
+        series = {}
+        for field, value in fields.items():
+            name, le = field.rsplit('|', 1)
+            series.setdefault(name, {})[le] = value
+        lines = []
+        for histogram in sorted(HISTOGRAMS):
+            help, buckets = HISTOGRAMS[histogram]
+            lines.append('# HELP %s %s' % (histogram, help))
+            lines.append('# TYPE %s histogram' % histogram)
+            for name in sorted(series):
+                if name.split('{')[0] != histogram:
+                    continue
+                values = series[name]
+                labels = name[len(histogram) + 1:-1]
+                total = 0
+                for le in bucket_labels(buckets):
+                    total += int(values.get(le, 0))
+                    lines.append('%s_bucket{%sle="%s"} %d' % (
+                        histogram, labels + ',' if labels else '', le, total))
+                lines.append('%s_sum%s %s' % (
+                    histogram, name[len(histogram):], values.get('sum', 0)))
+                lines.append('%s_count%s %s' % (
+                    histogram, name[len(histogram):], values.get('count', 0)))
+        for stat in sorted(stats):
+            lines.append('# TYPE coalesce_%s %s' % (
+                stat, 'gauge' if stat in GAUGES else 'counter'))
+            lines.append('coalesce_%s %s' % (stat, stats[stat]))
+        return '\n'.join(lines) + '\n'
+
+
+def series_name(name, labels):
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % item
+                                      for item in sorted(labels.items())))
+
+
+def bucket_labels(buckets):
+    return ['%g' % le for le in buckets] + ['+Inf']
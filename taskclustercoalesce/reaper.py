@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+import logging
+import signal
+
+import redisconn
+import sharding
+from stats import Stats
+from metrics import Metrics
+from coalescer import parse_deadlines
+
+log = None
+
+# Seconds between sweeps of the age index
+REAP_INTERVAL = 60
+
+
+def reap(coalescer):
+    """ Sweep until no list in the age index is due, returns tasks evicted """
+    evicted = 0
+    while True:
+        count, visited = coalescer.reap_expired()
+        evicted += count
+        if not visited:
+            return evicted
+
+
+def run(coalescer, stats, interval):
+    while True:
+        try:
+            evicted = reap(coalescer)
+            if evicted:
+                log.info("Evicted %d stale tasks" % evicted)
+            stats.flush()
+            coalescer.metrics.flush()
+        except KeyboardInterrupt:
+            raise
+        except:
+            log.exception("Reaper sweep failed")
+        time.sleep(interval)
+
+
+def setup_log():
+    global log
+    log = logging.getLogger(__name__)
+    lvl = logging.DEBUG if os.getenv('DEBUG') == 'True' else logging.INFO
+    log.setLevel(lvl)
+    console_handler = logging.StreamHandler(sys.stdout)
+    formatter = logging.Formatter('[%(asctime)s] [%(process)d] ' +
+                                  '[%(levelname)s] %(message)s',
+                                  datefmt='%Y-%m-%d %H:%M:%S +0000')
+    console_handler.setFormatter(formatter)
+    log.addHandler(console_handler)
+    return log
+
+
+def main():
+    setup_log()
+    try:
+        redis_url = os.environ['REDIS_URL']
+    except KeyError:
+        log.exception("Missing REDIS_URL env variable")
+        sys.exit(1)
+    log.info("Starting Coalescing Reaper")
+
+    prefix = "coalesce.v1."
+    rds = redisconn.connect(redis_url)
+    shard_urls = sharding.shard_urls(os.getenv('REDIS_SHARD_URLS'))
+    stats = Stats(prefix, datastore=rds)
+    ttl = int(os.environ['TASK_TTL']) if os.getenv('TASK_TTL') else None
+    coalescer = sharding.coalescing_machine(
+        prefix, rds, stats, ttl=ttl,
+        shards=sharding.connect(shard_urls) if shard_urls else None,
+        deadlines=parse_deadlines(os.getenv('TASK_DEADLINES', '')),
+        metrics=Metrics(prefix, rds))
+    indexed = coalescer.build_age_index()
+    if indexed:
+        log.info("Added %d lists to the age index" % indexed)
+    signal.signal(signal.SIGTERM, signal_term_handler)
+    try:
+        run(coalescer, stats, float(os.getenv('REAP_INTERVAL',
+                                              REAP_INTERVAL)))
+    except KeyboardInterrupt:
+        log.info("Shutting down")
+        stats.flush()
+        coalescer.metrics.flush()
+
+
+def signal_term_handler(signal, frame):
+    log.info("Handling signal: term")
+    raise KeyboardInterrupt
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Redis clients for the listener, reaper, scrubber and web API, built from a
+url such as redis://:password@host:6379/0, rediss://host:6380 for TLS or
+unix:///var/run/redis.sock?db=0.  Pools are tuned from the environment:
+
+    REDIS_SOCKET_TIMEOUT    seconds a command may block, default 10
+    REDIS_CONNECT_TIMEOUT   seconds to establish a connection, default 5
+    REDIS_KEEPALIVE         TCP keepalive on idle connections, default 1
+    REDIS_MAX_CONNECTIONS   connections per pool, default unbounded
+    REDIS_POOL_TIMEOUT      seconds to wait for a connection once a pool is
+                            bounded, default 5
+"""
+
+import os
+import redis
+from urlparse import urlparse
+
+SOCKET_TIMEOUT = 10
+CONNECT_TIMEOUT = 5
+POOL_TIMEOUT = 5
+
+
+def pool_options(url, environ=None):
+    """ Connection keyword arguments for url from the environment """
+    environ = os.environ if environ is None else environ
+    options = {'socket_timeout': float(environ.get('REDIS_SOCKET_TIMEOUT',
+                                                   SOCKET_TIMEOUT)) or None}
+    # Unix sockets have no connect timeout or keepalive
+    if urlparse(url).scheme != 'unix':
+        options['socket_connect_timeout'] = float(
+            environ.get('REDIS_CONNECT_TIMEOUT', CONNECT_TIMEOUT)) or None
+        options['socket_keepalive'] = environ.get('REDIS_KEEPALIVE',
+                                                  '1') != '0'
+    if environ.get('REDIS_MAX_CONNECTIONS'):
+        options['max_connections'] = int(environ['REDIS_MAX_CONNECTIONS'])
+    if environ.get('REDIS_POOL_TIMEOUT'):
+        options['pool_timeout'] = float(environ['REDIS_POOL_TIMEOUT'])
+    return options
+
+
+def connection_pool(url, **kwargs):
+    """
+    Return a pool for url.  Keyword arguments override the environment; a
+    pool with max_connections blocks for up to pool_timeout seconds when
+    every connection is in use, rather than failing
+    """
+    options = pool_options(url)
+    options.update(kwargs)
+    pool_timeout = options.pop('pool_timeout', POOL_TIMEOUT)
+    if options.get('max_connections'):
+        return redis.BlockingConnectionPool.from_url(url, timeout=pool_timeout,
+                                                     **options)
+    options.pop('max_connections', None)
+    return redis.ConnectionPool.from_url(url, **options)
+
+
+def connect(url, **kwargs):
+    """ Return a client for url on its own pool, see connection_pool """
+    return redis.Redis(connection_pool=connection_pool(url, **kwargs))
@@ -0,0 +1,211 @@
+"""
+Client side sharding of the coalesce lists over several Redis nodes, set by
+REDIS_SHARD_URLS.  The sorted set of a list lives on the node its coalesce
+key hashes to, and each node keeps its own list_keys, age_index, tombstones
+and version counter for the lists it holds, so every change is still applied
+in one MULTI/EXEC on one node.  Stats and metrics
+stay on REDIS_URL.
+"""
+
+import hashlib
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from urlparse import urlparse
+
+import redisconn
+from coalescer import CoalescingMachine
+
+
+class HashRing(object):
+    """
+    Consistent hashing of coalesce keys onto nodes.  Each node is placed at
+    points_per_node points on a ring by the hash of its name, and a key
+    belongs to the node of the first point at or after the key's hash, so
+    adding or removing a node only moves the keys of its share of the ring
+    """
+
+    points_per_node = 160
+
+    def __init__(self, nodes, names):
+        self.nodes = list(nodes)
+        self.names = list(names)
+        points = sorted((ring_hash('%s-%d' % (name, i)), index)
+                        for index, name in enumerate(self.names)
+                        for i in range(self.points_per_node))
+        self.hashes = [point for point, _ in points]
+        self.indexes = [index for _, index in points]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def index(self, coalesce_key):
+        """ The index in nodes of the node holding coalesce_key """
+        if len(self.nodes) == 1:
+            return 0
+        i = bisect_left(self.hashes, ring_hash(coalesce_key))
+        return self.indexes[i % len(self.hashes)]
+
+    def node(self, coalesce_key):
+        return self.nodes[self.index(coalesce_key)]
+
+    def partition(self, coalesce_keys):
+        """ {node index: [coalesce_key, ...]} of coalesce_keys, in order """
+        parts = OrderedDict()
+        for coalesce_key in coalesce_keys:
+            parts.setdefault(self.index(coalesce_key), []).append(
+                coalesce_key)
+        return parts
+
+    def map(self, call):
+        """ [call(node) for node in nodes], the nodes in parallel """
+        return parallel([lambda node=node: call(node) for node in self.nodes])
+
+
+class ShardStats(object):
+    """
+    The Stats of one shard's CoalescingMachine: the coalesced_lists gauge it
+    sets counts its own node's lists, and is reported summed over counts,
+    those of every shard
+    """
+
+    def __init__(self, stats, counts, index):
+        self.stats = stats
+        self.counts = counts
+        self.index = index
+
+    def notch(self, counter, count=1):
+        self.stats.notch(counter, count)
+
+    def get(self, stat_name):
+        if stat_name == 'coalesced_lists':
+            return self.counts[self.index]
+        return self.stats.get(stat_name)
+
+    def set(self, stat_name, stat):
+        if stat_name == 'coalesced_lists':
+            self.counts[self.index] = stat
+            stat = sum(self.counts)
+        self.stats.set(stat_name, stat)
+
+    def flush(self):
+        self.stats.flush()
+
+
+class ShardedCoalescer(object):
+    """
+    The CoalescingMachine interface over a CoalescingMachine per node of a
+    HashRing, each given the changes to the lists it holds
+    """
+
+    def __init__(self, prefix, shards, stats, **kwargs):
+        self.prefix = prefix
+        self.shards = shards
+        self.stats = stats
+        self.metrics = kwargs.get('metrics')
+        counts = shards.map(lambda node: node.scard(prefix + "list_keys"))
+        self.machines = [
+            CoalescingMachine(prefix, node, ShardStats(stats, counts, index),
+                              **kwargs)
+            for index, node in enumerate(shards.nodes)]
+        self.ttl = self.machines[0].ttl
+
+    def machine(self, coalesce_key):
+        return self.machines[self.shards.index(coalesce_key)]
+
+    def insert_task(self, taskId, coalesce_key):
+        self.machine(coalesce_key).insert_task(taskId, coalesce_key)
+
+    def remove_task(self, taskId, coalesce_key):
+        self.machine(coalesce_key).remove_task(taskId, coalesce_key)
+
+    def apply_events(self, events):
+        """ CoalescingMachine.apply_events(), one batch per node """
+        batches = {}
+        for event in events:
+            batches.setdefault(self.shards.index(event[2]), []).append(event)
+        for index, batch in sorted(batches.items()):
+            self.machines[index].apply_events(batch)
+
+    def migrate_lists(self):
+        return sum(machine.migrate_lists() for machine in self.machines)
+
+    def reap_expired(self):
+        reaped = [machine.reap_expired() for machine in self.machines]
+        return (sum(evicted for evicted, _ in reaped),
+                sum(visited for _, visited in reaped))
+
+    def build_age_index(self):
+        return sum(machine.build_age_index() for machine in self.machines)
+
+    def restore_lists(self, lists):
+        restored = 0
+        for index, coalesce_keys in self.shards.partition(lists).items():
+            restored += self.machines[index].restore_lists(
+                dict((coalesce_key, lists[coalesce_key])
+                     for coalesce_key in coalesce_keys))
+        return restored
+
+    def deadline(self, coalesce_key):
+        return self.machines[0].deadline(coalesce_key)
+
+
+def coalescing_machine(prefix, datastore, stats, shards=None, **kwargs):
+    """
+    A CoalescingMachine on datastore, or a ShardedCoalescer over the shards
+    HashRing if given
+    """
+    if shards is None:
+        return CoalescingMachine(prefix, datastore, stats, **kwargs)
+    return ShardedCoalescer(prefix, shards, stats, **kwargs)
+
+
+def connect(urls, **kwargs):
+    """ A HashRing of clients for urls, see redisconn.connect """
+    return HashRing([redisconn.connect(url, **kwargs) for url in urls],
+                    [node_name(url) for url in urls])
+
+
+def shard_urls(value):
+    """ Parse the comma separated urls given in REDIS_SHARD_URLS """
+    return [url.strip() for url in (value or '').split(',') if url.strip()]
+
+
+def node_name(url):
+    """ url without its password, which may change without moving keys """
+    parsed = urlparse(url)
+    return parsed.netloc.rsplit('@', 1)[-1] + parsed.path + (
+        '?' + parsed.query if parsed.query else '')
+
+
+def ring_hash(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+
+def parallel(calls):
+    """
+    Run calls on a thread each, returning their results in order or raising
+    the first exception.  A single call runs in this thread
+    """
+    if len(calls) == 1:
+        return [calls[0]()]
+    results = [None] * len(calls)
+    errors = []
+
+    def run(i):
+        try:
+            results[i] = calls[i]()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(len(calls))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
@@ -1,3 +1,5 @@
+import time
+
 
 class Stats(object):
 
@@ -9,29 +11,91 @@ class Stats(object):
              'coalesced_lists': 0,  # number of coalesced lists
              'unknown_tasks': 0,    # number of tasks seen missing from pending
              'premature': 0,        # number of premature msgs
+             'reaped': 0,           # number of stale tasks evicted
+             'unmatched': 0,        # number of msgs without a known route
+             'truncated_responses': 0,  # supersedes lists cut to a limit
              'total_msgs_handled': 0
              }
 
-    def __init__(self, prefix, datastore):
+    # Buffered writes are flushed to redis once this many seconds have passed
+    # or this many increments have accumulated, whichever comes first
+    flush_interval = 5
+    flush_size = 1000
+
+    def __init__(self, prefix, datastore, flush_interval=None,
+                 flush_size=None):
         self.prefix = prefix + "stats"
         self.redis = datastore
-        h_keys = self.redis.hkeys(self.prefix)
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if flush_size is not None:
+            self.flush_size = flush_size
+        self.stats = dict(self.stats)
+        # Counter increments and gauge values not yet written to redis
+        self.increments = {}
+        self.gauges = {}
+        self.pending = 0
+        self.last_flush = time.time()
+
+        h_stats = self.redis.hgetall(self.prefix)
+        pipe = self.redis.pipeline()
         for key in self.stats.keys():
-            if key in h_keys:
-                self.stats[key] = int(self.redis.hget(self.prefix, key))
+            if key in h_stats:
+                self.stats[key] = int(h_stats[key])
             else:
-                self.redis.hset(self.prefix, key, self.stats[key])
+                # Another listener may be initialising concurrently
+                pipe.hsetnx(self.prefix, key, self.stats[key])
+        pipe.execute()
 
-    def notch(self, counter):
-        self.stats[counter] += 1
-        self.redis.hset(self.prefix, counter, self.stats[counter])
+    def notch(self, counter, count=1):
+        """ Increment a counter shared by every listener process """
+        self.stats[counter] += count
+        self.increments[counter] = self.increments.get(counter, 0) + count
+        self.pending += count
+        self.maybe_flush()
 
     def get(self, stat_name):
         return self.stats[stat_name]
 
     def set(self, stat_name, stat):
+        """ Set a gauge, last writer wins """
         self.stats[stat_name] = stat
-        self.redis.hset(self.prefix, stat_name, stat)
+        self.gauges[stat_name] = stat
+        self.pending += 1
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if self.pending >= self.flush_size or \
+                time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Write buffered increments and gauges in one round trip """
+        self.last_flush = time.time()
+        if not self.pending:
+            return
+        increments, self.increments = self.increments, {}
+        gauges, self.gauges = self.gauges, {}
+        self.pending = 0
+        pipe = self.redis.pipeline()
+        for counter, count in increments.items():
+            pipe.hincrby(self.prefix, counter, count)
+        if gauges:
+            pipe.hmset(self.prefix, gauges)
+        try:
+            totals = pipe.execute()
+        except:
+            # Keep the buffered values for the next attempt
+            for counter, count in increments.items():
+                self.increments[counter] = \
+                    self.increments.get(counter, 0) + count
+            gauges.update(self.gauges)
+            self.gauges = gauges
+            self.pending += sum(increments.values()) + len(gauges)
+            raise
+        # Pick up increments made by other listeners
+        for counter, total in zip(increments.keys(), totals):
+            self.stats[counter] = int(total)
 
     def dump(self):
         return self.stats
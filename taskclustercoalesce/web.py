@@ -1,14 +1,19 @@
 import sys
 import os
+import json
 import flask
 import time
-import redis
 import logging
+import threading
 from flask import jsonify
-from urlparse import urlparse
 from werkzeug.contrib.fixers import ProxyFix
 from flask_sslify import SSLify
 
+import redisconn
+import sharding
+from cache import ListCache
+from metrics import Metrics
+
 starttime = time.time()
 
 app = flask.Flask(__name__)
@@ -42,34 +47,192 @@ def load_config(app):
     # Override with select environment vars if they exist
     if os.getenv('REDIS_URL'):
         app.config['REDIS_URL'] = os.getenv('REDIS_URL')
+    if os.getenv('REDIS_REPLICA_URL'):
+        app.config['REDIS_REPLICA_URL'] = os.getenv('REDIS_REPLICA_URL')
+    if os.getenv('REDIS_SHARD_URLS'):
+        app.config['REDIS_SHARD_URLS'] = os.getenv('REDIS_SHARD_URLS')
     if os.getenv('PREFIX'):
         app.config['PREFIX'] = os.getenv('PREFIX')
     if os.getenv('DEBUG'):
         app.config['DEBUG'] = os.getenv('DEBUG')
+    if os.getenv('CACHE_TTL'):
+        app.config['CACHE_TTL'] = float(os.getenv('CACHE_TTL'))
+    if os.getenv('REDIS_MAX_CONNECTIONS'):
+        app.config['REDIS_MAX_CONNECTIONS'] = int(
+            os.getenv('REDIS_MAX_CONNECTIONS'))
+    if os.getenv('REDIS_POOL_TIMEOUT'):
+        app.config['REDIS_POOL_TIMEOUT'] = float(
+            os.getenv('REDIS_POOL_TIMEOUT'))
     return app
 
 
 def connect_redis(app):
-    redis_url = urlparse(app.config['REDIS_URL'])
     app.logger.info('Connecting to Redis @ {0}'.format(
                     app.config['REDIS_URL']))
-    app.redis = redis.Redis(host=redis_url.hostname,
-                            port=redis_url.port,
-                            password=redis_url.password,
-                            decode_responses=True)
+    # Requests wait for a free connection rather than opening one per
+    # concurrent request, which matters under the gevent worker
+    options = {'max_connections': app.config['REDIS_MAX_CONNECTIONS'],
+               'pool_timeout': app.config['REDIS_POOL_TIMEOUT'],
+               'decode_responses': True}
+    app.redis = redisconn.connect(app.config['REDIS_URL'], **options)
+    # Lists may be read from a replica, writes always go to REDIS_URL
+    app.redis_replica = None
+    if app.config['REDIS_REPLICA_URL']:
+        app.logger.info('Reading lists from Redis replica @ {0}'.format(
+                        app.config['REDIS_REPLICA_URL']))
+        app.redis_replica = redisconn.connect(
+            app.config['REDIS_REPLICA_URL'], **options)
+    # Lists sharded over several nodes are read from those instead
+    app.shards = None
+    urls = sharding.shard_urls(app.config['REDIS_SHARD_URLS'])
+    if urls:
+        app.logger.info('Reading lists from {0} Redis shards'.format(
+                        len(urls)))
+        app.shards = sharding.connect(urls, **options)
     return app
 
 
+def read_redis():
+    """ The client for read only queries, the replica when configured """
+    return app.redis_replica or app.redis
+
+
+def list_nodes():
+    """ The clients to read the lists from, one per shard """
+    return app.shards.nodes if app.shards else [read_redis()]
+
+
+def invalidation_urls():
+    """ The nodes publishing the changes to the lists """
+    urls = sharding.shard_urls(app.config['REDIS_SHARD_URLS'])
+    # A replica relays each publish after the write before it
+    return urls or [app.config['REDIS_REPLICA_URL'] or
+                    app.config['REDIS_URL']]
+
+
+def pipelined(keys, width, queue):
+    """
+    Queue width commands for each of keys with queue(pipe, key) on a pipeline
+    to the node holding the key, run those of every node in parallel and
+    return {key: [the results of its commands]}
+    """
+    nodes = list_nodes()
+    parts = app.shards.partition(keys).items() if app.shards else [(0, keys)]
+
+    def execute(node, node_keys):
+        pipe = node.pipeline()
+        for key in node_keys:
+            queue(pipe, key)
+        return pipe.execute()
+
+    results = sharding.parallel(
+        [lambda node=nodes[index], node_keys=node_keys:
+         execute(node, node_keys) for index, node_keys in parts])
+    by_key = {}
+    for (_, node_keys), result in zip(parts, results):
+        for i, key in enumerate(node_keys):
+            by_key[key] = result[width * i:width * (i + 1)]
+    return by_key
+
+
 def set_prefix(app):
     app.prefix = app.config['PREFIX']
     return app
 
 
+def setup_cache(app):
+    app.cache = ListCache(app.config['CACHE_SIZE'], app.config['CACHE_TTL'])
+    return app
+
+
+def setup_metrics(app):
+    app.metrics = Metrics(app.prefix, app.redis)
+    return app
+
+
+def listen_for_invalidations(app, url):
+    """
+    Drop cached lists as the listener publishes changes to url.  The cache
+    is only enabled while subscribed to every node in invalidation_urls();
+    on any error it is cleared and disabled until the subscription is
+    re-established
+    """
+    channel = app.prefix + 'invalidate'
+    while True:
+        try:
+            # No socket timeout, the channel may idle
+            pubsub = redisconn.connect(url, socket_timeout=None,
+                                       decode_responses=True).pubsub()
+            pubsub.subscribe(channel)
+            for message in pubsub.listen():
+                if message['type'] == 'subscribe':
+                    app.logger.info('Subscribed to {0} @ {1}'.format(
+                        channel, sharding.node_name(url)))
+                    set_subscribed(app, url, True)
+                elif message['type'] == 'message':
+                    app.cache.invalidate(message['data'])
+        except Exception:
+            app.logger.exception('Cache invalidation subscriber failed')
+        set_subscribed(app, url, False)
+        time.sleep(1)
+
+
+subscriptions = set()
+subscriptions_lock = threading.Lock()
+
+
+def set_subscribed(app, url, subscribed):
+    """ Enable the cache once subscribed to every node, else disable it """
+    with subscriptions_lock:
+        if subscribed:
+            subscriptions.add(url)
+        else:
+            subscriptions.discard(url)
+        if len(subscriptions) == len(invalidation_urls()):
+            app.cache.enable()
+        else:
+            app.cache.disable()
+
+
 # Setup application
 app = setup_logging(app)
 app = load_config(app)
 app = connect_redis(app)
 app = set_prefix(app)
+app = setup_cache(app)
+app = setup_metrics(app)
+
+
+@app.before_first_request
+def start_cache_subscriber():
+    # Started per worker process, after gunicorn has forked
+    if not app.config['CACHE_TTL'] or app.config['TESTING']:
+        return
+    for url in invalidation_urls():
+        subscriber = threading.Thread(target=listen_for_invalidations,
+                                      args=(app, url),
+                                      name='cache-invalidation')
+        subscriber.daemon = True
+        subscriber.start()
+
+
+@app.before_request
+def start_timer():
+    flask.g.request_start = time.time()
+
+
+@app.teardown_request
+def record_request_time(exc):
+    # Requests which fail to route have no endpoint
+    if not flask.request.endpoint or 'request_start' not in flask.g:
+        return
+    app.metrics.observe('web_request_seconds',
+                        time.time() - flask.g.request_start,
+                        endpoint=flask.request.endpoint)
+    try:
+        app.metrics.maybe_flush()
+    except Exception:
+        app.logger.exception('Failed to flush metrics')
 
 
 @app.route('/')
@@ -91,13 +254,68 @@ def ping():
 @app.route('/v1/list')
 def coalasce_lists():
     """
-    GET: returns a list of all coalesced objects load into the listener
+    GET: returns a page of the coalesce keys load into the listener and the
+    SSCAN cursor of the next page, 0 once all keys have been returned.
+    Optional args: cursor, count (page size hint), prefix or match (glob) to
+    filter key names, and details=1 to include each list's length and the
+    insert time of its oldest task.  Responses carry an ETag which changes
+    whenever a key is added or dropped, or with details whenever any list
+    changes.  With sharded lists the shards are scanned one
+    after another, the cursor encoding the shard along with its own cursor
     """
-    list_keys_set = app.redis.smembers(app.prefix + "list_keys")
-    if len(list_keys_set) == 0:
-        return jsonify({app.prefix: []})
-    list_keys = [x for x in list_keys_set]
-    return jsonify({app.prefix: list_keys})
+    args = flask.request.args
+    try:
+        cursor = int(args.get('cursor', 0))
+        count = min(int(args.get('count', app.config['LIST_PAGE_SIZE'])),
+                    app.config['LIST_PAGE_MAX'])
+    except ValueError:
+        return action_response('list', success=False, status_code=400)
+    if count < 1:
+        return action_response('list', success=False, status_code=400)
+    match = args.get('match')
+    if 'prefix' in args:
+        match = glob_escape(args['prefix']) + '*'
+    details = args.get('details') in ('1', 'true')
+
+    # SSCAN cursors are unsigned 64 bit integers
+    nodes = list_nodes()
+    if not 0 <= cursor // len(nodes) < 2 ** 64:
+        return action_response('list', success=False, status_code=400)
+
+    # Answer conditional requests before reading any list
+    version_key = app.prefix + ('version' if details else 'list_keys_version')
+    versions = sharding.parallel(
+        [lambda node=node: node.get(version_key) for node in nodes])
+    etag = '-'.join(str(version or 0) for version in versions)
+    if etag in flask.request.if_none_match:
+        resp = flask.Response(status=304)
+        resp.set_etag(etag)
+        return resp
+
+    shard, cursor = cursor % len(nodes), cursor // len(nodes)
+    cursor, list_keys = nodes[shard].sscan(app.prefix + "list_keys", cursor,
+                                           match=match, count=count)
+    if int(cursor):
+        cursor = int(cursor) * len(nodes) + shard
+    elif shard + 1 < len(nodes):
+        cursor = shard + 1
+    body = {app.prefix: list_keys, 'cursor': int(cursor)}
+    if details:
+        def queue(pipe, key):
+            prefix_key = app.prefix + 'tasks.' + key
+            pipe.zcard(prefix_key)
+            pipe.zrange(prefix_key, 0, 0, withscores=True)
+
+        body['lists'] = {}
+        for key, (length, oldest_task) in pipelined(list_keys, 2,
+                                                    queue).items():
+            body['lists'][key] = {
+                'length': length,
+                'oldest_task_time': oldest_task[0][1] if oldest_task else None
+            }
+    resp = jsonify(body)
+    resp.set_etag(etag)
+    return resp
 
 
 @app.route('/v1/stats')
@@ -106,10 +324,21 @@ def stats():
     GET: returns stats
     """
     prefix_key = app.prefix + 'stats'
-    stats = app.redis.hgetall(prefix_key)
+    stats = read_redis().hgetall(prefix_key)
     return flask.jsonify(stats)
 
 
+@app.route('/metrics')
+def metrics():
+    """
+    GET: returns the latency histograms recorded by all processes and the
+    stats in the Prometheus text format
+    """
+    app.metrics.flush()
+    return flask.Response(app.metrics.render(app.prefix),
+                          mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/v1/list/<int:age>/<int:size>/<key>')
 def list(age, size, key):
     """
@@ -117,35 +346,190 @@ def list(age, size, key):
     contains either an ordered list of taskIds associated with <key>, when at
     least one of those tasks is older than <age> seconds, and there are more
     than <size> entries, otherwise if either of these criteria is not met, an
-    empty list.
+    empty list.  At most the newest ?limit= taskIds are returned, and never
+    more than SUPERSEDES_MAX; a list cut short is answered with 'total', its
+    length, and 'truncated': true alongside
     """
+    try:
+        limit = parse_limit(flask.request.args.get('limit'))
+    except ValueError:
+        return action_response('list', success=False, status_code=400)
+
+    list_state = list_states([(key, age, size, limit)])[key]
+    members, truncated = answer(list_state, age, size, limit)
+    count_truncated(int(truncated))
+    return flask.Response('{%s}' % members, mimetype='application/json')
 
-    prefix_key = app.prefix + 'lists.' + key
-    empty_resp = jsonify({'supersedes': []})
-    coalesced_list = app.redis.lrange(prefix_key, 0, -1)
 
-    # Return empty resp if list is empty
-    if len(coalesced_list) == 0:
-        return empty_resp
+@app.route('/v1/supersedes', methods=['POST'])
+def bulk_supersedes():
+    """
+    POST: takes {"queries": [{"key": <key>, "age": <age>, "size": <size>},
+    ...]} and returns {"results": [{"key": <key>, "supersedes": [...]}, ...]}
+    answering each query as GET /v1/list/<age>/<size>/<key> would, in the
+    order given.  A query may carry a "limit" as ?limit= does.  The response
+    is streamed
+    """
+    body = flask.request.get_json(force=True, silent=True)
+    try:
+        queries = [(q['key'], int(q['age']), int(q['size']),
+                    parse_limit(q.get('limit')))
+                   for q in body['queries']]
+        if not all(isinstance(q[0], basestring) for q in queries):
+            raise TypeError('keys must be strings')
+    except (TypeError, KeyError, ValueError, AttributeError):
+        return action_response('supersedes', success=False, status_code=400)
+    if len(queries) > app.config['BULK_MAX_QUERIES']:
+        return action_response('supersedes', success=False, status_code=413)
+
+    states = list_states(queries)
+
+    def generate():
+        yield '{"results": ['
+        truncated = 0
+        for i, (key, age, size, limit) in enumerate(queries):
+            members, cut = answer(states[key], age, size, limit)
+            truncated += cut
+            yield '%s{"key": %s, %s}' % (
+                ', ' if i else '', json.dumps(key), members)
+        count_truncated(int(truncated))
+        yield ']}'
+
+    return flask.Response(generate(), mimetype='application/json')
+
+
+def list_states(queries):
+    """
+    Return {key: (list_size, oldest_task_age, coalesced_list)} for a list of
+    (key, age, size, limit) queries, where coalesced_list is None unless a
+    query exceeds its thresholds, and then the newest limit taskIds.  Whatever
+    the cache cannot answer takes at most two pipelined round trips: the sizes
+    and oldest tasks of the lists, then the tasks of those whose thresholds
+    are exceeded
+    """
+    states = {}
+    tokens = {}
+    for key, _, _, _ in queries:
+        if key not in states:
+            states[key] = app.cache.get(key)
+
+    # Check thresholds without fetching the lists
+    missing = [key for key, state in states.items() if state is None]
+    if missing:
+        def queue_thresholds(pipe, key):
+            prefix_key = app.prefix + 'tasks.' + key
+            pipe.zcard(prefix_key)
+            pipe.zrange(prefix_key, 0, 0, withscores=True)
+
+        for key in missing:
+            tokens[key] = app.cache.begin(key)
+        result = pipelined(missing, 2, queue_thresholds)
+        for key in missing:
+            list_size, oldest_task = result[key]
+            oldest_task_age = oldest_task[0][1] if oldest_task else None
+            states[key] = (list_size, oldest_task_age, None)
+
+    # The most taskIds any query needs of each list
+    wanted = {}
+    for key, age, size, limit in queries:
+        if not fetched(states[key], limit) and \
+                thresholds_exceeded(states[key], age, size):
+            wanted[key] = max(limit, wanted.get(key, 0))
+    if wanted:
+        def queue_list(pipe, key):
+            pipe.zrevrange(app.prefix + 'tasks.' + key, 0, wanted[key] - 1)
+
+        for key in wanted:
+            if key not in tokens:
+                tokens[key] = app.cache.begin(key)
+        for key, (coalesced_list,) in pipelined(wanted, 1,
+                                                queue_list).items():
+            states[key] = states[key][:2] + (coalesced_list,)
+
+    for key, token in tokens.items():
+        app.cache.put(key, states[key], token)
+    return states
+
+
+def supersedes(list_state, age, size):
+    """ The taskIds a query should supersede given its list state """
+    # The list was not fetched if the thresholds were not exceeded when read
+    if not list_state[2] or not thresholds_exceeded(list_state, age, size):
+        return []
+    # Thresholds have been exceeded. Return list for coalescing
+    return list_state[2]
+
 
-    # Return empty resp if taskid list is
+def fetched(list_state, limit):
+    """ True if list_state holds the newest limit taskIds of its list """
+    coalesced_list = list_state[2]
+    if coalesced_list is None:
+        return False
+    return len(coalesced_list) >= min(list_state[0], limit)
+
+
+def answer(list_state, age, size, limit):
+    """
+    The JSON members answering a query, as a string, and whether the list
+    was cut to the newest limit taskIds
+    """
+    taskIds = supersedes(list_state, age, size)
+    if not taskIds or list_state[0] <= limit:
+        return '"supersedes": ' + json.dumps(taskIds), False
+    return '"supersedes": %s, "total": %d, "truncated": true' % (
+        json.dumps(taskIds[:limit]), list_state[0]), True
+
+
+def parse_limit(value):
+    """ The taskIds a query may return given its limit, if any """
+    if value is None:
+        return app.config['SUPERSEDES_MAX']
+    limit = int(value)
+    if limit < 1:
+        raise ValueError(value)
+    return min(limit, app.config['SUPERSEDES_MAX'])
+
+
+def count_truncated(count):
+    """ Add count to the truncated_responses stat """
+    if not count:
+        return
+    try:
+        app.redis.hincrby(app.prefix + 'stats', 'truncated_responses', count)
+    except Exception:
+        app.logger.exception('Failed to count truncated responses')
+
+
+def thresholds_exceeded(list_state, age, size):
+    """
+    True if a (list_size, oldest_task_age, ...) list state has more than
+    <size> entries and its oldest task is older than <age> seconds
+    """
+    list_size, oldest_task_age = list_state[0], list_state[1]
+
+    # Empty lists never qualify
+    if list_size == 0:
+        return False
+
+    # Not met if taskid list is
     # less than or equal to the size threshold
-    if len(coalesced_list) <= size:
+    if list_size <= size:
         app.logger.debug("List does not meet size threshold")
-        return empty_resp
-
-    # Get age of oldest taskid in the list
-    oldest_task_age = app.redis.get(app.prefix +
-                                    coalesced_list[-1] + '.timestamp')
+        return False
 
-    # Return empty resp if age of the oldest taskid in list is
+    # Not met if age of the oldest taskid in list is
     # less than or equal to the age threshold
     if (time.time() - float(oldest_task_age)) <= age:
         app.logger.debug("Oldest task in list does not meet age threshold")
-        return empty_resp
+        return False
+    return True
 
-    # Thresholds have been exceeded. Return list for coalescing
-    return jsonify({'supersedes': coalesced_list})
+
+def glob_escape(value):
+    """ Escape the SSCAN MATCH pattern characters in value """
+    for char in '\\*?[]':
+        value = value.replace(char, '\\' + char)
+    return value
 
 
 def action_response(action, success=True, status_code=200):
@@ -0,0 +1,60 @@
+from taskclustercoalesce.cache import ListCache
+import unittest
+
+
+class CacheTestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = ListCache(2, 10, clock=lambda: self.now)
+        self.cache.enable()
+
+    def tearDown(self):
+        pass
+
+
+class CacheTest(CacheTestBase):
+
+    def test_get_missing(self):
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_put_get(self):
+        token = self.cache.begin('key')
+        self.cache.put('key', 'value', token)
+        self.assertEqual(self.cache.get('key'), 'value')
+
+    def test_expired(self):
+        self.cache.put('key', 'value', self.cache.begin('key'))
+        self.now = 10
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_disabled(self):
+        self.cache.put('key', 'value', self.cache.begin('key'))
+        self.cache.disable()
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.enable()
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_invalidate(self):
+        self.cache.put('key', 'value', self.cache.begin('key'))
+        self.cache.invalidate('key')
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_invalidate_during_read(self):
+        token = self.cache.begin('key')
+        self.cache.invalidate('key')
+        self.cache.put('key', 'stale', token)
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_lru_eviction(self):
+        for key in ('key1', 'key2'):
+            self.cache.put(key, key, self.cache.begin(key))
+        self.cache.get('key1')
+        self.cache.put('key3', 'key3', self.cache.begin('key3'))
+        self.assertEqual(self.cache.get('key1'), 'key1')
+        self.assertIsNone(self.cache.get('key2'))
+        self.assertEqual(self.cache.get('key3'), 'key3')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+from taskclustercoalesce.capture import MessageLog, read_log
+import unittest
+import tempfile
+import shutil
+import mock
+import imp
+import os
+
+replay = imp.load_source(
+    'replay_pulse',
+    os.path.join(os.path.dirname(__file__), '..', 'bin', 'replay_pulse.py'))
+
+BODY = {'runId': 0, 'status': {'state': 'pending', 'taskId': 'taskId1'}}
+HEADERS = {'CC': ['route.coalesce.v1.key', 'route.index.other']}
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'capture.log.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        capture = MessageLog(self.path)
+        capture.write(BODY, HEADERS)
+        capture.close()
+        records = list(read_log(self.path))
+        self.assertEqual(len(records), 1)
+        timestamp, body, headers = records[0]
+        self.assertEqual((body, headers), (BODY, HEADERS))
+
+    def test_append(self):
+        for _ in range(2):
+            capture = MessageLog(self.path)
+            capture.write(BODY, HEADERS)
+            capture.close()
+        self.assertEqual(len(list(read_log(self.path))), 2)
+
+    def test_truncated(self):
+        capture = MessageLog(self.path, flush_interval=0)
+        capture.write(BODY, HEADERS)
+        capture.write(BODY, HEADERS)
+        # Never closed, as if the listener died
+        self.assertEqual(len(list(read_log(self.path))), 2)
+
+
+class ReplayTest(unittest.TestCase):
+
+    def test_rewrite_routes(self):
+        headers = replay.rewrite_routes(HEADERS, 'replay.v1.')
+        self.assertEqual(headers['CC'],
+                         ['route.replay.v1.key', 'route.index.other'])
+        self.assertEqual(HEADERS['CC'][0], 'route.coalesce.v1.key')
+
+    def test_replay(self):
+        handled = []
+        app = type('App', (object,), {'_flush_batch': lambda self: None})()
+        records = [(1.0, BODY, HEADERS), (1.01, BODY, HEADERS)]
+        count = replay.replay(app, lambda body, message:
+                              handled.append(message.headers['CC'][0]),
+                              records, 1, 'replay.v1.')
+        self.assertEqual(count, 2)
+        self.assertEqual(handled, ['route.replay.v1.key'] * 2)
+
+    @mock.patch('time.time')
+    def test_worker_logs_merged(self, m_time):
+        directory = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(directory, 'capture.log.gz.%d' % worker)
+                     for worker in range(2)]
+            captures = [MessageLog(path) for path in paths]
+            for timestamp, worker in [(1, 0), (2, 1), (3, 0), (4, 1)]:
+                m_time.return_value = timestamp
+                captures[worker].write(BODY, HEADERS)
+            for capture in captures:
+                capture.close()
+            self.assertEqual([record[0] for record in replay.records(paths)],
+                             [1, 2, 3, 4])
+        finally:
+            shutil.rmtree(directory)
@@ -1,4 +1,5 @@
 import taskclustercoalesce.coalescer as coalescer
+import taskclustercoalesce.reaper as reaper
 from mockredis import mock_redis_client
 import unittest
 import mock
@@ -6,9 +7,12 @@ import mock
 
 class CoalescerTestBase(unittest.TestCase):
 
+    # Backend under test, run against MemoryDatastore in test_datastore
+    datastore = staticmethod(mock_redis_client)
+
     def setUp(self):
         self.prefix = u'testing.prefix.'
-        self.m_redis = mock_redis_client()
+        self.m_redis = self.datastore()
         self.m_stats = mock.Mock()
         self.coalescer = coalescer.CoalescingMachine(self.prefix,
                                                      self.m_redis,
@@ -23,18 +27,19 @@ class CoalescerTest(CoalescerTestBase):
     def test_insert_task_single_taskid_list(self):
         taskId = 'taskId1'
         self.coalescer.insert_task(taskId, 'key')
-        actual_list_members = self.m_redis.lrange(
-                self.prefix + 'lists.' + 'key', 0, -1)
+        actual_list_members = self.m_redis.zrevrange(
+                self.prefix + 'tasks.' + 'key', 0, -1)
         expected_list_members = [taskId]
         self.assertEqual(actual_list_members, expected_list_members)
 
-    def test_insert_task_multi_taskid_list(self):
+    @mock.patch('time.time', side_effect=[1, 2, 3])
+    def test_insert_task_multi_taskid_list(self, m_time):
         taskId1, taskId2, taskId3 = 'taskId1', 'taskId2', 'taskId3'
         self.coalescer.insert_task(taskId1, 'key')
         self.coalescer.insert_task(taskId2, 'key')
         self.coalescer.insert_task(taskId3, 'key')
-        actual_list_members = self.m_redis.lrange(
-                self.prefix + 'lists.' + 'key', 0, -1)
+        actual_list_members = self.m_redis.zrevrange(
+                self.prefix + 'tasks.' + 'key', 0, -1)
         expected_list_members = [taskId3, taskId2, taskId1]
         self.assertEqual(actual_list_members, expected_list_members)
 
@@ -64,20 +69,20 @@ class CoalescerTest(CoalescerTestBase):
         self.assertEqual(actual_set_members, expected_set_members)
 
     def test_remove_task_single_taskid_list(self):
-        prefix = self.prefix + 'lists.' + 'key'
+        prefix = self.prefix + 'tasks.' + 'key'
         taskId = 'taskId'
-        self.m_redis.lpush(prefix, taskId)
+        self.m_redis.zadd(prefix, taskId, 1)
         self.coalescer.remove_task(taskId, 'key')
-        actual_list_members = self.m_redis.lrange(prefix, 0, -1)
+        actual_list_members = self.m_redis.zrevrange(prefix, 0, -1)
         expected_list_members = []
         self.assertEqual(actual_list_members, expected_list_members)
 
     def test_remove_task_multi_taskid_list(self):
-        prefix = self.prefix + 'lists.' + 'key'
+        prefix = self.prefix + 'tasks.' + 'key'
         taskId1, taskId2, taskId3 = 'taskId1', 'taskId2', 'taskId3'
-        self.m_redis.lpush(prefix, taskId1, taskId2, taskId3)
+        self.m_redis.zadd(prefix, taskId1, 1, taskId2, 2, taskId3, 3)
         self.coalescer.remove_task(taskId2, 'key')
-        actual_list_members = self.m_redis.lrange(prefix, 0, -1)
+        actual_list_members = self.m_redis.zrevrange(prefix, 0, -1)
         expected_list_members = [taskId3, taskId1]
         self.assertEqual(actual_list_members, expected_list_members)
 
@@ -100,9 +105,9 @@ class CoalescerTest(CoalescerTestBase):
         self.assertEqual(actual_set_members, expected_set_members)
 
     def test_remove_task_nonexistent_key(self):
-        prefix = self.prefix + 'lists.' + 'key'
+        prefix = self.prefix + 'tasks.' + 'key'
         self.coalescer.remove_task('taskId', 'key')
-        actual_list_members = self.m_redis.lrange(prefix, 0, -1)
+        actual_list_members = self.m_redis.zrevrange(prefix, 0, -1)
         expected_list_members = []
         self.assertEqual(actual_list_members, expected_list_members)
 
@@ -112,3 +117,409 @@ class CoalescerTest(CoalescerTestBase):
         actual_set_members = self.m_redis.smembers(prefix)
         expected_set_members = set([])
         self.assertEqual(actual_set_members, expected_set_members)
+
+    @mock.patch('time.time')
+    def test_insert_task_scores_timestamp(self, m_time):
+        m_time.return_value = 42.0
+        self.coalescer.insert_task('taskId1', 'key')
+        timestamp = self.m_redis.zscore(self.prefix + 'tasks.key', 'taskId1')
+        self.assertEqual(timestamp, 42.0)
+
+    def test_insert_task_no_timestamp_key(self):
+        self.coalescer.insert_task('taskId1', 'key')
+        self.assertEqual(self.m_redis.keys(self.prefix + '*.timestamp'), [])
+
+    def test_insert_task_updates_coalesced_lists(self):
+        self.m_stats.get.return_value = 0
+        self.coalescer.insert_task('taskId1', 'key')
+        self.m_stats.set.assert_called_once_with('coalesced_lists', 1)
+
+    def test_insert_task_unchanged_coalesced_lists(self):
+        self.m_stats.get.return_value = 1
+        self.m_redis.sadd(self.prefix + 'list_keys', 'key')
+        self.coalescer.insert_task('taskId1', 'key')
+        self.assertFalse(self.m_stats.set.called)
+
+    def test_remove_task_last_updates_coalesced_lists(self):
+        self.m_stats.get.return_value = 1
+        self.coalescer.insert_task('taskId1', 'key')
+        self.coalescer.remove_task('taskId1', 'key')
+        self.m_stats.set.assert_called_once_with('coalesced_lists', 0)
+
+    def test_insert_task_publishes_key(self):
+        with mock.patch.object(self.m_redis, 'publish') as m_publish:
+            self.coalescer.insert_task('taskId1', 'key')
+        m_publish.assert_called_once_with(self.prefix + 'invalidate', 'key')
+
+    def test_remove_task_publishes_key(self):
+        with mock.patch.object(self.m_redis, 'publish') as m_publish:
+            self.coalescer.remove_task('taskId1', 'key')
+        m_publish.assert_called_once_with(self.prefix + 'invalidate', 'key')
+
+
+class CoalescerBatchTest(CoalescerTestBase):
+
+    @mock.patch('time.time', side_effect=[1, 2, 3])
+    def test_apply_events_inserts(self, m_time):
+        self.coalescer.apply_events([('insert', 'taskId1', 'key1'),
+                                     ('insert', 'taskId2', 'key2'),
+                                     ('insert', 'taskId3', 'key1')])
+        self.assertEqual(
+            self.m_redis.zrevrange(self.prefix + 'tasks.key1', 0, -1),
+            ['taskId3', 'taskId1'])
+        self.assertEqual(
+            self.m_redis.zrevrange(self.prefix + 'tasks.key2', 0, -1),
+            ['taskId2'])
+        self.assertEqual(self.m_redis.smembers(self.prefix + 'list_keys'),
+                         set(['key1', 'key2']))
+
+    @mock.patch('time.time', side_effect=[1, 2, 3, 4])
+    def test_apply_events_removes(self, m_time):
+        self.coalescer.insert_task('taskId1', 'key1')
+        self.coalescer.insert_task('taskId2', 'key1')
+        self.coalescer.insert_task('taskId3', 'key2')
+        self.coalescer.apply_events([('remove', 'taskId1', 'key1'),
+                                     ('remove', 'taskId3', 'key2')])
+        self.assertEqual(
+            self.m_redis.zrevrange(self.prefix + 'tasks.key1', 0, -1),
+            ['taskId2'])
+        self.assertEqual(self.m_redis.smembers(self.prefix + 'list_keys'),
+                         set(['key1']))
+        self.assertEqual(
+            self.m_redis.zrevrange(self.prefix + 'tasks.key2', 0, -1), [])
+
+    def test_apply_events_insert_then_remove(self):
+        self.coalescer.apply_events([('insert', 'taskId1', 'key1'),
+                                     ('insert', 'taskId2', 'key1'),
+                                     ('remove', 'taskId1', 'key1')])
+        self.assertEqual(
+            self.m_redis.zrevrange(self.prefix + 'tasks.key1', 0, -1),
+            ['taskId2'])
+
+    def test_apply_events_redelivered_insert_then_remove(self):
+        self.coalescer.insert_task('taskId1', 'key1')
+        # The pending event redelivered in the batch of its completion
+        self.coalescer.apply_events([('insert', 'taskId1', 'key1'),
+                                     ('remove', 'taskId1', 'key1')])
+        self.assertEqual(
+            self.m_redis.zrevrange(self.prefix + 'tasks.key1', 0, -1), [])
+        self.assertIsNotNone(
+            self.m_redis.zscore(self.prefix + 'tombstones', 'taskId1'))
+        self.assertEqual(self.m_redis.smembers(self.prefix + 'list_keys'),
+                         set([]))
+
+    def test_apply_events_empties_list(self):
+        self.coalescer.apply_events([('insert', 'taskId1', 'key1'),
+                                     ('remove', 'taskId1', 'key1')])
+        self.assertEqual(self.m_redis.smembers(self.prefix + 'list_keys'),
+                         set([]))
+
+    def test_apply_events_unknown_action(self):
+        with self.assertRaises(ValueError):
+            self.coalescer.apply_events([('bogus', 'taskId1', 'key1')])
+
+
+class CoalescerVersionTest(CoalescerTestBase):
+
+    def version(self):
+        return int(self.m_redis.get(self.prefix + 'version') or 0)
+
+    def test_changes_increment_version(self):
+        self.coalescer.insert_task('taskId1', 'key')
+        self.assertEqual(self.version(), 1)
+        self.coalescer.apply_events([('insert', 'taskId2', 'key'),
+                                     ('insert', 'taskId3', 'key2')])
+        self.assertEqual(self.version(), 2)
+        self.coalescer.remove_task('taskId1', 'key')
+        self.assertEqual(self.version(), 3)
+
+    def test_dropping_list_increments_version(self):
+        self.coalescer.insert_task('taskId1', 'key')
+        self.coalescer.remove_task('taskId1', 'key')
+        # Removing the task and then the emptied list
+        self.assertEqual(self.version(), 3)
+
+    def test_list_keys_version(self):
+        def list_keys_version():
+            return int(self.m_redis.get(self.prefix + 'list_keys_version') or
+                       0)
+
+        self.coalescer.insert_task('taskId1', 'key')
+        self.assertEqual(list_keys_version(), 1)
+        self.coalescer.apply_events([('insert', 'taskId2', 'key'),
+                                     ('insert', 'taskId3', 'key2')])
+        self.assertEqual(list_keys_version(), 2)
+        self.coalescer.remove_task('taskId1', 'key')
+        self.assertEqual(list_keys_version(), 2)
+        self.coalescer.remove_task('taskId2', 'key')
+        self.assertEqual(list_keys_version(), 3)
+        self.coalescer.restore_lists({'key2': {'taskId3': 10.0}})
+        self.assertEqual(list_keys_version(), 3)
+        self.coalescer.restore_lists({'key3': {'taskId4': 10.0}})
+        self.assertEqual(list_keys_version(), 4)
+
+
+class CoalescerMetricsTest(CoalescerTestBase):
+
+    def test_redis_calls_timed(self):
+        m_metrics = mock.MagicMock()
+        self.coalescer.metrics = m_metrics
+        self.coalescer.insert_task('taskId1', 'key')
+        self.coalescer.remove_task('taskId1', 'key')
+        self.assertEqual(
+            [c[2] for c in m_metrics.time.mock_calls if c[2]],
+            [{'op': 'insert'}, {'op': 'index'}, {'op': 'remove'},
+             {'op': 'remove_list_key'}])
+
+
+class CoalescerExpiryTest(CoalescerTestBase):
+
+    def setUp(self):
+        super(CoalescerExpiryTest, self).setUp()
+        self.coalescer = coalescer.CoalescingMachine(self.prefix,
+                                                     self.m_redis,
+                                                     self.m_stats,
+                                                     ttl=100)
+
+    @mock.patch('time.time', side_effect=[1, 60, 150])
+    def test_insert_task_trims_expired(self, m_time):
+        self.coalescer.insert_task('taskId1', 'key')
+        self.coalescer.insert_task('taskId2', 'key')
+        self.coalescer.insert_task('taskId3', 'key')
+        self.assertEqual(
+            self.m_redis.zrevrange(self.prefix + 'tasks.key', 0, -1),
+            ['taskId3', 'taskId2'])
+        self.m_stats.notch.assert_called_once_with('reaped', 1)
+
+    def test_insert_task_sets_expiry(self):
+        self.coalescer.insert_task('taskId1', 'key')
+        ttl = self.m_redis.ttl(self.prefix + 'tasks.key')
+        self.assertTrue(100 < ttl <= 200)
+
+    @mock.patch('time.time', side_effect=[1, 150])
+    def test_apply_events_trims_expired(self, m_time):
+        self.coalescer.insert_task('taskId1', 'key')
+        self.coalescer.apply_events([('insert', 'taskId2', 'key')])
+        self.assertEqual(
+            self.m_redis.zrevrange(self.prefix + 'tasks.key', 0, -1),
+            ['taskId2'])
+        self.m_stats.notch.assert_called_once_with('reaped', 1)
+
+    @mock.patch('time.time', side_effect=[1, 2, 3, 150])
+    def test_apply_events_counts_trimmed(self, m_time):
+        self.coalescer.insert_task('taskId0', 'key1')
+        self.coalescer.insert_task('taskId1', 'key1')
+        self.coalescer.insert_task('taskId2', 'key2')
+        self.coalescer.apply_events([('remove', 'taskId3', 'key3'),
+                                     ('insert', 'taskId4', 'key1'),
+                                     ('insert', 'taskId5', 'key2')])
+        self.m_stats.notch.assert_any_call('reaped', 3)
+
+
+class CoalescerReapTest(CoalescerTestBase):
+
+    def setUp(self):
+        super(CoalescerReapTest, self).setUp()
+        self.coalescer = coalescer.CoalescingMachine(
+            self.prefix, self.m_redis, self.m_stats, ttl=100,
+            deadlines={'try.': 10, 'try.slow.': 50})
+
+    def index(self):
+        return dict(self.m_redis.zrange(self.prefix + 'age_index', 0, -1,
+                                        withscores=True))
+
+    def test_deadline(self):
+        self.assertEqual(self.coalescer.deadline('central.key'), 100)
+        self.assertEqual(self.coalescer.deadline('try.key'), 10)
+        self.assertEqual(self.coalescer.deadline('try.slow.key'), 50)
+
+    @mock.patch('time.time', side_effect=[1, 5])
+    def test_insert_indexes_new_list(self, m_time):
+        self.coalescer.insert_task('taskId1', 'try.key')
+        self.coalescer.insert_task('taskId2', 'try.key')
+        # Only the first insert schedules the list
+        self.assertEqual(self.index(), {'try.key': 11})
+
+    @mock.patch('time.time', side_effect=[1, 5])
+    def test_apply_events_indexes_new_lists(self, m_time):
+        self.coalescer.insert_task('taskId1', 'try.key')
+        self.coalescer.apply_events([('insert', 'taskId2', 'try.key'),
+                                     ('insert', 'taskId3', 'key')])
+        self.assertEqual(self.index(), {'try.key': 11, 'key': 105})
+
+    @mock.patch('time.time', side_effect=[1, 5, 20])
+    def test_reap_expired(self, m_time):
+        self.coalescer.insert_task('taskId1', 'try.key')
+        self.coalescer.insert_task('taskId2', 'try.key')
+        self.coalescer.insert_task('taskId3', 'key')
+        with mock.patch('time.time', return_value=12):
+            self.assertEqual(self.coalescer.reap_expired(), (1, 1))
+        self.assertEqual(
+            self.m_redis.zrange(self.prefix + 'tasks.try.key', 0, -1),
+            ['taskId2'])
+        # Rescheduled by the remaining task, the other list was not due
+        self.assertEqual(self.index(), {'try.key': 15, 'key': 120})
+        self.m_stats.notch.assert_called_with('reaped', 1)
+
+    @mock.patch('time.time', side_effect=[1])
+    def test_reap_expired_drops_empty_list(self, m_time):
+        self.coalescer.insert_task('taskId1', 'try.key')
+        with mock.patch('time.time', return_value=20):
+            self.assertEqual(self.coalescer.reap_expired(), (1, 1))
+        self.assertEqual(self.m_redis.smembers(self.prefix + 'list_keys'),
+                         set([]))
+        self.assertEqual(self.index(), {})
+
+    def test_reap_expired_nothing_due(self):
+        self.coalescer.insert_task('taskId1', 'key')
+        self.assertEqual(self.coalescer.reap_expired(), (0, 0))
+        self.assertFalse(self.m_stats.notch.called)
+
+    @mock.patch('time.time', return_value=1)
+    def test_reap_past_lists_with_nothing_stale(self, m_time):
+        self.coalescer.reap_batch = 1
+        for coalesce_key in ('key1', 'key2', 'key3'):
+            self.coalescer.insert_task('taskId1', coalesce_key)
+        self.coalescer.insert_task('taskId2', 'key3')
+        # The oldest tasks of key1 and key2 completed, key3's went stale
+        self.m_redis.zadd(self.prefix + 'tasks.key3', 'taskId1', -200)
+        self.m_redis.zadd(self.prefix + 'age_index', 'key1', 0, 'key2', 0,
+                          'key3', 0)
+        self.assertEqual(reaper.reap(self.coalescer), 1)
+        self.assertEqual(self.index(),
+                         {'key1': 101, 'key2': 101, 'key3': 101})
+
+    def test_remove_task_unindexes_list(self):
+        self.coalescer.insert_task('taskId1', 'key')
+        self.coalescer.remove_task('taskId1', 'key')
+        self.assertEqual(self.index(), {})
+
+    def test_build_age_index(self):
+        self.m_redis.sadd(self.prefix + 'list_keys', 'try.key', 'key')
+        self.m_redis.zadd(self.prefix + 'tasks.try.key', 'taskId1', 3)
+        self.m_redis.zadd(self.prefix + 'age_index', 'key', 7)
+        self.assertEqual(self.coalescer.build_age_index(), 1)
+        self.assertEqual(self.index(), {'try.key': 13, 'key': 7})
+
+
+class CoalescerTombstoneTest(CoalescerTestBase):
+
+    def test_remove_before_insert(self):
+        self.coalescer.remove_task('taskId1', 'key')
+        self.coalescer.insert_task('taskId1', 'key')
+        self.assertEqual(
+            self.m_redis.zrevrange(self.prefix + 'tasks.key', 0, -1), [])
+        self.assertEqual(self.m_redis.smembers(self.prefix + 'list_keys'),
+                         set([]))
+
+    def test_remove_before_insert_other_tasks(self):
+        self.coalescer.insert_task('taskId2', 'key')
+        self.coalescer.remove_task('taskId1', 'key')
+        self.coalescer.insert_task('taskId1', 'key')
+        self.assertEqual(
+            self.m_redis.zrevrange(self.prefix + 'tasks.key', 0, -1),
+            ['taskId2'])
+
+    def test_apply_events_remove_before_insert(self):
+        self.coalescer.apply_events([('remove', 'taskId1', 'key')])
+        self.coalescer.apply_events([('insert', 'taskId1', 'key'),
+                                     ('insert', 'taskId2', 'key')])
+        self.assertEqual(
+            self.m_redis.zrevrange(self.prefix + 'tasks.key', 0, -1),
+            ['taskId2'])
+
+    @mock.patch('time.time')
+    def test_tombstone_expires(self, m_time):
+        self.coalescer = coalescer.CoalescingMachine(self.prefix,
+                                                     self.m_redis,
+                                                     self.m_stats,
+                                                     tombstone_ttl=10)
+        m_time.return_value = 100
+        self.coalescer.remove_task('taskId1', 'key')
+        m_time.return_value = 200
+        self.coalescer.remove_task('taskId2', 'key')
+        self.assertEqual(
+            self.m_redis.zrange(self.prefix + 'tombstones', 0, -1),
+            ['taskId2'])
+
+    def test_tombstone_max(self):
+        self.coalescer = coalescer.CoalescingMachine(self.prefix,
+                                                     self.m_redis,
+                                                     self.m_stats,
+                                                     tombstone_max=2)
+        with mock.patch('time.time', side_effect=[1, 2, 3]):
+            for taskId in ('taskId1', 'taskId2', 'taskId3'):
+                self.coalescer.remove_task(taskId, 'key')
+        self.assertEqual(
+            self.m_redis.zrange(self.prefix + 'tombstones', 0, -1),
+            ['taskId2', 'taskId3'])
+
+    def test_premature_counted(self):
+        self.coalescer.remove_task('taskId1', 'key')
+        self.m_stats.reset_mock()
+        self.coalescer.insert_task('taskId1', 'key')
+        self.m_stats.notch.assert_called_once_with('premature')
+
+    def test_unknown_task_counted(self):
+        self.coalescer.remove_task('taskId1', 'key')
+        self.m_stats.notch.assert_called_once_with('unknown_tasks')
+
+    def test_known_task_not_counted(self):
+        self.coalescer.insert_task('taskId1', 'key')
+        self.coalescer.remove_task('taskId1', 'key')
+        self.assertFalse(self.m_stats.notch.called)
+
+    def test_apply_events_premature_counted(self):
+        self.coalescer.remove_task('taskId2', 'other')
+        self.m_stats.reset_mock()
+        self.coalescer.apply_events([('insert', 'taskId2', 'other')])
+        self.m_stats.notch.assert_called_once_with('premature', 1)
+
+    def test_apply_events_in_batch_premature_counted(self):
+        self.coalescer.apply_events([('remove', 'taskId1', 'key'),
+                                     ('insert', 'taskId1', 'key')])
+        self.m_stats.notch.assert_any_call('premature', 1)
+        self.assertEqual(
+            self.m_redis.zrevrange(self.prefix + 'tasks.key', 0, -1), [])
+
+    def test_apply_events_unknown_counted(self):
+        self.coalescer.insert_task('taskId1', 'key')
+        self.coalescer.apply_events([('remove', 'taskId1', 'key'),
+                                     ('remove', 'taskId2', 'key'),
+                                     ('insert', 'taskId3', 'key'),
+                                     ('remove', 'taskId3', 'key')])
+        self.m_stats.notch.assert_called_once_with('unknown_tasks', 1)
+
+
+class CoalescerMigrateTest(CoalescerTestBase):
+
+    @mock.patch('time.time')
+    def test_migrate_lists(self, m_time):
+        m_time.return_value = 20.0
+        self.m_redis.sadd(self.prefix + 'list_keys', 'key')
+        self.m_redis.lpush(self.prefix + 'lists.key', 'taskId1', 'taskId2')
+        self.m_redis.set(self.prefix + 'taskId1.timestamp', 5)
+        self.m_redis.set(self.prefix + 'taskId2.timestamp', 10)
+        self.assertEqual(self.coalescer.migrate_lists(), 2)
+        self.assertEqual(
+            self.m_redis.zrevrange(self.prefix + 'tasks.key', 0, -1,
+                                   withscores=True),
+            [('taskId2', 10.0), ('taskId1', 5.0)])
+        self.assertEqual(self.m_redis.keys(self.prefix + 'lists.*'), [])
+        self.assertEqual(self.m_redis.keys(self.prefix + '*.timestamp'), [])
+
+    @mock.patch('time.time')
+    def test_migrate_lists_missing_timestamp(self, m_time):
+        m_time.return_value = 20.0
+        self.m_redis.sadd(self.prefix + 'list_keys', 'key')
+        self.m_redis.lpush(self.prefix + 'lists.key', 'taskId1')
+        self.coalescer.migrate_lists()
+        self.assertEqual(
+            self.m_redis.zscore(self.prefix + 'tasks.key', 'taskId1'), 20.0)
+
+    def test_migrate_lists_already_migrated(self):
+        self.coalescer.insert_task('taskId1', 'key')
+        self.assertEqual(self.coalescer.migrate_lists(), 0)
+        self.assertEqual(
+            self.m_redis.zrevrange(self.prefix + 'tasks.key', 0, -1),
+            ['taskId1'])
@@ -0,0 +1,185 @@
+from taskclustercoalesce.datastore import MemoryDatastore, COMMANDS, \
+    connect, glob_regex
+import unittest
+import redis
+
+import test_coalesce
+import test_listener
+import test_metrics
+import test_stats
+import test_web_api
+
+
+class MemoryDatastoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.rds = MemoryDatastore(clock=lambda: self.now)
+
+    def test_commands_match_redis(self):
+        for command in COMMANDS:
+            self.assertTrue(hasattr(redis.Redis, command), command)
+            self.assertTrue(hasattr(self.rds, command), command)
+
+    def test_connect(self):
+        self.assertIsInstance(connect('memory'), MemoryDatastore)
+        self.assertRaises(ValueError, connect, 'mongodb')
+
+    def test_zset_order(self):
+        self.assertEqual(self.rds.zadd('z', 'b', 2, 'a', 1, 'c', 3), 3)
+        self.assertEqual(self.rds.zadd('z', 'a', 4), 0)
+        self.assertEqual(self.rds.zrange('z', 0, -1), ['b', 'c', 'a'])
+        self.assertEqual(self.rds.zrevrange('z', 0, 0, withscores=True),
+                         [('a', 4.0)])
+        self.assertEqual(self.rds.zrange('z', -2, -1), ['c', 'a'])
+
+    def test_zset_score_ranges(self):
+        self.rds.zadd('z', 'a', 1, 'b', 2, 'c', 2, 'd', 3)
+        self.assertEqual(self.rds.zrangebyscore('z', 2, 2), ['b', 'c'])
+        self.assertEqual(self.rds.zrangebyscore('z', '-inf', '+inf',
+                                                start=1, num=2), ['b', 'c'])
+        self.assertEqual(self.rds.zremrangebyscore('z', '-inf', 2), 3)
+        self.assertEqual(self.rds.zrange('z', 0, -1), ['d'])
+
+    def test_zremrangebyrank(self):
+        self.rds.zadd('z', 'a', 1, 'b', 2, 'c', 3)
+        self.assertEqual(self.rds.zremrangebyrank('z', 0, -3), 1)
+        self.assertEqual(self.rds.zrange('z', 0, -1), ['b', 'c'])
+
+    def test_empty_collections_removed(self):
+        self.rds.zadd('z', 'a', 1)
+        self.rds.sadd('s', 'a')
+        self.rds.zrem('z', 'a')
+        self.rds.srem('s', 'a')
+        self.assertFalse(self.rds.exists('z'))
+        self.assertFalse(self.rds.exists('s'))
+
+    def test_expiry(self):
+        self.rds.set('key', 'value', ex=10)
+        self.assertEqual(self.rds.ttl('key'), 10)
+        self.now += 10
+        self.assertIsNone(self.rds.get('key'))
+        self.assertIsNone(self.rds.ttl('key'))
+
+    def test_wrong_type(self):
+        self.rds.sadd('s', 'a')
+        self.assertRaises(TypeError, self.rds.zadd, 's', 'a', 1)
+
+    def test_hash_values_as_strings(self):
+        self.assertEqual(self.rds.hincrby('h', 'count', 2), 2)
+        self.assertEqual(self.rds.hincrbyfloat('h', 'sum', 0.5), 0.5)
+        self.rds.hincrbyfloat('h', 'sum', 0.5)
+        self.assertEqual(self.rds.hgetall('h'), {'count': '2', 'sum': '1'})
+
+    def test_pipeline(self):
+        pipe = self.rds.pipeline()
+        pipe.sadd('s', 'a').incr('version')
+        pipe.scard('s')
+        self.assertEqual(self.rds.scard('s'), 0)
+        self.assertEqual(pipe.execute(), [1, 1, 1])
+
+    def test_transaction(self):
+        self.rds.zadd('z', 'a', 1)
+
+        def drop_if_empty(pipe):
+            if pipe.zcard('z') == 0:
+                pipe.multi()
+                pipe.srem('s', 'z')
+
+        self.assertEqual(self.rds.transaction(drop_if_empty, 'z'), [])
+        self.rds.zrem('z', 'a')
+        self.assertEqual(self.rds.transaction(drop_if_empty, 'z'), [0])
+
+    def test_sscan_pages(self):
+        members = set('key.%d' % i for i in range(100))
+        self.rds.sadd('s', *members)
+        seen = []
+        cursor = 0
+        while True:
+            cursor, page = self.rds.sscan('s', cursor, count=7)
+            self.assertTrue(len(page) <= 8)
+            seen.extend(page)
+            # Members removed mid-scan do not cause others to be skipped
+            self.rds.srem('s', *page[:2])
+            if not cursor:
+                break
+        self.assertEqual(sorted(seen), sorted(members))
+
+    def test_sscan_match(self):
+        self.rds.sadd('s', 'a*b', 'axb', 'c')
+        self.assertEqual(sorted(self.rds.sscan_iter('s', match='a*')),
+                         ['a*b', 'axb'])
+        self.assertEqual(list(self.rds.sscan_iter('s', match='a\\*b')),
+                         ['a*b'])
+
+    def test_glob_regex(self):
+        self.assertTrue(glob_regex('h?llo').match('hello'))
+        self.assertTrue(glob_regex('h[ae]llo').match('hallo'))
+        self.assertFalse(glob_regex('h[^e]llo').match('hello'))
+        self.assertFalse(glob_regex('hello').match('hello world'))
+
+
+# The backend agnostic suites, run again against MemoryDatastore
+
+class MemoryCoalescerTest(test_coalesce.CoalescerTest):
+    datastore = MemoryDatastore
+
+
+class MemoryCoalescerBatchTest(test_coalesce.CoalescerBatchTest):
+    datastore = MemoryDatastore
+
+
+class MemoryCoalescerVersionTest(test_coalesce.CoalescerVersionTest):
+    datastore = MemoryDatastore
+
+
+class MemoryCoalescerMetricsTest(test_coalesce.CoalescerMetricsTest):
+    datastore = MemoryDatastore
+
+
+class MemoryCoalescerExpiryTest(test_coalesce.CoalescerExpiryTest):
+    datastore = MemoryDatastore
+
+
+class MemoryCoalescerReapTest(test_coalesce.CoalescerReapTest):
+    datastore = MemoryDatastore
+
+
+class MemoryCoalescerTombstoneTest(test_coalesce.CoalescerTombstoneTest):
+    datastore = MemoryDatastore
+
+
+class MemoryStatsTest(test_stats.StatsTest):
+    datastore = MemoryDatastore
+
+
+class MemoryMetricsTest(test_metrics.MetricsTest):
+    datastore = MemoryDatastore
+
+
+class MemoryTaskEventAppTest(test_listener.TaskEventAppTest):
+    datastore = MemoryDatastore
+
+
+class MemoryWebTestCase(test_web_api.WebTestCase):
+    datastore = MemoryDatastore
+
+
+class MemoryWebMetricsTestCase(test_web_api.WebMetricsTestCase):
+    datastore = MemoryDatastore
+
+
+class MemoryWebListKeysTestCase(test_web_api.WebListKeysTestCase):
+    datastore = MemoryDatastore
+
+
+class MemoryWebBulkTestCase(test_web_api.WebBulkTestCase):
+    datastore = MemoryDatastore
+
+
+class MemoryWebLimitTestCase(test_web_api.WebLimitTestCase):
+    datastore = MemoryDatastore
+
+
+class MemoryWebCacheTestCase(test_web_api.WebCacheTestCase):
+    datastore = MemoryDatastore
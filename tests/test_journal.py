@@ -0,0 +1,224 @@
+from taskclustercoalesce import journal
+import taskclustercoalesce.coalescer as coalescer
+import taskclustercoalesce.listener as listener
+from mockredis import mock_redis_client
+import unittest
+import tempfile
+import shutil
+import mock
+import os
+
+PREFIX = 'testing.prefix.'
+
+
+def deadline(prefix, coalesce_key):
+    return 100
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.journal = journal.Journal(self.dir, deadline, segment_records=2,
+                                       compact_segments=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def load(self, now=50):
+        return journal.load(self.dir, deadline, now=now)
+
+    def test_round_trip(self):
+        self.journal.append('+', PREFIX, 'key', ['taskId1', 'taskId2'], 10)
+        self.journal.append('-', PREFIX, 'key', ['taskId1'], 20)
+        self.journal.flush()
+        self.assertEqual(self.load(),
+                         {PREFIX: {'key': {'taskId2': 10}}})
+
+    def test_rotate(self):
+        self.journal.append('+', PREFIX, 'key', ['taskId1', 'taskId2'], 10)
+        self.journal.append('+', PREFIX, 'key', ['taskId3'], 10)
+        self.assertEqual(
+            [seq for seq, _ in journal.segments(self.dir, 'journal')],
+            [1, 2])
+
+    def test_restart_starts_new_segment(self):
+        self.journal.append('+', PREFIX, 'key', ['taskId1'], 10)
+        self.journal.close()
+        self.journal = journal.Journal(self.dir, deadline)
+        self.assertEqual(self.journal.seq, 2)
+        self.assertEqual(self.load(), {PREFIX: {'key': {'taskId1': 10}}})
+
+    def test_compact(self):
+        self.journal.append('+', PREFIX, 'key', ['taskId1', 'taskId2'], 10)
+        self.journal.append('-', PREFIX, 'key', ['taskId1', 'taskId3'], 20)
+        self.journal.append('+', PREFIX, 'other', ['taskId4'], 30)
+        self.assertEqual(self.journal.compact(now=50), 2)
+        self.assertEqual(len(journal.segments(self.dir)), 1)
+        through, lists, tombstones = journal.read_snapshot(
+            self.journal.snapshot_path())
+        self.assertEqual(through, 2)
+        self.assertEqual(lists, {(PREFIX, 'key'): {'taskId2': 10}})
+        # taskId3 was never inserted here, another journal may hold it
+        self.assertEqual(tombstones, {(PREFIX, 'key'): {'taskId3': 20}})
+        self.journal.flush()
+        self.assertEqual(self.load(), {PREFIX: {'key': {'taskId2': 10},
+                                                'other': {'taskId4': 30}}})
+
+    def test_compact_drops_stale(self):
+        self.journal.append('+', PREFIX, 'key', ['taskId1'], 10)
+        self.journal.append('+', PREFIX, 'key', ['taskId2'], 90)
+        self.journal.compact(now=150)
+        _, lists, _ = journal.read_snapshot(self.journal.snapshot_path())
+        self.assertEqual(lists, {(PREFIX, 'key'): {'taskId2': 90}})
+
+    def test_compacts_in_background(self):
+        self.journal.compact_segments = 2
+        self.journal.append('+', PREFIX, 'key', ['taskId1', 'taskId2'], 10)
+        self.journal.append('+', PREFIX, 'key', ['taskId3', 'taskId4'], 10)
+        self.journal.compactor.join()
+        self.assertTrue(os.path.exists(self.journal.snapshot_path()))
+        self.assertEqual(len(journal.segments(self.dir)), 1)
+
+    def test_truncated_segment(self):
+        self.journal.append('+', PREFIX, 'key', ['taskId1'], 10)
+        self.journal.file.write('20.0\t+\ttesting')
+        self.journal.flush()
+        self.assertEqual(self.load(), {PREFIX: {'key': {'taskId1': 10}}})
+
+    def test_load_merges_journals(self):
+        other = journal.Journal(self.dir, deadline, name='journal.1')
+        self.journal.append('+', PREFIX, 'key', ['taskId1', 'taskId2'], 10)
+        other.append('-', PREFIX, 'key', ['taskId1'], 20)
+        # A rerun inserted after its earlier removal stays
+        other.append('-', PREFIX, 'key', ['taskId3'], 20)
+        self.journal.append('+', PREFIX, 'key', ['taskId3'], 30)
+        other.compact(now=50)
+        self.journal.flush()
+        other.flush()
+        self.assertEqual(self.load(),
+                         {PREFIX: {'key': {'taskId2': 10, 'taskId3': 30}}})
+
+
+class CoalescerJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.journal = journal.Journal(self.dir, deadline)
+        self.m_redis = mock_redis_client()
+        self.m_stats = mock.Mock()
+        self.coalescer = coalescer.CoalescingMachine(
+            PREFIX, self.m_redis, self.m_stats, journal=self.journal)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def logged(self):
+        self.journal.flush()
+        return [record[1:] for _, path in journal.segments(self.dir)
+                for record in journal.read_segment(path)]
+
+    def test_insert_and_remove_logged(self):
+        self.coalescer.insert_task('taskId1', 'key')
+        self.coalescer.remove_task('taskId1', 'key')
+        self.assertEqual(self.logged(),
+                         [['+', PREFIX, 'key', 'taskId1'],
+                          ['-', PREFIX, 'key', 'taskId1']])
+
+    def test_apply_events_logged(self):
+        self.coalescer.insert_task('taskId1', 'key')
+        self.coalescer.apply_events([('remove', 'taskId1', 'key'),
+                                     ('insert', 'taskId2', 'key'),
+                                     ('insert', 'taskId3', 'key'),
+                                     ('remove', 'taskId3', 'key')])
+        # taskId3's insert is cancelled, its removal still logged
+        self.assertEqual(self.logged()[1:],
+                         [['-', PREFIX, 'key', 'taskId1'],
+                          ['-', PREFIX, 'key', 'taskId3'],
+                          ['+', PREFIX, 'key', 'taskId2']])
+
+    def test_premature_insert_logged_as_removed(self):
+        self.coalescer.remove_task('taskId1', 'key')
+        self.coalescer.insert_task('taskId1', 'key')
+        self.assertEqual(
+            journal.load(self.dir, deadline, now=self.journal.last_flush),
+            {})
+
+    def test_restore_lists(self):
+        self.coalescer.restore_batch = 1
+        restored = self.coalescer.restore_lists({
+            'key1': {'taskId1': 10, 'taskId2': 20},
+            'key2': {'taskId3': 30},
+            'key3': {}})
+        self.assertEqual(restored, 3)
+        self.assertEqual(self.m_redis.zrange(PREFIX + 'tasks.key1', 0, -1,
+                                             withscores=True),
+                         [('taskId1', 10), ('taskId2', 20)])
+        self.assertEqual(self.m_redis.smembers(PREFIX + 'list_keys'),
+                         set(['key1', 'key2']))
+        self.assertEqual(self.m_redis.zscore(PREFIX + 'age_index', 'key1'),
+                         10 + self.coalescer.ttl)
+        self.m_stats.set.assert_called_once_with('coalesced_lists', 2)
+
+
+class RestoreFromJournalTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        listener.setup_log()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.m_redis = mock_redis_client()
+        self.options = {'journal_dir': self.dir, 'deadlines': {}}
+        logged = journal.Journal(self.dir, deadline)
+        logged.append('+', PREFIX, 'key', ['taskId1'], logged.last_flush)
+        logged.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_restores_lost_lists(self):
+        self.assertEqual(listener.restore_from_journal(
+            [PREFIX], self.options, self.m_redis), 1)
+        self.assertEqual(self.m_redis.zrange(PREFIX + 'tasks.key', 0, -1),
+                         ['taskId1'])
+        self.assertTrue(self.m_redis.exists(PREFIX + 'restored'))
+
+    def test_skips_intact_lists(self):
+        self.m_redis.set(PREFIX + 'restored', 1)
+        self.assertEqual(listener.restore_from_journal(
+            [PREFIX], self.options, self.m_redis), 0)
+        self.assertEqual(self.m_redis.zcard(PREFIX + 'tasks.key'), 0)
+
+    def test_restores_after_later_changes(self):
+        # Lost while running, then changed again before the check
+        self.m_redis.incr(PREFIX + 'version')
+        self.m_redis.zadd(PREFIX + 'tasks.other', 'taskId2', 10)
+        self.assertEqual(listener.restore_from_journal(
+            [PREFIX], self.options, self.m_redis), 1)
+        self.assertEqual(self.m_redis.zrange(PREFIX + 'tasks.key', 0, -1),
+                         ['taskId1'])
+        self.assertEqual(self.m_redis.zrange(PREFIX + 'tasks.other', 0, -1),
+                         ['taskId2'])
+
+    @mock.patch('time.time')
+    def test_listener_restores_lost_lists(self, m_time):
+        m_time.return_value = 1000
+        app = listener.TaskEventApp(
+            PREFIX, dict(self.options, user='test', passwd='test',
+                         journal_name='journal.app'),
+            mock.Mock(), datastore=self.m_redis)
+        app.journal.flush_interval = 0
+        self.m_redis.set(PREFIX + 'restored', 1)
+        app.coalescer.insert_task('taskId2', 'key')
+        self.m_redis.flushdb()
+        # Not checked again within restore_check_interval
+        app._check_restored()
+        self.assertFalse(self.m_redis.exists(PREFIX + 'restored'))
+        m_time.return_value += app.restore_check_interval
+        app._check_restored()
+        self.assertEqual(
+            sorted(self.m_redis.zrange(PREFIX + 'tasks.key', 0, -1)),
+            ['taskId1', 'taskId2'])
+        app.journal.close()
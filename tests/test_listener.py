@@ -0,0 +1,100 @@
+import taskclustercoalesce.listener as listener
+from taskclustercoalesce.stats import Stats
+from mockredis import mock_redis_client
+import unittest
+import mock
+
+
+class RouteMatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.routes = listener.RouteMatcher(['coalesce.v1.',
+                                             'coalesce.v1.beta.'])
+
+    def test_match(self):
+        self.assertEqual(
+            self.routes.match(['route.index.foo', 'route.coalesce.v1.key']),
+            ('coalesce.v1.', 'key'))
+
+    def test_longest_prefix(self):
+        self.assertEqual(self.routes.match(['route.coalesce.v1.beta.key']),
+                         ('coalesce.v1.beta.', 'key'))
+
+    def test_no_match(self):
+        self.assertIsNone(self.routes.match(['route.index.coalesce.v1.key',
+                                             'coalesce.v1.key']))
+        self.assertIsNone(self.routes.match([]))
+
+
+class TaskEventAppTest(unittest.TestCase):
+
+    # Backend under test, run against MemoryDatastore in test_datastore
+    datastore = staticmethod(mock_redis_client)
+
+    @classmethod
+    def setUpClass(cls):
+        listener.setup_log()
+
+    def setUp(self):
+        self.prefix = 'testing.prefix.'
+        self.m_redis = self.datastore()
+        self.stats = Stats(self.prefix, self.m_redis)
+        options = {'user': 'test', 'passwd': 'test',
+                   'extra_prefixes': ['testing.other.']}
+        self.app = listener.TaskEventApp(self.prefix, options, self.stats,
+                                         datastore=self.m_redis)
+
+    def message(self, *routes):
+        message = mock.Mock()
+        message.headers = {'CC': list(routes)}
+        return message
+
+    def body(self, state, taskId='taskId1'):
+        return {'runId': 0, 'status': {'state': state, 'taskId': taskId}}
+
+    def tasks(self, prefix, key):
+        return self.m_redis.zrange(prefix + 'tasks.' + key, 0, -1)
+
+    def test_route_to_prefix(self):
+        self.app._route_callback_handler(
+            self.body('pending'),
+            self.message('route.testing.other.key'))
+        self.app._route_callback_handler(
+            self.body('pending', 'taskId2'),
+            self.message('route.testing.prefix.key'))
+        self.assertEqual(self.tasks('testing.other.', 'key'), ['taskId1'])
+        self.assertEqual(self.tasks(self.prefix, 'key'), ['taskId2'])
+
+    def test_unmatched_acked(self):
+        message = self.message('route.index.foo')
+        self.app._route_callback_handler(self.body('pending'), message)
+        message.ack.assert_called_once_with()
+        self.assertEqual(self.stats.get('unmatched'), 1)
+
+    def test_batch_by_prefix(self):
+        self.app.batch_size = 10
+        messages = [self.message('route.testing.prefix.key'),
+                    self.message('route.testing.other.key'),
+                    self.message('route.testing.prefix.key')]
+        for taskId, message in zip(['taskId1', 'taskId2', 'taskId3'],
+                                   messages):
+            self.app._batch_callback_handler(self.body('pending', taskId),
+                                             message)
+        self.app._flush_batch()
+        self.assertEqual(self.tasks(self.prefix, 'key'),
+                         ['taskId1', 'taskId3'])
+        self.assertEqual(self.tasks('testing.other.', 'key'), ['taskId2'])
+        for message in messages:
+            message.ack.assert_called_once_with()
+
+    def test_batch_requeue_unapplied(self):
+        self.app.batch_size = 10
+        messages = [self.message('route.testing.prefix.key'),
+                    self.message('route.testing.other.key')]
+        for message in messages:
+            self.app._batch_callback_handler(self.body('pending'), message)
+        with mock.patch.object(self.app.coalescers['testing.other.'],
+                               'apply_events', side_effect=IOError):
+            self.assertRaises(IOError, self.app._flush_batch)
+        messages[0].ack.assert_called_once_with()
+        messages[1].requeue.assert_called_once_with()
@@ -0,0 +1,81 @@
+import taskclustercoalesce.metrics as metrics
+from mockredis import mock_redis_client
+import unittest
+import mock
+
+
+class MetricsTest(unittest.TestCase):
+
+    # Backend under test, run against MemoryDatastore in test_datastore
+    datastore = staticmethod(mock_redis_client)
+
+    def setUp(self):
+        self.prefix = 'testing.prefix.'
+        self.m_redis = self.datastore()
+        self.metrics = metrics.Metrics(self.prefix, self.m_redis,
+                                       flush_interval=60)
+
+    def stored(self):
+        return self.m_redis.hgetall(self.prefix + 'metrics')
+
+    def test_observe_buffers(self):
+        self.metrics.observe('listener_message_seconds', 0.003)
+        self.assertEqual(self.stored(), {})
+
+    def test_flush(self):
+        self.metrics.observe('listener_message_seconds', 0.003)
+        self.metrics.observe('listener_message_seconds', 0.005)
+        self.metrics.observe('listener_message_seconds', 20)
+        self.metrics.flush()
+        stored = self.stored()
+        self.assertEqual(stored['listener_message_seconds|0.005'], '2')
+        self.assertEqual(stored['listener_message_seconds|+Inf'], '1')
+        self.assertEqual(stored['listener_message_seconds|count'], '3')
+        self.assertAlmostEqual(
+            float(stored['listener_message_seconds|sum']), 20.008)
+        # Flushing again merges only the new observations
+        self.metrics.observe('listener_message_seconds', 0.004)
+        self.metrics.flush()
+        self.assertEqual(self.stored()['listener_message_seconds|0.005'],
+                         '3')
+
+    def test_labels(self):
+        self.metrics.observe('coalescer_redis_seconds', 0.001, op='insert')
+        self.metrics.flush()
+        self.assertEqual(
+            self.stored()['coalescer_redis_seconds{op="insert"}|count'], '1')
+
+    @mock.patch('time.time', side_effect=[10, 10.25, 11])
+    def test_time(self, m_time):
+        with self.metrics.time('web_request_seconds', endpoint='ping'):
+            pass
+        self.metrics.flush()
+        self.assertEqual(
+            self.stored()['web_request_seconds{endpoint="ping"}|0.25'], '1')
+
+    def test_maybe_flush(self):
+        self.metrics.observe('listener_message_seconds', 0.003)
+        self.metrics.maybe_flush()
+        self.assertEqual(self.stored(), {})
+        self.metrics.last_flush -= 60
+        self.metrics.maybe_flush()
+        self.assertNotEqual(self.stored(), {})
+
+    def test_render(self):
+        self.m_redis.hset(self.prefix + 'stats', 'total_msgs_handled', 4)
+        self.m_redis.hset(self.prefix + 'stats', 'coalesced_lists', 2)
+        self.metrics.observe('coalescer_redis_seconds', 0.001, op='insert')
+        self.metrics.observe('coalescer_redis_seconds', 0.02, op='insert')
+        self.metrics.flush()
+        lines = self.metrics.render(self.prefix).splitlines()
+        self.assertIn('# TYPE coalescer_redis_seconds histogram', lines)
+        self.assertIn('coalescer_redis_seconds_bucket'
+                      '{op="insert",le="0.001"} 1', lines)
+        self.assertIn('coalescer_redis_seconds_bucket'
+                      '{op="insert",le="0.025"} 2', lines)
+        self.assertIn('coalescer_redis_seconds_bucket'
+                      '{op="insert",le="+Inf"} 2', lines)
+        self.assertIn('coalescer_redis_seconds_count{op="insert"} 2', lines)
+        self.assertIn('# TYPE coalesce_total_msgs_handled counter', lines)
+        self.assertIn('coalesce_total_msgs_handled 4', lines)
+        self.assertIn('# TYPE coalesce_coalesced_lists gauge', lines)
@@ -0,0 +1,67 @@
+from taskclustercoalesce import redisconn
+from mock import patch
+import unittest
+import redis
+
+
+class RedisConnTest(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = patch.dict('os.environ', clear=True)
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+
+    def test_defaults(self):
+        pool = redisconn.connection_pool('redis://:secret@example.com:6380/2')
+        self.assertIs(type(pool), redis.ConnectionPool)
+        kwargs = pool.connection_kwargs
+        self.assertEqual(kwargs['host'], 'example.com')
+        self.assertEqual(kwargs['port'], 6380)
+        self.assertEqual(kwargs['db'], 2)
+        self.assertEqual(kwargs['password'], 'secret')
+        self.assertEqual(kwargs['socket_timeout'], redisconn.SOCKET_TIMEOUT)
+        self.assertEqual(kwargs['socket_connect_timeout'],
+                         redisconn.CONNECT_TIMEOUT)
+        self.assertTrue(kwargs['socket_keepalive'])
+
+    def test_environment(self):
+        with patch.dict('os.environ', {'REDIS_SOCKET_TIMEOUT': '0',
+                                       'REDIS_KEEPALIVE': '0',
+                                       'REDIS_MAX_CONNECTIONS': '7',
+                                       'REDIS_POOL_TIMEOUT': '2'}):
+            pool = redisconn.connection_pool('redis://localhost')
+        self.assertIsInstance(pool, redis.BlockingConnectionPool)
+        self.assertEqual(pool.max_connections, 7)
+        self.assertEqual(pool.timeout, 2)
+        self.assertIsNone(pool.connection_kwargs['socket_timeout'])
+        self.assertFalse(pool.connection_kwargs['socket_keepalive'])
+
+    def test_arguments_override_environment(self):
+        with patch.dict('os.environ', {'REDIS_MAX_CONNECTIONS': '7'}):
+            pool = redisconn.connection_pool('redis://localhost',
+                                             max_connections=3,
+                                             decode_responses=True)
+        self.assertEqual(pool.max_connections, 3)
+        self.assertEqual(pool.timeout, redisconn.POOL_TIMEOUT)
+        self.assertTrue(pool.connection_kwargs['decode_responses'])
+
+    def test_tls(self):
+        pool = redisconn.connection_pool('rediss://localhost:6380')
+        self.assertIs(pool.connection_class, redis.SSLConnection)
+
+    def test_unix_socket(self):
+        pool = redisconn.connection_pool('unix:///tmp/redis.sock?db=1')
+        self.assertIs(pool.connection_class,
+                      redis.UnixDomainSocketConnection)
+        self.assertEqual(pool.connection_kwargs['path'], '/tmp/redis.sock')
+        self.assertEqual(pool.connection_kwargs['db'], 1)
+        self.assertNotIn('socket_keepalive', pool.connection_kwargs)
+        # The connection class accepts every argument
+        pool.make_connection()
+
+    def test_connect(self):
+        rds = redisconn.connect('redis://localhost', max_connections=1)
+        self.assertIsInstance(rds, redis.Redis)
+        self.assertEqual(rds.connection_pool.max_connections, 1)
@@ -0,0 +1,193 @@
+from mockredis import mock_redis_client
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import threading
+import unittest
+import tempfile
+import shutil
+import json
+import time
+import imp
+import os
+
+scrub = imp.load_source(
+    'scrub_stale_lists',
+    os.path.join(os.path.dirname(__file__), '..', 'bin',
+                 'scrub_stale_lists.py'))
+
+# taskId -> state reported by the stub queue, missing taskIds get a 404
+TASK_STATES = {'pending1': 'pending',
+               'pending2': 'pending',
+               'done1': 'completed',
+               'done2': 'exception'}
+
+
+def deadline(prefix, coalesce_key):
+    return 3600
+
+
+class QueueStubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        taskId = self.path.split('/')[-2]
+        if taskId == 'broken':
+            self.send_response(500)
+            self.end_headers()
+            return
+        if taskId not in TASK_STATES:
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps({'status': {'taskId': taskId,
+                                      'state': TASK_STATES[taskId]}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ScrubTest(unittest.TestCase):
+
+    pf = "coalesce.v1."
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), QueueStubHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        base_url = 'http://127.0.0.1:%d/v1' % self.server.server_port
+        self.queue = scrub.QueueStatus(base_url=base_url, concurrency=4,
+                                       rate_limit=0)
+        self.m_redis = mock_redis_client()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add(self, key, *taskIds, **kwargs):
+        """ Add a list of taskIds inserted from time 0, or since oldest """
+        oldest = kwargs.get('oldest', 0)
+        self.m_redis.sadd(self.pf + "list_keys", key)
+        for score, taskId in enumerate(taskIds, oldest):
+            self.m_redis.zadd(self.pf + "tasks." + key, taskId, score)
+        self.m_redis.zadd(self.pf + "age_index", key,
+                          oldest + deadline(self.pf, key))
+
+    def test_is_pending(self):
+        self.assertTrue(self.queue.is_pending('pending1'))
+        self.assertFalse(self.queue.is_pending('done1'))
+        self.assertFalse(self.queue.is_pending('missing'))
+        # Errors keep the task
+        self.assertTrue(self.queue.is_pending('broken'))
+
+    def test_scrub(self):
+        self.add('key1', 'pending1', 'done1', 'missing', 'broken')
+        self.add('key2', 'done2')
+        self.add('key3', 'pending2')
+        result = scrub.main(self.m_redis, self.queue, concurrency=4,
+                            chunk_size=2, scan_count=2, page_size=2)
+        self.assertEqual(result, (3, 1, True))
+        self.assertEqual(self.m_redis.zrange(self.pf + "tasks.key1", 0, -1),
+                         ['pending1', 'broken'])
+        self.assertEqual(self.m_redis.zrange(self.pf + "tasks.key3", 0, -1),
+                         ['pending2'])
+        self.assertEqual(self.m_redis.smembers(self.pf + "list_keys"),
+                         set(['key1', 'key3']))
+        self.assertIsNone(self.m_redis.get(self.pf + "scrub.cursor"))
+
+    def test_removals_journaled(self):
+        directory = tempfile.mkdtemp()
+        try:
+            inserted = scrub.journal.Journal(directory, deadline)
+            inserted.append('+', self.pf, 'key1', ['pending1', 'done1'],
+                            time.time() - 10)
+            inserted.close()
+            removal_log = scrub.journal.Journal(directory, deadline,
+                                                name='scrub')
+            self.add('key1', 'pending1', 'done1')
+            scrub.main(self.m_redis, self.queue, removal_log=removal_log)
+            removal_log.close()
+            lists = scrub.journal.load(directory, deadline)
+            self.assertEqual(list(lists[self.pf]['key1']), ['pending1'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_keeps_nonempty_list_key(self):
+        self.add('key1', 'done1')
+        self.m_redis.zadd(self.pf + "tasks.key1", 'pending1', 5)
+        self.assertEqual(scrub.main(self.m_redis, self.queue), (1, 0, True))
+        self.assertEqual(self.m_redis.smembers(self.pf + "list_keys"),
+                         set(['key1']))
+
+    def test_oldest_first(self):
+        checked = []
+        is_pending = self.queue.is_pending
+
+        def record(taskId):
+            checked.append(taskId)
+            return is_pending(taskId)
+
+        self.queue.is_pending = record
+        self.add('key1', 'pending1', 'done1', oldest=10)
+        self.m_redis.zadd(self.pf + "tasks.key1", 'done1', 30)
+        self.add('key2', 'pending2', 'done2', oldest=20)
+        self.m_redis.zadd(self.pf + "tasks.key2", 'done2', 40)
+        scrub.main(self.m_redis, self.queue, concurrency=1, chunk_size=1)
+        self.assertEqual(checked, ['pending1', 'pending2', 'done1', 'done2'])
+
+    def test_oldest_lists_first(self):
+        checked = []
+        is_pending = self.queue.is_pending
+
+        def record(taskId):
+            checked.append(taskId)
+            return is_pending(taskId)
+
+        self.queue.is_pending = record
+        self.add('key1', 'pending1', oldest=30)
+        self.add('key2', 'pending2', oldest=20)
+        self.add('key3', 'done1', 'done2', oldest=10)
+        # Ordered across batches by the age index, not by list_keys
+        scrub.main(self.m_redis, self.queue, concurrency=1, scan_count=1)
+        self.assertEqual(checked, ['done1', 'done2', 'pending2', 'pending1'])
+
+    def test_tied_lists_in_one_batch(self):
+        self.add('key1', 'done1')
+        self.add('key2', 'done2')
+        self.add('key3', 'pending1', oldest=10)
+        result = scrub.main(self.m_redis, self.queue, scan_count=1,
+                            time_budget=-1)
+        self.assertEqual(result, (0, 0, False))
+        result = scrub.main(self.m_redis, self.queue, scan_count=1)
+        self.assertEqual(result, (2, 2, True))
+        self.assertEqual(self.m_redis.smembers(self.pf + "list_keys"),
+                         set(['key3']))
+
+    def test_resume(self):
+        self.add('key1', 'done1')
+        self.add('key2', 'done2', oldest=10)
+        # No time left, the first batch is kept for the next run
+        result = scrub.main(self.m_redis, self.queue, scan_count=1,
+                            time_budget=-1)
+        self.assertEqual(result, (0, 0, False))
+        self.assertEqual(self.m_redis.get(self.pf + "scrub.cursor"), '-inf')
+        # Resume from a saved cursor past the first batch
+        self.m_redis.set(self.pf + "scrub.cursor", '(3600.0')
+        result = scrub.main(self.m_redis, self.queue, scan_count=1)
+        self.assertEqual(result, (1, 1, True))
+        self.assertEqual(self.m_redis.smembers(self.pf + "list_keys"),
+                         set(['key1']))
+        self.assertIsNone(self.m_redis.get(self.pf + "scrub.cursor"))
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_spacing(self):
+        limiter = scrub.RateLimiter(1000)
+        first = limiter.next_slot
+        for i in range(5):
+            limiter.wait()
+        self.assertAlmostEqual(limiter.next_slot - first, 0.005, places=3)
@@ -0,0 +1,223 @@
+from taskclustercoalesce import sharding
+import taskclustercoalesce.web as web
+import taskclustercoalesce.listener as listener
+from taskclustercoalesce import journal
+from taskclustercoalesce.cache import ListCache
+from mockredis import mock_redis_client
+import unittest
+import tempfile
+import shutil
+import json
+import mock
+
+PREFIX = 'testing.prefix.'
+
+
+class HashRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = ['key.%d' % i for i in range(1000)]
+
+    def test_keys_spread(self):
+        ring = sharding.HashRing(['a', 'b', 'c'], ['a', 'b', 'c'])
+        counts = {}
+        for key in self.keys:
+            counts[ring.node(key)] = counts.get(ring.node(key), 0) + 1
+        self.assertEqual(sorted(counts), ['a', 'b', 'c'])
+        for count in counts.values():
+            self.assertTrue(200 < count < 470, counts)
+
+    def test_added_node_moves_its_share(self):
+        before = sharding.HashRing(['a', 'b', 'c'], ['a', 'b', 'c'])
+        after = sharding.HashRing(['a', 'b', 'c', 'd'], ['a', 'b', 'c', 'd'])
+        moved = [key for key in self.keys
+                 if before.node(key) != after.node(key)]
+        self.assertTrue(all(after.node(key) == 'd' for key in moved))
+        self.assertTrue(150 < len(moved) < 350, len(moved))
+
+    def test_placed_by_name(self):
+        ring = sharding.HashRing(['a', 'b'], ['a', 'b'])
+        swapped = sharding.HashRing(['b', 'a'], ['b', 'a'])
+        for key in self.keys[:100]:
+            self.assertEqual(ring.node(key), swapped.node(key))
+
+    def test_partition(self):
+        ring = sharding.HashRing(['a', 'b'], ['a', 'b'])
+        parts = ring.partition(self.keys[:20])
+        self.assertEqual(sorted(key for keys in parts.values()
+                                for key in keys), sorted(self.keys[:20]))
+        for index, keys in parts.items():
+            self.assertTrue(all(ring.index(key) == index for key in keys))
+
+    def test_node_name(self):
+        self.assertEqual(sharding.node_name('redis://:secret@host:6379/1'),
+                         'host:6379/1')
+        self.assertEqual(sharding.node_name('unix:///tmp/redis.sock?db=2'),
+                         '/tmp/redis.sock?db=2')
+
+    def test_shard_urls(self):
+        self.assertEqual(sharding.shard_urls(' redis://a, redis://b,'),
+                         ['redis://a', 'redis://b'])
+        self.assertEqual(sharding.shard_urls(None), [])
+
+    def test_parallel(self):
+        self.assertEqual(sharding.parallel([lambda: 1, lambda: 2]), [1, 2])
+        self.assertRaises(ZeroDivisionError, sharding.parallel,
+                          [lambda: 1, lambda: 1 / 0])
+
+
+class ShardTestBase(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = [mock_redis_client(), mock_redis_client()]
+        self.shards = sharding.HashRing(self.nodes, ['node0', 'node1'])
+        # Keys held by each node
+        self.keys = [[key for key in ('key.%d' % i for i in range(20))
+                      if self.shards.index(key) == index][:2]
+                     for index in range(2)]
+
+
+class ShardedCoalescerTest(ShardTestBase):
+
+    def setUp(self):
+        super(ShardedCoalescerTest, self).setUp()
+        self.m_stats = mock.Mock()
+        self.m_stats.get.return_value = 0
+        self.coalescer = sharding.coalescing_machine(
+            PREFIX, None, self.m_stats, shards=self.shards)
+
+    def members(self, index, key):
+        return self.nodes[index].zrange(PREFIX + 'tasks.' + key, 0, -1)
+
+    def test_insert_on_key_node(self):
+        self.coalescer.insert_task('taskId1', self.keys[0][0])
+        self.coalescer.insert_task('taskId2', self.keys[1][0])
+        self.assertEqual(self.members(0, self.keys[0][0]), ['taskId1'])
+        self.assertEqual(self.members(1, self.keys[1][0]), ['taskId2'])
+        self.assertEqual(self.nodes[0].smembers(PREFIX + 'list_keys'),
+                         set([self.keys[0][0]]))
+        self.assertEqual(self.nodes[1].smembers(PREFIX + 'list_keys'),
+                         set([self.keys[1][0]]))
+
+    def test_list_count_summed(self):
+        self.coalescer.insert_task('taskId1', self.keys[0][0])
+        self.coalescer.insert_task('taskId2', self.keys[1][0])
+        self.coalescer.insert_task('taskId3', self.keys[1][1])
+        self.m_stats.set.assert_called_with('coalesced_lists', 3)
+
+    def test_apply_events_per_node(self):
+        self.coalescer.insert_task('taskId1', self.keys[0][0])
+        self.coalescer.apply_events([('remove', 'taskId1', self.keys[0][0]),
+                                     ('insert', 'taskId2', self.keys[1][0]),
+                                     ('insert', 'taskId3', self.keys[0][1])])
+        self.assertEqual(self.members(0, self.keys[0][0]), [])
+        self.assertEqual(self.members(1, self.keys[1][0]), ['taskId2'])
+        self.assertEqual(self.members(0, self.keys[0][1]), ['taskId3'])
+
+    def test_restore_lists(self):
+        restored = self.coalescer.restore_lists({
+            self.keys[0][0]: {'taskId1': 10},
+            self.keys[1][0]: {'taskId2': 20, 'taskId3': 30}})
+        self.assertEqual(restored, 3)
+        self.assertEqual(self.members(0, self.keys[0][0]), ['taskId1'])
+        self.assertEqual(self.members(1, self.keys[1][0]),
+                         ['taskId2', 'taskId3'])
+
+    @mock.patch('time.time')
+    def test_reap_every_node(self, m_time):
+        m_time.return_value = 10
+        self.coalescer.insert_task('taskId1', self.keys[0][0])
+        self.coalescer.insert_task('taskId2', self.keys[1][0])
+        m_time.return_value = 11 + self.coalescer.ttl
+        self.assertEqual(self.coalescer.reap_expired(), (2, 2))
+
+
+class ShardedRestoreTest(ShardTestBase):
+
+    @classmethod
+    def setUpClass(cls):
+        listener.setup_log()
+
+    def setUp(self):
+        super(ShardedRestoreTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        logged = journal.Journal(self.dir, lambda prefix, key: 100)
+        logged.append('+', PREFIX, self.keys[0][0], ['taskId1'],
+                      logged.last_flush)
+        logged.append('+', PREFIX, self.keys[1][0], ['taskId2'],
+                      logged.last_flush)
+        logged.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_restores_lost_node(self):
+        self.nodes[1].set(PREFIX + 'restored', 1)
+        self.assertEqual(listener.restore_from_journal(
+            [PREFIX], {'journal_dir': self.dir, 'deadlines': {}},
+            mock_redis_client(), shards=self.shards), 1)
+        self.assertEqual(self.nodes[0].zrange(
+            PREFIX + 'tasks.' + self.keys[0][0], 0, -1), ['taskId1'])
+        self.assertFalse(self.nodes[1].exists(
+            PREFIX + 'tasks.' + self.keys[1][0]))
+        self.assertTrue(self.nodes[0].exists(PREFIX + 'restored'))
+
+
+class WebShardTestCase(ShardTestBase):
+
+    def setUp(self):
+        super(WebShardTestCase, self).setUp()
+        web.app.config['TESTING'] = True
+        web.app.prefix = PREFIX
+        web.app.redis = mock_redis_client()
+        web.app.redis_replica = None
+        web.app.shards = self.shards
+        web.app.cache = ListCache(16, 60)
+        self.coalescer = sharding.coalescing_machine(
+            PREFIX, None, mock.Mock(), shards=self.shards)
+        self.app = web.app.test_client()
+
+    def tearDown(self):
+        web.app.shards = None
+
+    def test_supersedes_across_nodes(self):
+        self.coalescer.apply_events([('insert', 'taskId1', self.keys[0][0]),
+                                     ('insert', 'taskId2', self.keys[1][0])])
+        rv = self.app.post('/v1/supersedes', data=json.dumps({'queries': [
+            {'key': key, 'age': 0, 'size': 0}
+            for key in (self.keys[0][0], self.keys[1][0])]}))
+        self.assertEqual(json.loads(rv.data), {'results': [
+            {'key': self.keys[0][0], 'supersedes': ['taskId1']},
+            {'key': self.keys[1][0], 'supersedes': ['taskId2']}]})
+
+    def test_list_keys_paginated_across_nodes(self):
+        keys = self.keys[0] + self.keys[1]
+        for i, key in enumerate(keys):
+            self.coalescer.insert_task('taskId%d' % i, key)
+        found = []
+        cursor = None
+        while cursor != 0:
+            rv = self.app.get('/v1/list?count=1&details=1&cursor=%d' %
+                              (cursor or 0))
+            body = json.loads(rv.data)
+            found.extend(body[PREFIX])
+            self.assertEqual(sorted(body['lists']), sorted(body[PREFIX]))
+            cursor = body['cursor']
+        self.assertEqual(sorted(found), sorted(keys))
+
+    def test_cursor_range_per_node(self):
+        # Two nodes, the largest cursor of the second
+        rv = self.app.get('/v1/list?cursor=%d' % (2 ** 65 - 1))
+        self.assertEqual(rv.status_code, 200)
+        rv = self.app.get('/v1/list?cursor=%d' % 2 ** 65)
+        self.assertEqual(rv.status_code, 400)
+
+    def test_etag_covers_every_node(self):
+        etag = self.app.get('/v1/list').headers['ETag']
+        self.nodes[1].incr(PREFIX + 'list_keys_version')
+        rv = self.app.get('/v1/list', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
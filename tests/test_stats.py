@@ -0,0 +1,76 @@
+import taskclustercoalesce.stats as stats
+from mockredis import mock_redis_client
+import unittest
+import mock
+
+
+class StatsTestBase(unittest.TestCase):
+
+    # Backend under test, run against MemoryDatastore in test_datastore
+    datastore = staticmethod(mock_redis_client)
+
+    def setUp(self):
+        self.prefix = 'testing.prefix.'
+        self.m_redis = self.datastore()
+        self.stats = stats.Stats(self.prefix, self.m_redis,
+                                 flush_interval=60, flush_size=3)
+
+    def tearDown(self):
+        pass
+
+    def stored(self, stat_name):
+        return int(self.m_redis.hget(self.prefix + 'stats', stat_name))
+
+
+class StatsTest(StatsTestBase):
+
+    def test_init_defaults(self):
+        self.assertEqual(self.stored('total_msgs_handled'), 0)
+        self.assertEqual(self.stats.get('total_msgs_handled'), 0)
+
+    def test_init_existing(self):
+        self.m_redis.hset(self.prefix + 'stats', 'premature', 7)
+        s = stats.Stats(self.prefix, self.m_redis)
+        self.assertEqual(s.get('premature'), 7)
+        self.assertEqual(self.stored('premature'), 7)
+
+    def test_notch_buffered(self):
+        self.stats.notch('total_msgs_handled')
+        self.stats.notch('total_msgs_handled')
+        self.assertEqual(self.stats.get('total_msgs_handled'), 2)
+        self.assertEqual(self.stored('total_msgs_handled'), 0)
+
+    def test_notch_flush_size(self):
+        self.stats.notch('total_msgs_handled', 2)
+        self.stats.notch('premature')
+        self.assertEqual(self.stored('total_msgs_handled'), 2)
+        self.assertEqual(self.stored('premature'), 1)
+
+    @mock.patch('time.time')
+    def test_notch_flush_interval(self, m_time):
+        m_time.return_value = 0
+        s = stats.Stats(self.prefix, self.m_redis, flush_interval=5)
+        s.notch('total_msgs_handled')
+        self.assertEqual(self.stored('total_msgs_handled'), 0)
+        m_time.return_value = 5
+        s.notch('total_msgs_handled')
+        self.assertEqual(self.stored('total_msgs_handled'), 2)
+
+    def test_flush_shared_counters(self):
+        other = stats.Stats(self.prefix, self.m_redis, flush_interval=60)
+        other.notch('total_msgs_handled', 5)
+        other.flush()
+        self.stats.notch('total_msgs_handled')
+        self.stats.flush()
+        self.assertEqual(self.stored('total_msgs_handled'), 6)
+        self.assertEqual(self.stats.get('total_msgs_handled'), 6)
+
+    def test_set_flushed(self):
+        self.stats.set('coalesced_lists', 4)
+        self.assertEqual(self.stored('coalesced_lists'), 0)
+        self.stats.flush()
+        self.assertEqual(self.stored('coalesced_lists'), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
 import taskclustercoalesce.web as web
+from taskclustercoalesce.cache import ListCache
+from taskclustercoalesce.metrics import Metrics
 import unittest
 import json
 from mockredis import mock_redis_client
@@ -7,17 +9,20 @@ from mock import patch
 
 class WebTestBase(unittest.TestCase):
 
+    # Backend under test, run against MemoryDatastore in test_datastore
+    datastore = staticmethod(mock_redis_client)
+
     def setUp(self):
         web.app.config['TESTING'] = True
         web.app.prefix = self.prefix = 'testing.prefix.'
-        web.app.redis = mock_redis_client()
-
-        # Setup some taskIds and timestamps
-        web.app.redis.set(self.prefix + 'taskId1' + '.timestamp', 0)
-        web.app.redis.set(self.prefix + 'taskId2' + '.timestamp', 5)
-        web.app.redis.set(self.prefix + 'taskId3' + '.timestamp', 10)
-        web.app.redis.lpush(self.prefix + 'lists.' + 'sample.key.1',
-                            'taskId1', 'taskId2', 'taskId3')
+        web.app.redis = self.datastore()
+        web.app.redis_replica = None
+        web.app.shards = None
+        web.app.cache = ListCache(16, 60)
+
+        # Setup some taskIds scored by timestamp
+        web.app.redis.zadd(self.prefix + 'tasks.' + 'sample.key.1',
+                           'taskId1', 0, 'taskId2', 5, 'taskId3', 10)
         self.app = web.app.test_client()
 
     def tearDown(self):
@@ -55,7 +60,7 @@ class WebTestCase(WebTestBase):
     def test_coalesce_key_list_empty(self):
         rv = self.app.get('/v1/list')
         actual = json.loads(rv.data)
-        expected = {self.prefix: []}
+        expected = {self.prefix: [], 'cursor': 0}
         self.assertEqual(self.ordered(actual), self.ordered(expected))
         self.assertEqual(rv.status_code, 200)
 
@@ -64,7 +69,7 @@ class WebTestCase(WebTestBase):
         with web.app.test_client() as c:
             rv = c.get('/v1/list')
             actual = json.loads(rv.data)
-            expected = {self.prefix: ["single_key"]}
+            expected = {self.prefix: ["single_key"], 'cursor': 0}
             self.assertEqual(self.ordered(actual), self.ordered(expected))
             self.assertEqual(rv.status_code, 200)
 
@@ -74,7 +79,7 @@ class WebTestCase(WebTestBase):
         with web.app.test_client() as c:
             rv = c.get('/v1/list')
             actual = json.loads(rv.data)
-            expected = {self.prefix: ['key_1', 'key_2', 'key_3']}
+            expected = {self.prefix: ['key_1', 'key_2', 'key_3'], 'cursor': 0}
             self.assertEqual(self.ordered(actual), self.ordered(expected))
             self.assertEqual(rv.status_code, 200)
 
@@ -137,6 +142,22 @@ class WebTestCase(WebTestBase):
             self.assertEqual(self.ordered(actual), self.ordered(expected))
             self.assertEqual(rv.status_code, 200)
 
+    @patch('time.time')
+    def test_coalesce_task_list_not_met_skips_fetch(self, m_time):
+        m_time.return_value = 10
+        with patch.object(web.app.redis, 'zrevrange') as m_zrevrange:
+            rv = self.app.get('/v1/list/20/0/sample.key.1')
+            self.assertEqual(json.loads(rv.data), {'supersedes': []})
+            self.assertFalse(m_zrevrange.called)
+
+    @patch('time.time')
+    def test_coalesce_task_list_order(self, m_time):
+        m_time.return_value = 10
+        rv = self.app.get('/v1/list/5/0/sample.key.1')
+        actual = json.loads(rv.data)
+        expected = {'supersedes': ['taskId3', 'taskId2', 'taskId1']}
+        self.assertEqual(actual, expected)
+
     def test_stats_multi(self):
         stats = {'pending_count': '8',
                  'coalesced_lists': '7',
@@ -155,5 +176,291 @@ class WebTestCase(WebTestBase):
             self.assertEqual(rv.status_code, 200)
 
 
+class WebMetricsTestCase(WebTestBase):
+
+    def setUp(self):
+        super(WebMetricsTestCase, self).setUp()
+        web.app.metrics = Metrics(self.prefix, web.app.redis)
+
+    def test_metrics(self):
+        self.app.get('/v1/ping')
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('web_request_seconds_count{endpoint="ping"} 1',
+                      rv.data.splitlines())
+
+
+class WebListKeysTestCase(WebTestBase):
+
+    def setUp(self):
+        super(WebListKeysTestCase, self).setUp()
+        web.app.redis.sadd(self.prefix + 'list_keys', 'sample.key.1',
+                           'sample.key.2', 'other.key', 'odd*key')
+
+    def get(self, url, **kwargs):
+        rv = self.app.get(url, **kwargs)
+        return rv, json.loads(rv.data) if rv.data else None
+
+    def test_list_keys_paginated(self):
+        keys = []
+        cursor = None
+        while cursor != 0:
+            rv, actual = self.get('/v1/list?count=3&cursor=%d' % (cursor or 0))
+            self.assertLessEqual(len(actual[self.prefix]), 3)
+            keys.extend(actual[self.prefix])
+            cursor = actual['cursor']
+        self.assertEqual(sorted(keys),
+                         ['odd*key', 'other.key', 'sample.key.1',
+                          'sample.key.2'])
+
+    def test_list_keys_prefix(self):
+        rv, actual = self.get('/v1/list?prefix=sample.')
+        self.assertEqual(sorted(actual[self.prefix]),
+                         ['sample.key.1', 'sample.key.2'])
+
+    def test_glob_escape(self):
+        self.assertEqual(web.glob_escape('odd*key?[1]\\'),
+                         'odd\\*key\\?\\[1\\]\\\\')
+
+    def test_list_keys_match(self):
+        rv, actual = self.get('/v1/list?match=*.key*')
+        self.assertEqual(sorted(actual[self.prefix]),
+                         ['other.key', 'sample.key.1', 'sample.key.2'])
+
+    def test_list_keys_details(self):
+        rv, actual = self.get('/v1/list?prefix=sample.&details=1')
+        expected = {'sample.key.1': {'length': 3, 'oldest_task_time': 0},
+                    'sample.key.2': {'length': 0, 'oldest_task_time': None}}
+        self.assertEqual(actual['lists'], expected)
+
+    def test_list_keys_bad_args(self):
+        rv, actual = self.get('/v1/list?count=0')
+        self.assertEqual(rv.status_code, 400)
+        rv, actual = self.get('/v1/list?cursor=abc')
+        self.assertEqual(rv.status_code, 400)
+        rv, actual = self.get('/v1/list?cursor=-1')
+        self.assertEqual(rv.status_code, 400)
+        rv, actual = self.get('/v1/list?cursor=%d' % 2 ** 64)
+        self.assertEqual(rv.status_code, 400)
+
+    def test_list_keys_etag(self):
+        rv, actual = self.get('/v1/list')
+        etag = rv.headers['ETag']
+        rv, actual = self.get('/v1/list',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.headers['ETag'], etag)
+        web.app.redis.incr(self.prefix + 'list_keys_version')
+        rv, actual = self.get('/v1/list',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertNotEqual(rv.headers['ETag'], etag)
+
+    def test_list_keys_etag_of_details(self):
+        etag = self.get('/v1/list')[0].headers['ETag']
+        details_etag = self.get('/v1/list?details=1')[0].headers['ETag']
+        # A change to a list which leaves the keys as they are
+        web.app.redis.incr(self.prefix + 'version')
+        rv, actual = self.get('/v1/list', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        rv, actual = self.get('/v1/list?details=1',
+                              headers={'If-None-Match': details_etag})
+        self.assertEqual(rv.status_code, 200)
+
+
+class WebBulkTestCase(WebTestBase):
+
+    def post(self, queries):
+        return self.app.post('/v1/supersedes',
+                             data=json.dumps({'queries': queries}),
+                             content_type='application/json')
+
+    @patch('time.time')
+    def test_bulk_supersedes(self, m_time):
+        m_time.return_value = 10
+        web.app.redis.zadd(self.prefix + 'tasks.sample.key.2',
+                           'taskId4', 1, 'taskId5', 2)
+        rv = self.post([{'key': 'sample.key.1', 'age': 5, 'size': 2},
+                        {'key': 'sample.key.2', 'age': 5, 'size': 2},
+                        {'key': 'sample.key.1', 'age': 20, 'size': 0},
+                        {'key': 'missing.key', 'age': 0, 'size': 0}])
+        self.assertEqual(rv.status_code, 200)
+        expected = {'results': [
+            {'key': 'sample.key.1',
+             'supersedes': ['taskId3', 'taskId2', 'taskId1']},
+            {'key': 'sample.key.2', 'supersedes': []},
+            {'key': 'sample.key.1', 'supersedes': []},
+            {'key': 'missing.key', 'supersedes': []}]}
+        self.assertEqual(json.loads(rv.data), expected)
+
+    @patch('time.time')
+    def test_bulk_supersedes_matches_get(self, m_time):
+        m_time.return_value = 10
+        rv = self.post([{'key': 'sample.key.1', 'age': 5, 'size': 0}])
+        get = self.app.get('/v1/list/5/0/sample.key.1')
+        self.assertEqual(json.loads(rv.data)['results'][0]['supersedes'],
+                         json.loads(get.data)['supersedes'])
+
+    def test_bulk_supersedes_empty(self):
+        rv = self.post([])
+        self.assertEqual(json.loads(rv.data), {'results': []})
+
+    def test_bulk_supersedes_bad_request(self):
+        rv = self.app.post('/v1/supersedes', data='not json')
+        self.assertEqual(rv.status_code, 400)
+        rv = self.post([{'key': 'sample.key.1', 'age': 'old'}])
+        self.assertEqual(rv.status_code, 400)
+        rv = self.post([{'key': 123, 'age': 0, 'size': 0}])
+        self.assertEqual(rv.status_code, 400)
+        rv = self.post([{'key': ['sample.key.1'], 'age': 0, 'size': 0}])
+        self.assertEqual(rv.status_code, 400)
+
+    @patch.dict(web.app.config, {'BULK_MAX_QUERIES': 1})
+    def test_bulk_supersedes_too_many(self):
+        rv = self.post([{'key': 'a', 'age': 0, 'size': 0},
+                        {'key': 'b', 'age': 0, 'size': 0}])
+        self.assertEqual(rv.status_code, 413)
+
+
+class WebLimitTestCase(WebTestBase):
+
+    def truncated_responses(self):
+        return web.app.redis.hget(self.prefix + 'stats', 'truncated_responses')
+
+    @patch('time.time')
+    def test_limit(self, m_time):
+        m_time.return_value = 10
+        with patch.object(web.app.redis, 'zrevrange',
+                          wraps=web.app.redis.zrevrange) as m_zrevrange:
+            rv = self.app.get('/v1/list/5/0/sample.key.1?limit=2')
+        m_zrevrange.assert_called_once_with(
+            self.prefix + 'tasks.sample.key.1', 0, 1)
+        self.assertEqual(json.loads(rv.data),
+                         {'supersedes': ['taskId3', 'taskId2'],
+                          'total': 3, 'truncated': True})
+        self.assertEqual(self.truncated_responses(), '1')
+
+    @patch('time.time')
+    def test_truncated_counted_as_integer(self, m_time):
+        m_time.return_value = 10
+        with patch.object(web.app.redis, 'hincrby',
+                          wraps=web.app.redis.hincrby) as m_hincrby:
+            self.app.get('/v1/list/5/0/sample.key.1?limit=2')
+            # Counted once the streamed response is read
+            self.app.post('/v1/supersedes', data=json.dumps({'queries': [
+                {'key': 'sample.key.1', 'age': 5, 'size': 0, 'limit': 1}]}
+            )).data
+        # redis rejects the 'True' a bool is sent as
+        self.assertEqual([type(c[0][2]) for c in m_hincrby.call_args_list],
+                         [int, int])
+
+    @patch('time.time')
+    def test_limit_not_reached(self, m_time):
+        m_time.return_value = 10
+        rv = self.app.get('/v1/list/5/0/sample.key.1?limit=3')
+        self.assertEqual(json.loads(rv.data),
+                         {'supersedes': ['taskId3', 'taskId2', 'taskId1']})
+        self.assertIsNone(self.truncated_responses())
+
+    @patch('time.time')
+    @patch.dict(web.app.config, {'SUPERSEDES_MAX': 1})
+    def test_global_limit(self, m_time):
+        m_time.return_value = 10
+        rv = self.app.get('/v1/list/5/0/sample.key.1?limit=2')
+        self.assertEqual(json.loads(rv.data),
+                         {'supersedes': ['taskId3'],
+                          'total': 3, 'truncated': True})
+
+    @patch('time.time')
+    def test_list_read_to_limit(self, m_time):
+        m_time.return_value = 10
+        zrevrange = web.app.redis.zrevrange
+        with patch.object(web.app.redis, 'zrevrange',
+                          side_effect=zrevrange) as m_zrevrange:
+            rv = self.app.get('/v1/list/5/0/sample.key.1?limit=1')
+        m_zrevrange.assert_called_once_with(
+            self.prefix + 'tasks.sample.key.1', 0, 0)
+        self.assertEqual(json.loads(rv.data),
+                         {'supersedes': ['taskId3'],
+                          'total': 3, 'truncated': True})
+
+    def test_bad_limit(self):
+        rv = self.app.get('/v1/list/5/0/sample.key.1?limit=0')
+        self.assertEqual(rv.status_code, 400)
+        rv = self.app.get('/v1/list/5/0/sample.key.1?limit=all')
+        self.assertEqual(rv.status_code, 400)
+
+    @patch('time.time')
+    def test_bulk_limits(self, m_time):
+        m_time.return_value = 10
+        rv = self.app.post('/v1/supersedes', data=json.dumps({'queries': [
+            {'key': 'sample.key.1', 'age': 5, 'size': 0, 'limit': 1},
+            {'key': 'sample.key.1', 'age': 5, 'size': 0}]}))
+        self.assertEqual(json.loads(rv.data), {'results': [
+            {'key': 'sample.key.1', 'supersedes': ['taskId3'],
+             'total': 3, 'truncated': True},
+            {'key': 'sample.key.1',
+             'supersedes': ['taskId3', 'taskId2', 'taskId1']}]})
+        self.assertEqual(self.truncated_responses(), '1')
+
+
+class WebReplicaTestCase(WebTestBase):
+
+    def setUp(self):
+        super(WebReplicaTestCase, self).setUp()
+        web.app.redis_replica = self.datastore()
+        web.app.redis_replica.zadd(self.prefix + 'tasks.sample.key.1',
+                                   'taskId1', 0, 'taskId2', 5)
+        web.app.redis_replica.sadd(self.prefix + 'list_keys', 'sample.key.1')
+
+    def test_list_read_from_replica(self):
+        rv = self.app.get('/v1/list/0/0/sample.key.1')
+        actual = json.loads(rv.data)
+        self.assertEqual(actual, {'supersedes': ['taskId2', 'taskId1']})
+
+    def test_list_keys_read_from_replica(self):
+        rv = self.app.get('/v1/list')
+        actual = json.loads(rv.data)
+        self.assertEqual(actual[self.prefix], ['sample.key.1'])
+
+
+class WebCacheTestCase(WebTestBase):
+
+    def setUp(self):
+        super(WebCacheTestCase, self).setUp()
+        web.app.cache.enable()
+
+    @patch('time.time')
+    def test_cached_list_served(self, m_time):
+        m_time.return_value = 10
+        self.app.get('/v1/list/5/0/sample.key.1')
+        web.app.redis.zrem(self.prefix + 'tasks.sample.key.1', 'taskId3')
+        rv = self.app.get('/v1/list/5/0/sample.key.1')
+        actual = json.loads(rv.data)
+        expected = {'supersedes': ['taskId3', 'taskId2', 'taskId1']}
+        self.assertEqual(actual, expected)
+
+    @patch('time.time')
+    def test_cached_list_invalidated(self, m_time):
+        m_time.return_value = 10
+        self.app.get('/v1/list/5/0/sample.key.1')
+        web.app.redis.zrem(self.prefix + 'tasks.sample.key.1', 'taskId3')
+        web.app.cache.invalidate('sample.key.1')
+        rv = self.app.get('/v1/list/5/0/sample.key.1')
+        actual = json.loads(rv.data)
+        expected = {'supersedes': ['taskId2', 'taskId1']}
+        self.assertEqual(actual, expected)
+
+    @patch('time.time')
+    def test_cached_thresholds_fetch_list(self, m_time):
+        m_time.return_value = 10
+        rv = self.app.get('/v1/list/20/0/sample.key.1')
+        self.assertEqual(json.loads(rv.data), {'supersedes': []})
+        rv = self.app.get('/v1/list/5/0/sample.key.1')
+        actual = json.loads(rv.data)
+        expected = {'supersedes': ['taskId3', 'taskId2', 'taskId1']}
+        self.assertEqual(actual, expected)
+
+
 if __name__ == '__main__':
     unittest.main()